@@ -0,0 +1,219 @@
+# analysis_pipeline.py
+"""
+Общий расчёт окна для get_routes, get_raport и следующих ответов по тому же окну.
+
+Pipeline считает этапы по требованию и запоминает их по входам: окно, население, граф с привязанными
+домами и остановками, маршруты до ближайшей по сети остановки и зоны остановок, распределение маршрутов,
+нагрузки и сводка (по методу распределения), использование улиц. Объекты Pipeline хранятся в процессе
+по ключу (сессия, версия, отпечаток файлов, точка, радиус, зерно) - отчёт сразу после маршрутов того же
+окна только рисует картинки.
+
+Граф строится один раз, а каждый этап получает его копию со своими весами (общие массивы структуры):
+длины улиц или веса после распределения своим методом. Распределение меняет веса только своей копии,
+поэтому этапы и отрисовка в разных потоках не мешают друг другу.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import metrics
+from dataset_cache import datasets, dataset_fingerprint
+from graph_engine import create_street_graph
+from street_graph import (POPULATION_SEED, add_places_to_graph, assign_routes_to_population,
+                          calculate_equilibrium_loads, calculate_population_loads, cpu_shortest_path_usage,
+                          nearest_stop_routes, stop_catchments, summarize_traffic_data, update_weights)
+
+# Сколько окон держать в памяти процесса
+PIPELINE_CACHE_SIZE = int(os.environ.get("PIPELINE_CACHE_SIZE", 8))
+# Процессов для поиска путей этапа использования улиц (cpu_shortest_path_usage); 0 - в процессе задачи
+STREET_USAGE_WORKERS = int(os.environ.get("STREET_USAGE_WORKERS", 0))
+
+
+class Pipeline:
+    """
+    Этапы расчёта окна radius метров вокруг (lat, long) набора данных data.
+    Каждый этап считается один раз на свои параметры; progress(stage) вызывается только для этапов,
+    которые действительно считаются. Этапы, от которых зависит этап, запрашиваются до его начала -
+    так порядок и длительности этапов в progress остаются прежними.
+    """
+
+    def __init__(self, data, lat, long, radius=1000, seed=POPULATION_SEED):
+        self.data = data
+        self.lat, self.long, self.radius, self.seed = lat, long, radius, seed
+        self.progress = None
+        self._results = {}
+        # Этапы зависят друг от друга - считаются по одному
+        self._lock = threading.RLock()
+
+    def stage(self, name):
+        """Сообщает о начале этапа (и этапов потребителя - например, отрисовки)"""
+        if self.progress is not None:
+            self.progress(name)
+
+    def _memoized(self, name, compute, *params):
+        key = (name,) + params
+        with self._lock:
+            if key not in self._results:
+                self.stage(name)
+                self._results[key] = compute(*params)
+            return self._results[key]
+
+    # --- Window ---
+    def window(self):
+        """Дома (с населением Total_People), остановки и улицы окна"""
+        _, buses, streets = self._memoized("clip", self.data.clip, self.lat, self.long, self.radius)
+        return self._memoized("population", self._population), buses, streets
+
+    def _population(self):
+        houses = self._memoized("clip", self.data.clip, self.lat, self.long, self.radius)[0]
+        # Население считается по всей версии с фиксированным зерном и берётся для домов окна
+        return houses.assign(Total_People=self.data.population(self.seed).loc[houses.index])
+
+    # --- Graph ---
+    def graph(self, assignment=None):
+        """
+        (граф улиц с домами и остановками, KD-дерево уличных вершин, их координаты).
+        Граф - своя копия для вызывающего: веса - длины рёбер, с assignment - веса после распределения
+        нагрузки этим методом; изменение её весов не влияет на другие этапы.
+        """
+        self.window()
+        G, tree, node_coords = self._memoized("graph", self._graph)
+        weights = G.weights if assignment is None else self.loads(assignment)[1]
+        return G.with_weights(weights.copy()), tree, node_coords
+
+    def _graph(self):
+        houses, buses, streets = self.window()
+        G, node_coords = create_street_graph(streets)
+        tree = cKDTree(node_coords)
+
+        self.stage("places")
+        # Дома и остановки привязываются к ближайшим отрезкам улиц (привязка ко всей версии кешируется)
+        add_places_to_graph(houses, G, tree, node_coords, 'house', points=self.data.house_points(houses),
+                            snap=self.data.snap_places("houses", houses, streets))
+        add_places_to_graph(buses, G, tree, node_coords, 'bus_stop',
+                            snap=self.data.snap_places("buses", buses, streets))
+        metrics.observe_graph(G, len(houses), len(buses))
+        return G, tree, node_coords
+
+    # --- Routes ---
+    def nearest_routes(self):
+        """
+        Маршруты дом -> ближайшая по сети остановка {вершина дома: точки пути или None},
+        вершины домов по порядку и зоны обслуживания остановок (см. stop_catchments)
+        """
+        self.graph()
+        return self._memoized("nearest_routes", self._nearest_routes)
+
+    def _nearest_routes(self):
+        G, _, _ = self.graph()
+        house_nodes = G.place_nodes['house']
+        bus_nodes = G.place_nodes['bus_stop']
+        house_locations = [G.node_key(node) for node in house_nodes]
+        routes, nearest = nearest_stop_routes(G)
+
+        # Зоны обслуживания: номер остановки (в порядке buses) для каждой вершины
+        stop_index = np.full(G.number_of_nodes, -1, dtype=np.int64)
+        stop_index[bus_nodes] = np.arange(len(bus_nodes))
+        stop_of_node = np.where(nearest >= 0, stop_index[np.maximum(nearest, 0)], -1)
+        catchments = stop_catchments(G, stop_of_node, house_nodes, G.total_people[house_nodes], G.coords[bus_nodes])
+
+        return routes, house_locations, catchments
+
+    def route_distribution(self):
+        """Маршруты населения от домов ко всем остановкам (см. assign_routes_to_population)"""
+        self.graph()
+        return self._memoized("routes", self._route_distribution)
+
+    def _route_distribution(self):
+        houses, buses, _ = self.window()
+        G, tree, node_coords = self.graph()
+        return assign_routes_to_population(G, houses, buses, tree, node_coords)
+
+    # --- Loads ---
+    def loads(self, assignment="free_flow"):
+        """
+        (нагрузка рёбер {(u, v): люди}, веса рёбер после распределения, сведения о сходимости или None).
+        free_flow - кратчайшие пути по длине и однократное update_weights; иначе метод равновесного
+        распределения (frank_wolfe, msa), при котором пути перестраиваются с учётом загруженности.
+        """
+        self.route_distribution()
+        return self._memoized("loads", self._loads, assignment)
+
+    def _loads(self, assignment):
+        route_distribution = self.route_distribution()
+        houses, buses, _ = self.window()
+        G, tree, node_coords = self.graph()
+        if assignment == "free_flow":
+            edge_loads = calculate_population_loads(G, route_distribution)
+            update_weights(G, edge_loads)
+            info = None
+        else:
+            # Пути перестраиваются с учётом загруженности, веса графа обновляются внутри
+            edge_loads, info = calculate_equilibrium_loads(G, houses, buses, tree, node_coords, method=assignment)
+        return edge_loads, G.weights.copy(), info
+
+    def summary(self, assignment="free_flow"):
+        """Сводка по нагрузке (summarize_traffic_data); для равновесного распределения - и его сходимость"""
+        self.loads(assignment)
+        return self._memoized("summary", self._summary, assignment)
+
+    def _summary(self, assignment):
+        edge_loads, _, info = self.loads(assignment)
+        G, _, _ = self.graph()
+        summary = summarize_traffic_data(G, edge_loads, self.route_distribution(), self.window()[1])
+        if info is not None:
+            summary["assignment"] = info
+        return summary
+
+    def street_usage(self, assignment="free_flow"):
+        """Сколько путей от домов до двух ближайших остановок проходит по каждому ребру (по весам после распределения)"""
+        self.loads(assignment)
+        return self._memoized("usage", self._street_usage, assignment)
+
+    def _street_usage(self, assignment):
+        houses, buses, _ = self.window()
+        G, _, _ = self.graph(assignment)
+        return cpu_shortest_path_usage(houses, buses, G, workers=STREET_USAGE_WORKERS or None)
+
+
+class PipelineCache:
+    """LRU-кеш объектов Pipeline процесса; ключ включает отпечаток файлов версии"""
+
+    def __init__(self, max_items=PIPELINE_CACHE_SIZE):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        pipeline = create()
+        with self._lock:
+            # Параллельный вызов мог успеть создать тот же объект - берём первый
+            pipeline = self._items.setdefault(key, pipeline)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return pipeline
+
+
+pipelines = PipelineCache()
+
+
+def get_pipeline(folder_path, id, version, lat, long, radius=1000, seed=POPULATION_SEED, progress=None):
+    """Pipeline окна из кеша процесса или новый; этапы нового окна будут сообщать о себе через progress"""
+    folder_path = Path(folder_path)
+    progress = progress or (lambda name: None)
+    progress("load")
+    # Общий кеш наборов данных: ключ (сессия, версия, отпечаток файлов)
+    data = datasets.get(id, version, folder_path)
+    key = (id, version, dataset_fingerprint(folder_path), lat, long, radius, seed)
+    pipeline = pipelines.get(key, lambda: Pipeline(data, lat, long, radius, seed))
+    pipeline.progress = progress
+    return pipeline
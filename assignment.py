@@ -0,0 +1,97 @@
+# assignment.py
+import os
+
+import numpy as np
+
+from graph_engine import ContractedGraph, last_value_per_node, tree_edge_loads
+
+# Пределы итераций равновесного распределения: число итераций и относительный разрыв (gap)
+ASSIGNMENT_MAX_ITERATIONS = int(os.environ.get("ASSIGNMENT_MAX_ITERATIONS", 50))
+ASSIGNMENT_GAP = float(os.environ.get("ASSIGNMENT_GAP", 1e-3))
+
+ASSIGNMENT_METHODS = ("frank_wolfe", "msa")
+
+
+# --- Cost function ---
+def congestion_costs(free_flow, loads, capacity=300):
+    """Вес ребра при нагрузке loads - та же формула, что в update_weights: w * (1 + 2 * load / capacity)"""
+    return free_flow * (1 + loads / capacity * 2)
+
+
+# --- All-or-nothing loading ---
+def all_or_nothing(G, stops, node_weights):
+    """
+    Нагрузка рёбер, если все идут кратчайшими путями при текущих весах G:
+    одна обратная дейкстра на все остановки, нагрузка каждого дерева - суммы по поддеревьям.
+    """
+    loads = np.zeros(G.number_of_edges)
+    dist, predecessors = G.shortest_path_tree(stops, reverse=True)
+    for stop_dist, stop_predecessors in zip(dist, predecessors):
+        loads += tree_edge_loads(G, stop_dist, stop_predecessors, node_weights)
+    return loads
+
+def _frank_wolfe_step(free_flow, loads, direction, capacity):
+    """
+    Точный шаг по направлению direction: минимум интеграла стоимости free_flow * (x + x^2 / capacity).
+    Стоимость линейна по нагрузке, поэтому шаг считается по формуле, без поиска.
+    """
+    costs = congestion_costs(free_flow, loads, capacity)
+    numerator = -np.dot(costs, direction)
+    denominator = 2 / capacity * np.dot(free_flow, direction ** 2)
+    if denominator <= 0:
+        return 0.0
+    return float(np.clip(numerator / denominator, 0, 1))
+
+
+# --- Equilibrium ---
+def equilibrium_assignment(G, house_nodes, people, bus_nodes, capacity=300, method="frank_wolfe",
+                           max_iterations=ASSIGNMENT_MAX_ITERATIONS, gap=ASSIGNMENT_GAP):
+    """
+    Равновесное распределение пешеходов (по Вардропу) между путями дом -> остановка.
+    Спрос тот же, что в assign_routes_to_population: из уличной вершины каждого дома (последнего в вершине)
+    люди идут ко всем остановкам. На каждой итерации пути перестраиваются по весам, увеличенным нагрузкой
+    (congestion_costs), и нагрузки сдвигаются к новому решению:
+    - frank_wolfe - на оптимальный шаг;
+    - msa - метод последовательных усреднений, шаг 1 / (k + 1).
+    Пути ищутся по графу со стянутыми цепочками (ContractedGraph): его структура строится один раз,
+    между итерациями меняются только веса, нагрузки разворачиваются обратно на рёбра G.
+    Останавливается, когда относительный разрыв (gap) не больше gap или после max_iterations итераций.
+    После расчёта веса G - стоимости при итоговой нагрузке, как после update_weights.
+    Возвращает (массив нагрузок по рёбрам, {"method", "iterations", "gap"}).
+    """
+    if method not in ASSIGNMENT_METHODS:
+        raise ValueError(f"Unknown assignment method {method}")
+    free_flow = G.weights.copy()
+    info = {"method": method, "iterations": 0, "gap": 0.0}
+    if len(bus_nodes) == 0:
+        return np.zeros(G.number_of_edges), info
+    house_nodes = np.asarray(house_nodes, dtype=np.int64)
+    bus_nodes = np.asarray(bus_nodes, dtype=np.int64)
+    routing = ContractedGraph(G, keep=np.concatenate((house_nodes, bus_nodes)))
+    node_weights, _ = last_value_per_node(routing.graph.number_of_nodes, routing.index[house_nodes], people)
+    stops = np.unique(routing.index[bus_nodes])
+
+    # Закрытые (бесконечные) рёбра не участвуют в расчёте шага и разрыва
+    finite = np.isfinite(free_flow)
+    loads = routing.expand_loads(all_or_nothing(routing.graph, stops, node_weights))
+    for iteration in range(1, max_iterations + 1):
+        costs = congestion_costs(free_flow, loads, capacity)
+        routing.set_weights(costs)
+        target = routing.expand_loads(all_or_nothing(routing.graph, stops, node_weights))
+
+        # Относительный разрыв: насколько текущие пути дороже кратчайших при текущих весах
+        total = np.dot(costs[finite], loads[finite])
+        relative_gap = (total - np.dot(costs[finite], target[finite])) / total if total > 0 else 0.0
+        info.update(iterations=iteration, gap=float(relative_gap))
+        if relative_gap <= gap:
+            break
+
+        direction = target - loads
+        if method == "frank_wolfe":
+            step = _frank_wolfe_step(free_flow[finite], loads[finite], direction[finite], capacity)
+        else:
+            step = 1 / (iteration + 1)
+        loads = loads + step * direction
+
+    G.set_weights(congestion_costs(free_flow, loads, capacity))
+    return loads, info
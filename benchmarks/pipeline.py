@@ -0,0 +1,207 @@
+# benchmarks/pipeline.py
+"""
+Замер этапов find_routes_and_places и generate_raport: время и пиковая память (RSS) каждого этапа.
+
+Наборы данных:
+- default - default_data (окно по умолчанию из пайплайнов);
+- synthetic-<N>x - синтетический город-решётка, в N раз больше базового по числу домов и улиц.
+
+Каждый расчёт идёт в отдельном процессе: пиковая память не смешивается между прогонами,
+а прогон, не уложившийся в --timeout, записывается с уже пройденными этапами и статусом timeout.
+Этапы - те же, что видит очередь задач (progress): load (чтение shapefile и проекция), clip, population,
+graph, places, nearest_routes, routes, loads, summary, heatmap; в отчёте - plots (тепловая карта
+и использование улиц параллельно, поиск путей для второго - этап usage), pdf.
+
+Запуск из корня репозитория:
+    python benchmarks/pipeline.py --scales 1 10 100 --output benchmark.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Базовый синтетический город: 20 x 20 кварталов по 4 дома
+BASE_BLOCKS = 20
+PIPELINES = ("routes", "raport")
+
+
+# --- Memory ---
+def _memory():
+    """(текущий RSS, пиковый RSS) процесса в байтах"""
+    try:
+        with open("/proc/self/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError):
+        # Без /proc доступен только пик за всё время процесса (Linux - КБ, macOS - байты)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == "darwin" else 1024
+        return peak, peak
+
+def _reset_peak():
+    """Сбрасывает пиковый RSS, чтобы пик считался по этапу (только Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+# --- Child process ---
+def _run_pipeline(events, pipeline, folder, lat, long, radius):
+    import data_process_new
+    import find_bad_places2
+
+    def progress(stage):
+        rss, peak = _memory()
+        events.put(("stage", stage, time.perf_counter(), rss, peak))
+        _reset_peak()
+
+    task = data_process_new.find_routes_and_places if pipeline == "routes" else find_bad_places2.generate_raport
+    window = {} if lat is None else {"lat": lat, "long": long, "radius": radius}
+    try:
+        task(folder, "benchmark", os.path.basename(folder), progress=progress, **window)
+        progress("done")
+        events.put(("status", "ok", None))
+    except Exception as e:
+        progress("failed")
+        events.put(("status", "failed", repr(e)))
+
+def run_pipeline(pipeline, folder, window, timeout, workdir):
+    """Прогон одного пайплайна в отдельном процессе, возвращает запись для JSON"""
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    cwd = os.getcwd()
+    # Прогон идёт в рабочей папке, чтобы случайные файлы не попадали в репозиторий
+    os.chdir(workdir)
+    try:
+        process = context.Process(target=_run_pipeline, args=(events, pipeline, folder) + window)
+        started = time.perf_counter()
+        process.start()
+    finally:
+        os.chdir(cwd)
+
+    marks, status, error = [], "timeout", None
+    deadline = started + timeout
+    while True:
+        try:
+            event = events.get(timeout=max(0.1, deadline - time.perf_counter()))
+        except queue.Empty:
+            if time.perf_counter() >= deadline or not process.is_alive():
+                break
+            continue
+        if event[0] == "stage":
+            marks.append(event[1:])
+        else:
+            _, status, error = event
+            break
+    if process.is_alive() and status == "timeout":
+        process.terminate()
+    process.join()
+    if status == "timeout" and process.exitcode not in (None, 0, -15):
+        status, error = "crashed", f"exit code {process.exitcode}"
+
+    # Отметка этапа - его начало; пик памяти этапа приходит со следующей отметкой
+    stages = []
+    for (stage, start, _, _), (_, end, rss, peak) in zip(marks, marks[1:]):
+        stages.append({"stage": stage, "wall_time": end - start, "rss": rss, "peak_rss": peak})
+    if status == "timeout" and marks and marks[-1][0] not in ("done", "failed"):
+        stages.append({"stage": marks[-1][0], "wall_time": None, "rss": None, "peak_rss": None, "unfinished": True})
+    stages = [stage for stage in stages if stage["stage"] not in ("started", "done", "failed")]
+
+    return {
+        "pipeline": pipeline,
+        "status": status,
+        "error": error,
+        "wall_time": time.perf_counter() - started if status == "timeout" else
+        (marks[-1][1] - marks[0][1] if marks else None),
+        "peak_rss": max((stage["peak_rss"] for stage in stages if stage["peak_rss"]), default=None),
+        "stages": stages,
+    }
+
+
+# --- Datasets ---
+def synthetic_dataset(scale, root):
+    """Город в scale раз больше базового; окно расчёта покрывает его целиком"""
+    import numpy as np
+    from synthetic import grid_city, write_version
+
+    blocks = int(round(BASE_BLOCKS * np.sqrt(scale)))
+    lat, long = 55.55, 37.5
+    houses, buses, streets = grid_city(blocks, jitter=0.2, lat=lat, long=long)
+    folder = write_version(os.path.join(root, f"synthetic-{scale}x"), houses, buses, streets)
+    # Радиус окна - в метрах EPSG:3857, на этой широте они короче метров на местности
+    radius = blocks * 100 * 0.75 / np.cos(np.radians(lat))
+    sizes = {"houses": len(houses), "bus_stops": len(buses), "streets": len(streets)}
+    return str(folder), (lat, long, float(radius)), sizes
+
+def default_dataset(path):
+    return os.path.abspath(path), (None, None, None), None
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--default-data", default=os.path.join(ROOT, "default_data"),
+                        help="папка версии с реальными данными; пустая строка - не замерять")
+    parser.add_argument("--scales", type=int, nargs="*", default=[1, 10, 100],
+                        help="масштабы синтетического города относительно базового")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument("--timeout", type=float, default=600, help="предел на один прогон, секунд")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    datasets = []
+    if args.default_data:
+        datasets.append(("default",) + default_dataset(args.default_data))
+    for scale in args.scales:
+        datasets.append((f"synthetic-{scale}x",) + synthetic_dataset(scale, workdir))
+
+    runs = []
+    try:
+        for name, folder, window, sizes in datasets:
+            for pipeline in args.pipelines:
+                run = {"dataset": name, "sizes": sizes, **run_pipeline(pipeline, folder, window, args.timeout, workdir)}
+                runs.append(run)
+                total = f"{run['wall_time']:.2f}s" if run["wall_time"] is not None else "-"
+                print(f"{name:16s} {pipeline:7s} {run['status']:8s} {total:>9s}  "
+                      + "  ".join(f"{stage['stage']} {stage['wall_time']:.2f}s" for stage in run["stages"]
+                                  if stage["wall_time"] is not None))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "timeout": args.timeout,
+        },
+        "runs": runs,
+    }
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"Saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
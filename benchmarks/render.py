@@ -0,0 +1,111 @@
+# benchmarks/render.py
+"""
+Замер отрисовки тепловой карты и карты использования улиц: текущие plot_heatmap / plot_street_usage
+против прежней реализации (ax.plot и GeoSeries.plot на каждое ребро).
+
+Запуск из корня репозитория: python benchmarks/render.py [--blocks 20 40] [--dpi 100]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+import geopandas as gpd
+import matplotlib.cm as cm
+import matplotlib.pyplot as plt
+import numpy as np
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import grid_city
+from graph_engine import create_street_graph
+from street_graph import place_points, plot_heatmap, plot_street_usage
+
+
+# --- Прежняя реализация (для сравнения) ---
+def legacy_plot_heatmap(G, edge_loads, buses, path):
+    loads = np.array(list(edge_loads.values()))
+    norm = plt.Normalize(vmin=0, vmax=loads.max())
+    cmap = plt.cm.Reds
+    fig, ax = plt.subplots(figsize=(20, 18))
+    edge_colors = []
+    for (u, v), load in edge_loads.items():
+        color = cmap(norm(load))
+        edge_colors.append((u, v, load, color))
+        ax.plot([u[0], v[0]], [u[1], v[1]], color=color, linewidth=2)
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+    sm.set_array([])
+    plt.colorbar(sm, ax=ax, label='Load Intensity')
+    plt.title("Heatmap of Pedestrian Congestion")
+    plt.tight_layout()
+    buses.plot(ax=ax, color='green', markersize=10, label='Bus Stops', zorder=5)
+    plt.legend()
+    plt.savefig(path, format='png')
+    plt.close(fig)
+    return path, edge_colors
+
+def legacy_plot_street_usage(streets, street_usage, houses, buses, path):
+    fig, ax = plt.subplots(figsize=(12, 12))
+    streets.plot(ax=ax, color='lightgray', linewidth=0.5)
+    max_usage = max(street_usage.values())
+    for (start, end), usage in street_usage.items():
+        line = LineString([start, end])
+        gpd.GeoSeries([line]).plot(ax=ax, color=cm.viridis(usage / max_usage), linewidth=2)
+    houses.plot(ax=ax, color='blue', markersize=10, label='Houses')
+    buses.plot(ax=ax, color='red', markersize=10, label='Bus Stops')
+    plt.legend()
+    plt.savefig(path, format='png')
+    plt.close(fig)
+    return path
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def run(blocks, dpi, legacy=True):
+    houses, buses, streets = grid_city(blocks)
+    G, _ = create_street_graph(streets)
+    rng = np.random.default_rng(0)
+    edge_loads = G.edge_dict(rng.integers(0, 500, G.number_of_edges).astype(float))
+    # Используется примерно треть рёбер, как у маршрутов до двух ближайших остановок
+    used = rng.random(G.number_of_edges) < 0.3
+    street_usage = {key: int(count) for key, count, keep in
+                    zip(G.edge_keys(), rng.integers(1, 50, G.number_of_edges), used) if keep}
+    houses_points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(*place_points(houses).T), crs=houses.crs)
+
+    row = {"blocks": blocks, "edges": G.number_of_edges, "used_edges": len(street_usage)}
+    row["heatmap"] = timed(plot_heatmap, G, edge_loads, buses, dpi=dpi)
+    row["street_usage"] = timed(plot_street_usage, streets, street_usage, houses_points, buses, dpi=dpi)
+    if legacy:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            row["legacy_heatmap"] = timed(legacy_plot_heatmap, G, edge_loads, buses,
+                                          os.path.join(tmp_dir, "heatmap.png"))
+            row["legacy_street_usage"] = timed(legacy_plot_street_usage, streets, street_usage, houses_points, buses,
+                                               os.path.join(tmp_dir, "routes.png"))
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, nargs="+", default=[10, 20, 40], help="размер решётки в кварталах")
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--no-legacy", action="store_true", help="не замерять прежнюю реализацию")
+    args = parser.parse_args()
+
+    for blocks in args.blocks:
+        row = run(blocks, args.dpi, legacy=not args.no_legacy)
+        line = f"blocks={row['blocks']:4d} edges={row['edges']:7d} used={row['used_edges']:7d}  " \
+               f"heatmap {row['heatmap']:7.2f}s  usage {row['street_usage']:7.2f}s"
+        if "legacy_heatmap" in row:
+            line += f"  | legacy heatmap {row['legacy_heatmap']:7.2f}s  usage {row['legacy_street_usage']:7.2f}s" \
+                    f"  (x{row['legacy_heatmap'] / row['heatmap']:.1f}, x{row['legacy_street_usage'] / row['street_usage']:.1f})"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
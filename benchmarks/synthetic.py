@@ -0,0 +1,62 @@
+# benchmarks/synthetic.py
+"""Синтетический город-решётка для замеров: кварталы, улицы по границам кварталов, остановки на перекрёстках."""
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString, Point, box
+
+# Метров в градусе широты; для долготы делим на cos(широты)
+METERS_PER_DEGREE = 111_320
+
+
+def grid_city(blocks=20, block_size=100, buildings_per_block=4, stop_every=3, lat=55.55, long=37.5, seed=0,
+              jitter=0.0):
+    """
+    Строит город blocks x blocks кварталов со стороной block_size метров вокруг точки (lat, long).
+    jitter - случайный сдвиг перекрёстков в долях квартала: без него у решётки много путей равной длины.
+    Возвращает (houses, buses, streets) в EPSG:4326 с колонками Apartments и Foot, как у загруженных версий.
+    """
+    rng = np.random.default_rng(seed)
+    step_y = block_size / METERS_PER_DEGREE
+    step_x = step_y / np.cos(np.radians(lat))
+    x0 = long - blocks * step_x / 2
+    y0 = lat - blocks * step_y / 2
+    xs = x0 + np.arange(blocks + 1) * step_x
+    ys = y0 + np.arange(blocks + 1) * step_y
+    # Координаты перекрёстков (i, j)
+    px = xs[:, None] + rng.uniform(-jitter, jitter, (blocks + 1, blocks + 1)) * step_x
+    py = ys[None, :] + rng.uniform(-jitter, jitter, (blocks + 1, blocks + 1)) * step_y
+
+    # Улица между соседними перекрёстками - отдельная линия
+    streets = [LineString([(px[i, j], py[i, j]), (px[i + 1, j], py[i + 1, j])])
+               for j in range(blocks + 1) for i in range(blocks)]
+    streets += [LineString([(px[i, j], py[i, j]), (px[i, j + 1], py[i, j + 1])])
+                for i in range(blocks + 1) for j in range(blocks)]
+
+    # Дома - квадраты внутри квартала с отступом от улиц
+    side = int(np.ceil(np.sqrt(buildings_per_block)))
+    cell_x, cell_y = step_x / side, step_y / side
+    houses = []
+    for i in range(blocks):
+        for j in range(blocks):
+            for k in range(buildings_per_block):
+                cx = xs[i] + (k % side + 0.5) * cell_x
+                cy = ys[j] + (k // side + 0.5) * cell_y
+                houses.append(box(cx - cell_x / 4, cy - cell_y / 4, cx + cell_x / 4, cy + cell_y / 4))
+
+    stops = [Point(px[i, j], py[i, j]) for i in range(0, blocks + 1, stop_every) for j in range(0, blocks + 1, stop_every)]
+
+    houses = gpd.GeoDataFrame({"Apartments": rng.integers(0, 120, len(houses))}, geometry=houses, crs="EPSG:4326")
+    buses = gpd.GeoDataFrame(geometry=stops, crs="EPSG:4326")
+    streets = gpd.GeoDataFrame({"Foot": np.ones(len(streets), dtype=int)}, geometry=streets, crs="EPSG:4326")
+    return houses, buses, streets
+
+
+def write_version(folder, houses, buses, streets):
+    """Сохраняет слои в структуре загруженной версии: buildings/, stations/, streets/ с shapefile в каждой"""
+    folder = Path(folder)
+    for layer, name, frame in (("buildings", "houses", houses), ("stations", "stops", buses), ("streets", "streets", streets)):
+        (folder / layer).mkdir(parents=True, exist_ok=True)
+        frame.to_file(folder / layer / f"{name}.shp")
+    return folder
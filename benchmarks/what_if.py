@@ -0,0 +1,128 @@
+# benchmarks/what_if.py
+"""
+Правки what-if против полного пересчёта: время каждой правки Analysis и совпадение результата
+с окном Pipeline (assign_routes_to_population + calculate_population_loads, nearest_stop_routes)
+на отредактированных данных.
+
+Запуск из корня репозитория: python benchmarks/what_if.py [--blocks 30] [--edits 40]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from shapely.geometry import Point
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import grid_city
+from analysis_pipeline import Pipeline
+from dataset_cache import Dataset
+from graph_engine import NODE_TYPES
+from street_graph import (POPULATION_SEED, assign_routes_to_population, calculate_population_loads,
+                          generate_population, nearest_stop_routes, summarize_traffic_data)
+from what_if import Analysis
+
+
+class EditedDataset(Dataset):
+    """Набор данных с населением домов из анализа (у добавленных домов оно своё)"""
+
+    def population(self, seed=POPULATION_SEED):
+        return self.houses['Total_People']
+
+
+def full_recompute(analysis, streets, lat, long, radius):
+    """Расчёт окна Pipeline с нуля по текущим домам, остановкам и закрытым участкам анализа"""
+    start = time.perf_counter()
+    pipeline = Pipeline(EditedDataset(analysis.houses, analysis.buses, streets), lat, long, radius, analysis.seed)
+    houses, buses, _ = pipeline.window()
+    G, tree, node_coords = pipeline.graph()
+    # Закрытые участки - по координатам концов среди уличных вершин (точки мест могут с ними совпадать)
+    closed = sorted(analysis.closed)
+    streets_nodes = np.flatnonzero(G.node_type == NODE_TYPES["street"])
+    index = dict(zip(map(tuple, G.coords[streets_nodes].tolist()), streets_nodes.tolist()))
+    weights = G.weights.copy()
+    weights[G.edge_ids([index[analysis.G.node_key(u)] for u in analysis.G.sources[closed].tolist()],
+                       [index[analysis.G.node_key(v)] for v in analysis.G.indices[closed].tolist()])] = np.inf
+    G.set_weights(weights)
+    route_distribution = assign_routes_to_population(G, houses, buses, tree, node_coords)
+    edge_loads = calculate_population_loads(G, route_distribution)
+    summary = summarize_traffic_data(G, edge_loads, route_distribution, buses)
+    routes, _ = nearest_stop_routes(G)
+    return edge_loads, summary, routes, time.perf_counter() - start
+
+def check(analysis, streets, lat, long, radius):
+    edge_loads, summary, routes, elapsed = full_recompute(analysis, streets, lat, long, radius)
+    incremental = analysis.edge_loads()
+    assert incremental.keys() == edge_loads.keys()
+    # Номера вершин у анализа и пересчёта разные - сравниваем по ключам рёбер
+    assert np.allclose(list(incremental.values()), [edge_loads[edge] for edge in incremental], atol=1e-6)
+    current = analysis.summary()
+    for key, value in summary.items():
+        assert np.isclose(current[key], value) if value is not None else current[key] is None, (key, current[key], value)
+    assert analysis.routes() == routes
+    return elapsed
+
+def random_edit(analysis, rng, bounds):
+    x0, y0, x1, y1 = bounds
+    point = Point(rng.uniform(x0, x1), rng.uniform(y0, y1))
+    kind = rng.choice(["add_building", "remove_building", "add_stop", "move_stop", "remove_stop",
+                       "close_segment", "open_segment"])
+    if kind == "add_building":
+        return {"op": kind, "x": point.x, "y": point.y, "apartments": int(rng.integers(1, 200))}
+    if kind == "remove_building" and len(analysis.houses):
+        return {"op": kind, "id": int(rng.choice(analysis.houses.index))}
+    if kind == "add_stop":
+        return {"op": kind, "x": point.x, "y": point.y}
+    if kind in ("move_stop", "remove_stop") and len(analysis.buses) > 1:
+        edit = {"op": kind, "id": int(rng.choice(analysis.buses.index))}
+        if kind == "move_stop":
+            edit.update(x=point.x, y=point.y)
+        return edit
+    if kind == "close_segment":
+        # Закрываются участки улиц, а не рёбра от улицы до дома или остановки
+        street = analysis.G.node_type == NODE_TYPES["street"]
+        edge = int(rng.choice(np.flatnonzero(street[analysis.G.sources] & street[analysis.G.indices])))
+        u, v = analysis.G.sources[edge], analysis.G.indices[edge]
+        return {"op": kind, "start": analysis.G.node_key(u), "end": analysis.G.node_key(v)}
+    if kind == "open_segment" and analysis.closed:
+        edge = int(rng.choice(sorted(analysis.closed)))
+        u, v = analysis.G.sources[edge], analysis.G.indices[edge]
+        return {"op": kind, "start": analysis.G.node_key(u), "end": analysis.G.node_key(v)}
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=30)
+    parser.add_argument("--edits", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Сдвиг перекрёстков убирает равные по длине пути, иначе выбор среди них зависит от порядка обхода
+    # Окно на весь город: радиус окна - в метрах EPSG:3857, на этой широте они почти вдвое короче настоящих
+    lat, long, radius = 55.55, 37.5, args.blocks * 200
+    houses, buses, streets = grid_city(args.blocks, lat=lat, long=long, jitter=0.2, seed=args.seed)
+    houses["Total_People"] = generate_population(houses, POPULATION_SEED)
+    start = time.perf_counter()
+    analysis = Analysis.from_pipeline(Pipeline(EditedDataset(houses, buses, streets), lat, long, radius))
+    print(f"build {time.perf_counter() - start:.2f}s: {len(houses)} houses, {len(buses)} stops, "
+          f"{analysis.G.number_of_edges} edges")
+
+    rng = np.random.default_rng(args.seed)
+    bounds = streets.total_bounds
+    applied = 0
+    while applied < args.edits:
+        edit = random_edit(analysis, rng, bounds)
+        if edit is None:
+            continue
+        start = time.perf_counter()
+        analysis.apply(edit)
+        elapsed = time.perf_counter() - start
+        full = check(analysis, streets, lat, long, radius)
+        applied += 1
+        print(f"{edit['op']:16s} {elapsed * 1000:8.1f} ms   full recompute {full * 1000:8.1f} ms   ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+# catalog.py
+"""
+Каталог версий и наборов данных: версии сессий, наборы (папки слоёв), их файлы с размерами и sha256,
+число объектов и охват (bbox в EPSG:4326) каждого слоя.
+
+Каталог - база SQLAlchemy (CATALOG_URL): локально файл SQLite рядом с сессиями, в docker-compose - Postgres
+из сервиса db. Записи меняются транзакциями, поэтому параллельные загрузки не теряют версии, а списки
+версий и файлов - один запрос по индексу вместо обхода папок.
+
+Через каталог остальные части берут хеш содержимого версии для ключей кешей: он считается по sha256
+файлов из каталога и пересчитывается (только для изменившихся файлов), когда отпечаток
+dataset_fingerprint папки расходится с записанным.
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import (BigInteger, Column, DateTime, Float, ForeignKey, Integer, String, UniqueConstraint,
+                        create_engine, event, select)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+
+from dataset_cache import dataset_fingerprint, dataset_files
+
+# Папка сессий (как BASE_SAVE_FOLDER в main.py)
+CATALOG_ROOT = os.environ.get("CATALOG_ROOT", "uploaded_files")
+# База каталога; по умолчанию SQLite в служебном файле папки сессий
+CATALOG_URL = os.environ.get("CATALOG_URL", "sqlite:///" + os.path.join(CATALOG_ROOT, ".catalog.sqlite"))
+# Сколько раз повторять транзакцию, столкнувшуюся с параллельной записью той же версии
+CATALOG_RETRIES = 3
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+Base = declarative_base()
+
+
+class Version(Base):
+    __tablename__ = "catalog_versions"
+    __table_args__ = (UniqueConstraint("session_id", "name"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String(100), nullable=False)
+    name = Column(String(255), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    # dataset_fingerprint папки на момент обхода; None - файлы менялись, нужен новый обход
+    fingerprint = Column(String(40))
+    content_hash = Column(String(64))
+    datasets = relationship("Dataset", cascade="all, delete-orphan", order_by="Dataset.name")
+
+
+class Dataset(Base):
+    __tablename__ = "catalog_datasets"
+    __table_args__ = (UniqueConstraint("version_id", "name"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    version_id = Column(Integer, ForeignKey("catalog_versions.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String(255), nullable=False)
+    # Число объектов и охват слоя shapefile; None, если .shp в наборе нет
+    feature_count = Column(Integer)
+    min_lon = Column(Float)
+    min_lat = Column(Float)
+    max_lon = Column(Float)
+    max_lat = Column(Float)
+    files = relationship("DatasetFile", cascade="all, delete-orphan", order_by="DatasetFile.name")
+
+
+class DatasetFile(Base):
+    __tablename__ = "catalog_files"
+    __table_args__ = (UniqueConstraint("dataset_id", "name"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dataset_id = Column(Integer, ForeignKey("catalog_datasets.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+
+
+# --- Files on disk ---
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as input:
+        for chunk in iter(lambda: input.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_files(dataset_folder, known=None):
+    """
+    Файлы набора (с вложенными папками, без служебных) по порядку: {"name", "size", "sha256", "mtime_ns"}.
+    known - {имя: (размер, mtime_ns, sha256)} из каталога: файлы с тем же размером и временем не перечитываются.
+    """
+    dataset_folder = Path(dataset_folder)
+    known = known or {}
+    result = []
+    for path in dataset_files(dataset_folder):
+        name = path.relative_to(dataset_folder).as_posix()
+        stat = path.stat()
+        size, mtime_ns, sha256 = known.get(name, (None, None, None))
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            sha256 = file_sha256(path)
+        result.append({"name": name, "size": stat.st_size, "sha256": sha256, "mtime_ns": stat.st_mtime_ns})
+    return result
+
+
+def _sidecar(shapefile, extension):
+    for path in shapefile.parent.glob(shapefile.stem + ".*"):
+        if path.suffix.lower() == "." + extension:
+            return path
+    return None
+
+
+def layer_summary(dataset_folder):
+    """
+    (число объектов, (min_lon, min_lat, max_lon, max_lat)) первого shapefile набора по .shx, .dbf и заголовку .shp -
+    без чтения геометрии. Охват переводится из системы координат .prj в EPSG:4326; (None, None) без .shp.
+    """
+    shapefiles = sorted(Path(dataset_folder).glob("*.shp"))
+    if not shapefiles:
+        return None, None
+    shapefile = shapefiles[0]
+
+    # Индекс .shx - заголовок 100 байт и по 8 байт на объект; без него - число записей из заголовка .dbf
+    feature_count = None
+    shx, dbf = _sidecar(shapefile, "shx"), _sidecar(shapefile, "dbf")
+    if shx is not None and shx.stat().st_size >= 100:
+        feature_count = (shx.stat().st_size - 100) // 8
+    elif dbf is not None:
+        with open(dbf, "rb") as input:
+            header = input.read(8)
+        if len(header) == 8:
+            feature_count, = struct.unpack("<I", header[4:8])
+
+    with open(shapefile, "rb") as input:
+        header = input.read(100)
+    if len(header) < 100 or feature_count == 0:
+        return feature_count, None
+    bbox = struct.unpack("<4d", header[36:68])
+
+    prj = _sidecar(shapefile, "prj")
+    if prj is not None:
+        try:
+            from pyproj import CRS, Transformer
+            transformer = Transformer.from_crs(CRS.from_user_input(prj.read_text(errors="ignore")), "EPSG:4326",
+                                               always_xy=True)
+            bbox = transformer.transform_bounds(*bbox)
+        except Exception as e:
+            print(f"Bounding box of {shapefile} is not converted to EPSG:4326: {e}")
+            return feature_count, None
+    return feature_count, tuple(float(value) for value in bbox)
+
+
+def content_hash_of(datasets):
+    """Хеш содержимого версии по файлам наборов {набор: [{"name", "size", "sha256"}]}"""
+    digest = hashlib.sha256()
+    for dataset in sorted(datasets):
+        for file in sorted(datasets[dataset], key=lambda file: file["name"]):
+            digest.update(f"{dataset}/{file['name']}:{file['size']}:{file['sha256']}\n".encode())
+    return digest.hexdigest()
+
+
+# --- Catalog ---
+class Catalog:
+    """Каталог версий сессий в папке root; база url открывается при первом обращении"""
+
+    def __init__(self, url=CATALOG_URL, root=CATALOG_ROOT):
+        self.url = url
+        self.root = root
+        self._sessions = None
+        self._lock = threading.Lock()
+
+    def version_folder(self, session_id, version):
+        return os.path.join(self.root, session_id, version)
+
+    def _transaction(self):
+        with self._lock:
+            if self._sessions is None:
+                self._sessions = sessionmaker(bind=self._create_engine())
+        return self._sessions.begin()
+
+    def _create_engine(self):
+        url = make_url(self.url)
+        if url.get_backend_name() != "sqlite":
+            return self._create_tables(create_engine(url, pool_pre_ping=True))
+
+        if url.database:
+            os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+        engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": 30})
+
+        # Транзакция SQLite сразу берёт блокировку записи: иначе две транзакции, начавшие с чтения,
+        # не могут обе перейти к записи и одна из них падает, не дождавшись другой
+        @event.listens_for(engine, "connect")
+        def disable_implicit_begin(connection, record):
+            connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+        return self._create_tables(engine)
+
+    @staticmethod
+    def _create_tables(engine):
+        try:
+            Base.metadata.create_all(engine)
+        except (IntegrityError, OperationalError):
+            # Другой процесс создаёт те же таблицы одновременно
+            Base.metadata.create_all(engine)
+        return engine
+
+    def _write(self, work):
+        """Выполняет work(db) в транзакции; при столкновении с параллельной записью повторяет её"""
+        for attempt in range(CATALOG_RETRIES):
+            try:
+                with self._transaction() as db:
+                    return work(db)
+            except IntegrityError:
+                if attempt == CATALOG_RETRIES - 1:
+                    raise
+
+    @staticmethod
+    def _version(db, session_id, version, create=False, created_at=None):
+        row = db.execute(select(Version).where(Version.session_id == session_id, Version.name == version)) \
+            .scalar_one_or_none()
+        if row is None and create:
+            now = datetime.utcnow()
+            row = Version(session_id=session_id, name=version, created_at=created_at or now, updated_at=now)
+            db.add(row)
+            db.flush()
+        return row
+
+    @staticmethod
+    def _set_dataset(db, version_row, name, files, feature_count, bbox):
+        """Заменяет запись набора name версии и его файлов"""
+        for dataset in list(version_row.datasets):
+            if dataset.name == name:
+                version_row.datasets.remove(dataset)
+        db.flush()
+        min_lon, min_lat, max_lon, max_lat = bbox or (None, None, None, None)
+        version_row.datasets.append(Dataset(
+            name=name, feature_count=feature_count, min_lon=min_lon, min_lat=min_lat, max_lon=max_lon,
+            max_lat=max_lat,
+            files=[DatasetFile(name=file["name"], size=file["size"], sha256=file["sha256"], mtime_ns=file["mtime_ns"])
+                   for file in files],
+        ))
+
+    # --- Write ---
+    def record_dataset(self, session_id, version, dataset_name, files=None):
+        """
+        Записывает набор dataset_name после загрузки. files - [{"name", "size", "sha256"}] от save_dataset:
+        sha256 этих файлов не пересчитывается. Версия создаётся, если её не было.
+        """
+        dataset_folder = os.path.join(self.version_folder(session_id, version), dataset_name)
+        known = {}
+        for file in files or ():
+            path = os.path.join(dataset_folder, file["name"])
+            if os.path.exists(path):
+                stat = os.stat(path)
+                if stat.st_size == file["size"]:
+                    known[file["name"]] = (stat.st_size, stat.st_mtime_ns, file["sha256"])
+        scanned = scan_files(dataset_folder, known)
+        feature_count, bbox = layer_summary(dataset_folder)
+
+        def work(db):
+            row = self._version(db, session_id, version, create=True)
+            self._set_dataset(db, row, dataset_name, scanned, feature_count, bbox)
+            # Хеш содержимого пересчитается по каталогу при следующем обращении
+            row.updated_at = datetime.utcnow()
+            row.fingerprint = row.content_hash = None
+
+        self._write(work)
+
+    def sync_version(self, session_id, version, created_at=None):
+        """
+        Сверяет запись версии с папкой: наборы - её подпапки, sha256 считается только для новых и изменившихся
+        файлов. Версия создаётся, если её не было (created_at - время создания для неё). Возвращает хеш содержимого.
+        """
+        folder = self.version_folder(session_id, version)
+        # Отпечаток снимается до обхода: если файлы поменяются во время обхода, он не совпадёт с папкой
+        fingerprint = dataset_fingerprint(folder)
+        with self._transaction() as db:
+            row = self._version(db, session_id, version)
+            known = {} if row is None else {
+                (dataset.name, file.name): (file.size, file.mtime_ns, file.sha256)
+                for dataset in row.datasets for file in dataset.files
+            }
+
+        datasets = {}
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            files = scan_files(path, {file: value for (dataset, file), value in known.items() if dataset == name})
+            datasets[name] = (files,) + layer_summary(path)
+        content_hash = content_hash_of({name: files for name, (files, _, _) in datasets.items()})
+
+        def work(db):
+            row = self._version(db, session_id, version, create=True, created_at=created_at)
+            for dataset in list(row.datasets):
+                if dataset.name not in datasets:
+                    row.datasets.remove(dataset)
+            for name, (files, feature_count, bbox) in datasets.items():
+                self._set_dataset(db, row, name, files, feature_count, bbox)
+            if row.content_hash != content_hash:
+                row.updated_at = datetime.utcnow()
+            row.fingerprint, row.content_hash = fingerprint, content_hash
+
+        self._write(work)
+        return content_hash
+
+    def delete_version(self, session_id, version):
+        def work(db):
+            row = self._version(db, session_id, version)
+            if row is not None:
+                db.delete(row)
+
+        self._write(work)
+
+    def import_session(self, session_id):
+        """
+        Заносит в каталог версии папки сессии, созданной до каталога; время создания берётся из её metadata.json.
+        Возвращает число версий.
+        """
+        session_folder = os.path.join(self.root, session_id)
+        if not os.path.isdir(session_folder):
+            return 0
+        metadata = {}
+        metadata_path = os.path.join(session_folder, "metadata.json")
+        if os.path.exists(metadata_path):
+            try:
+                with open(metadata_path, "r") as f:
+                    metadata = json.load(f)
+            except ValueError:
+                pass
+        versions = [name for name in sorted(os.listdir(session_folder))
+                    if not name.startswith(".") and os.path.isdir(os.path.join(session_folder, name))]
+        for version in versions:
+            created_at = metadata.get(version, {}).get("created_at")
+            self.sync_version(session_id, version, datetime.fromisoformat(created_at) if created_at else None)
+        return len(versions)
+
+    def _import_new_session(self, session_id):
+        """Импортирует папку сессии, если в каталоге у неё ещё нет ни одной версии; True - если что-то занесено"""
+        with self._transaction() as db:
+            known = db.execute(select(Version.id).where(Version.session_id == session_id).limit(1)).first()
+        return known is None and self.import_session(session_id) > 0
+
+    # --- Read ---
+    def content_hash(self, session_id, version):
+        """
+        Хеш содержимого версии (sha256 путей, размеров и sha256 файлов наборов) для ключей кешей.
+        Пока отпечаток папки совпадает с записанным, файлы не читаются; у несуществующей версии - хеш пустой.
+        """
+        folder = self.version_folder(session_id, version)
+        if not os.path.isdir(folder):
+            return content_hash_of({})
+        with self._transaction() as db:
+            row = self._version(db, session_id, version)
+            if row is not None and row.fingerprint == dataset_fingerprint(folder):
+                return row.content_hash
+        return self.sync_version(session_id, version)
+
+    def versions(self, session_id):
+        """Версии сессии [{"version", "created_at"}] по времени создания"""
+        query = select(Version.name, Version.created_at).where(Version.session_id == session_id) \
+            .order_by(Version.created_at, Version.name)
+        with self._transaction() as db:
+            rows = db.execute(query).all()
+        if not rows and self._import_new_session(session_id):
+            return self.versions(session_id)
+        return [{"version": name, "created_at": created_at.isoformat()} for name, created_at in rows]
+
+    def files(self, session_id, version=None):
+        """{версия: {набор: [имена файлов]}} сессии или одной версии"""
+        query = select(Version.name, Dataset.name, DatasetFile.name) \
+            .outerjoin(Dataset, Dataset.version_id == Version.id) \
+            .outerjoin(DatasetFile, DatasetFile.dataset_id == Dataset.id) \
+            .where(Version.session_id == session_id) \
+            .order_by(Version.name, Dataset.name, DatasetFile.name)
+        if version is not None:
+            query = query.where(Version.name == version)
+        with self._transaction() as db:
+            rows = db.execute(query).all()
+        if not rows and self._import_new_session(session_id):
+            return self.files(session_id, version)
+
+        result = {} if version is None else {version: {}}
+        for version_name, dataset, file in rows:
+            datasets = result.setdefault(version_name, {})
+            if dataset is not None:
+                files = datasets.setdefault(dataset, [])
+                if file is not None:
+                    files.append(file)
+        return result
+
+    def describe(self, session_id, version=None):
+        """
+        Сведения о версиях сессии (или одной версии): время создания и изменения, хеш содержимого,
+        наборы с числом объектов, охватом и файлами (размер, sha256)
+        """
+        query = select(Version.name, Version.created_at, Version.updated_at, Version.content_hash,
+                       Dataset.name, Dataset.feature_count, Dataset.min_lon, Dataset.min_lat, Dataset.max_lon,
+                       Dataset.max_lat, DatasetFile.name, DatasetFile.size, DatasetFile.sha256) \
+            .outerjoin(Dataset, Dataset.version_id == Version.id) \
+            .outerjoin(DatasetFile, DatasetFile.dataset_id == Dataset.id) \
+            .where(Version.session_id == session_id) \
+            .order_by(Version.name, Dataset.name, DatasetFile.name)
+        if version is not None:
+            query = query.where(Version.name == version)
+        with self._transaction() as db:
+            rows = db.execute(query).all()
+
+        result = {}
+        for (version_name, created_at, updated_at, content_hash, dataset, feature_count, min_lon, min_lat,
+             max_lon, max_lat, file, size, sha256) in rows:
+            entry = result.setdefault(version_name, {
+                "created_at": created_at.isoformat(),
+                "updated_at": updated_at.isoformat(),
+                "content_hash": content_hash,
+                "datasets": {},
+            })
+            if dataset is None:
+                continue
+            dataset_entry = entry["datasets"].setdefault(dataset, {
+                "feature_count": feature_count,
+                "bbox": None if min_lon is None else [min_lon, min_lat, max_lon, max_lat],
+                "files": [],
+            })
+            if file is not None:
+                dataset_entry["files"].append({"name": file, "size": size, "sha256": sha256})
+        return result
+
+
+# Общий каталог процесса API
+catalog = Catalog()
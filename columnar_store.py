@@ -0,0 +1,157 @@
+# columnar_store.py
+"""
+Колоночное хранилище версии: слои, подготовленные для расчётов, в файлах numpy рядом с исходными shapefile.
+
+Каждая запись хранилища - своя папка STORE_FOLDER-<id> внутри версии, текущая указана в файле STORE_POINTER.
+Указатель заменяется атомарно (os.replace), прежняя папка удаляется только после этого - читатель
+видит либо старое хранилище целиком, либо новое. В папке:
+- manifest.json - формат, отпечаток исходных файлов, колонки и массивы каждого слоя, метаданные версии;
+- <слой>.wkb.npy и <слой>.wkb_offsets.npy - геометрия в EPSG:4326 (WKB подряд и границы записей);
+- <слой>.projected.npy - координаты той же геометрии в EPSG:3857 (по порядку shapely.get_coordinates);
+- <слой>.index.npy - индекс строк; <слой>.c<N>.npy или .json - колонки атрибутов;
+- дополнительные массивы слоя (например, центроиды домов).
+Числовые массивы открываются через np.load(mmap_mode="r") - без чтения файла целиком.
+"""
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+STORE_FOLDER = ".columnar"
+STORE_POINTER = ".columnar.current"
+STORE_FORMAT = 3
+
+
+def _save(folder, name, array):
+    np.save(folder / name, np.ascontiguousarray(array))
+    return name
+
+def _load(folder, name):
+    return np.load(folder / name, mmap_mode="r")
+
+
+# --- Write ---
+def _write_layer(folder, name, frame, projected_coords, arrays):
+    geometry = np.asarray(frame.geometry.values, dtype=object)
+    wkb = shapely.to_wkb(geometry)
+    offsets = np.concatenate(([0], np.cumsum([len(item) for item in wkb]))).astype(np.int64)
+    layer = {
+        "rows": len(frame),
+        "geometry": _save(folder, f"{name}.wkb.npy", np.frombuffer(b"".join(wkb), dtype=np.uint8)),
+        "geometry_offsets": _save(folder, f"{name}.wkb_offsets.npy", offsets),
+        "projected": _save(folder, f"{name}.projected.npy", np.asarray(projected_coords, dtype=float)),
+        "index": _save(folder, f"{name}.index.npy", frame.index.to_numpy()),
+        "columns": [],
+        "arrays": {},
+    }
+
+    for number, column in enumerate(frame.columns.drop(frame.geometry.name)):
+        values = frame[column]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            file = _save(folder, f"{name}.c{number}.npy", values.to_numpy())
+        else:
+            # Строки и прочие типы - в JSON: в .npy они сохраняются только через pickle
+            file = f"{name}.c{number}.json"
+            with open(folder / file, "w", encoding="utf-8") as output:
+                json.dump(values.astype(object).where(values.notna(), None).tolist(), output,
+                          ensure_ascii=False, default=str)
+        layer["columns"].append({"name": column, "file": file})
+
+    for array_name, array in arrays.items():
+        layer["arrays"][array_name] = _save(folder, f"{name}.{array_name}.npy", array)
+    return layer
+
+def _current_store(folder_path):
+    """Папка текущего хранилища версии по указателю или None"""
+    try:
+        with open(folder_path / STORE_POINTER, encoding="utf-8") as input:
+            name = input.read().strip()
+    except OSError:
+        return None
+    return folder_path / name if name else None
+
+def write_store(folder_path, source, layers, meta=None):
+    """
+    Записывает хранилище версии. layers - словарь {слой: (GeoDataFrame в EPSG:4326,
+    координаты геометрии в EPSG:3857, {имя: дополнительный массив})}; source - отпечаток исходных файлов;
+    meta - словарь для JSON (например, отчёт об очистке улиц).
+    Файлы пишутся в новую папку, затем на неё атомарно переключается указатель; прежняя папка удаляется после.
+    """
+    folder_path = Path(folder_path)
+    store = folder_path / f"{STORE_FOLDER}-{uuid.uuid4().hex}"
+    store.mkdir()
+    try:
+        manifest = {
+            "format": STORE_FORMAT,
+            "source": source,
+            "layers": {name: _write_layer(store, name, *layer) for name, layer in layers.items()},
+            "meta": meta or {},
+        }
+        with open(store / "manifest.json", "w", encoding="utf-8") as output:
+            json.dump(manifest, output, ensure_ascii=False)
+
+        previous = _current_store(folder_path)
+        pointer = folder_path / f"{STORE_POINTER}-{uuid.uuid4().hex}"
+        with open(pointer, "w", encoding="utf-8") as output:
+            output.write(store.name)
+        os.replace(pointer, folder_path / STORE_POINTER)
+    except BaseException:
+        shutil.rmtree(store, ignore_errors=True)
+        raise
+
+    # Читатели прежней папки, уже открывшие массивы через mmap, дочитывают их и после удаления файлов
+    if previous is not None and previous != store:
+        shutil.rmtree(previous, ignore_errors=True)
+    # Хранилище старой раскладки (одна папка STORE_FOLDER без указателя) больше не нужно
+    shutil.rmtree(folder_path / STORE_FOLDER, ignore_errors=True)
+
+
+# --- Read ---
+def _read_layer(folder, layer):
+    # Срезы bytes намного дешевле срезов memmap, поэтому буфер WKB читается одним куском
+    buffer = _load(folder, layer["geometry"]).tobytes()
+    offsets = _load(folder, layer["geometry_offsets"]).tolist()
+    wkb = np.empty(layer["rows"], dtype=object)
+    wkb[:] = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    geometry = shapely.from_wkb(wkb)
+    index = pd.Index(_load(folder, layer["index"]))
+
+    columns = {}
+    for column in layer["columns"]:
+        if column["file"].endswith(".npy"):
+            columns[column["name"]] = _load(folder, column["file"])
+        else:
+            with open(folder / column["file"], encoding="utf-8") as input:
+                columns[column["name"]] = json.load(input)
+    frame = gpd.GeoDataFrame(pd.DataFrame(columns, index=index),
+                             geometry=gpd.GeoSeries(geometry, index=index, crs="EPSG:4326"))
+
+    # Проецированная геометрия - копия той же структуры с координатами EPSG:3857
+    projected_coords = np.asarray(_load(folder, layer["projected"]))
+    projected = shapely.transform(geometry, lambda coords: projected_coords)
+    arrays = {name: _load(folder, file) for name, file in layer["arrays"].items()}
+    return frame, projected, arrays
+
+def read_store(folder_path, source):
+    """
+    Читает хранилище версии: ({слой: (GeoDataFrame, проецированная геометрия, {имя: массив})}, метаданные).
+    None - хранилища нет, оно другого формата, собрано из других исходных файлов (source)
+    или удалено во время чтения новой записью - тогда версия загружается из shapefile.
+    """
+    store = _current_store(Path(folder_path))
+    if store is None:
+        return None
+    try:
+        with open(store / "manifest.json", encoding="utf-8") as input:
+            manifest = json.load(input)
+        if manifest.get("format") != STORE_FORMAT or manifest.get("source") != source:
+            return None
+        return {name: _read_layer(store, layer) for name, layer in manifest["layers"].items()}, manifest["meta"]
+    except (OSError, ValueError):
+        return None
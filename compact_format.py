@@ -0,0 +1,95 @@
+# compact_format.py
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используется стандартный json
+    orjson = None
+
+# Сколько маршрутов отправлять в одной строке потока
+ROUTES_CHUNK_SIZE = 2000
+
+
+def dumps(obj):
+    """Сериализует объект с numpy-массивами в JSON (bytes)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=_to_builtin, separators=(",", ":")).encode()
+
+def _to_builtin(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _xy(points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return {"x": np.ascontiguousarray(points[:, 0]), "y": np.ascontiguousarray(points[:, 1])}
+
+
+def compact_result(summary, house_points, bus_points, edge_starts, edge_ends, edge_loads, routes, catchments=None):
+    """
+    Компактный результат расчёта маршрутов: плоские массивы координат вместо вложенных словарей.
+    Параметры:
+    - house_points, bus_points: массивы (N x 2) координат домов и остановок
+    - edge_starts, edge_ends, edge_loads: начала и концы рёбер графа и нагрузка на них
+    - routes: словарь {координаты дома: список точек маршрута или None}
+    - catchments: зоны обслуживания остановок (см. street_graph.stop_catchments)
+    """
+    route_houses = np.array(list(routes.keys()), dtype=float).reshape(-1, 2)
+    lengths = np.array([len(route) if route else 0 for route in routes.values()], dtype=np.int64)
+    points = [point for route in routes.values() if route for point in route]
+    return {
+        "format": "compact",
+        "summary": summary,
+        "houses": np.asarray(house_points, dtype=float).reshape(-1, 2),
+        "bus_stops": np.asarray(bus_points, dtype=float).reshape(-1, 2),
+        "edges": {
+            "start": np.asarray(edge_starts, dtype=float).reshape(-1, 2),
+            "end": np.asarray(edge_ends, dtype=float).reshape(-1, 2),
+            "load": np.asarray(edge_loads, dtype=float),
+        },
+        "routes": {
+            "house": route_houses,
+            # Маршрут i - точки offsets[i]:offsets[i + 1]; пустой отрезок - пути нет
+            "offsets": np.concatenate(([0], np.cumsum(lengths))),
+            "points": np.array(points, dtype=float).reshape(-1, 2),
+        },
+        "catchments": catchments,
+    }
+
+
+def iter_ndjson(result, chunk_size=ROUTES_CHUNK_SIZE):
+    """
+    Отдаёт компактный результат построчно (NDJSON): сводка, остановки, дома, зоны остановок, рёбра с нагрузкой,
+    затем маршруты пачками по chunk_size - клиент может рисовать карту по мере получения строк.
+    """
+    yield dumps({"type": "summary", "format": result["format"], "summary": result["summary"]}) + b"\n"
+    yield dumps({"type": "bus_stops", **_xy(result["bus_stops"])}) + b"\n"
+    yield dumps({"type": "houses", **_xy(result["houses"])}) + b"\n"
+    if result.get("catchments") is not None:
+        yield dumps({"type": "catchments", "catchments": result["catchments"]}) + b"\n"
+
+    edges = result["edges"]
+    starts, ends = edges["start"].reshape(-1, 2), edges["end"].reshape(-1, 2)
+    yield dumps({
+        "type": "edges",
+        "x1": np.ascontiguousarray(starts[:, 0]), "y1": np.ascontiguousarray(starts[:, 1]),
+        "x2": np.ascontiguousarray(ends[:, 0]), "y2": np.ascontiguousarray(ends[:, 1]),
+        "load": edges["load"],
+        "load_max": float(edges["load"].max()) if len(edges["load"]) else 0.0,
+    }) + b"\n"
+
+    routes = result["routes"]
+    offsets = routes["offsets"]
+    for start in range(0, len(routes["house"]), chunk_size):
+        stop = min(start + chunk_size, len(routes["house"]))
+        chunk_offsets = offsets[start:stop + 1]
+        houses = routes["house"][start:stop]
+        yield dumps({
+            "type": "routes",
+            "house_x": np.ascontiguousarray(houses[:, 0]), "house_y": np.ascontiguousarray(houses[:, 1]),
+            "offsets": chunk_offsets - chunk_offsets[0],
+            **_xy(routes["points"][chunk_offsets[0]:chunk_offsets[-1]]),
+        }) + b"\n"
@@ -0,0 +1,354 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import metrics
+from columnar_store import read_store, write_store
+from graph_engine import line_segments, nearest_segments
+from topology import clean_streets
+from street_graph import POPULATION_SEED, generate_population, place_points
+
+# Бюджет памяти кеша в байтах, по умолчанию 1 ГБ на процесс
+DEFAULT_MAX_BYTES = int(os.environ.get("DATASET_CACHE_BYTES", 1024 ** 3))
+
+
+# --- Load and preprocess data ---
+def find_shapefile(directory, keyword=None):
+    """Ищет первый файл .shp в директории с опциональной фильтрацией по ключевому слову"""
+    for file in Path(directory).glob("*.shp"):
+        if keyword is None or keyword.lower() in file.stem.lower():
+            return str(file)
+    return None
+
+def read_shapefiles(folder_path):
+    """Читает из shapefile дома, остановки и пешеходные улицы версии в EPSG:4326"""
+    folder_path = Path(folder_path)
+
+    # Ищем shapefiles в папке
+    files = {
+        "Street": find_shapefile(folder_path / "streets")
+    }
+
+    house_path = find_shapefile(folder_path / "buildings")
+    stations = find_shapefile(folder_path / "stations")
+
+    print(f"House path: {house_path}")
+    print(f"Stations path: {stations}")
+
+    houses = gpd.read_file(house_path).to_crs(epsg=4326)
+    houses["Apartments"] = houses["Apartments"].fillna(0)
+    buses = gpd.read_file(stations).to_crs(epsg=4326)
+    streets = gpd.GeoDataFrame(pd.concat([gpd.read_file(path).to_crs(epsg=4326).query("Foot == 1")
+                                    for path in files.values()], ignore_index=True)).loc[lambda df: df.geometry.type.isin(['LineString', 'MultiLineString'])]
+
+    return houses, buses, streets
+
+def read_metro(folder_path):
+    """Выходы метро версии в EPSG:4326 или None, если слоя нет (он необязателен)"""
+    metro_path = find_shapefile(Path(folder_path) / "metro")
+    if metro_path is None:
+        return None
+    return gpd.read_file(metro_path).to_crs(epsg=4326)
+
+def dataset_from_shapefiles(folder_path):
+    """Набор данных из shapefile версии; топология улиц очищается (см. topology.clean_streets)"""
+    houses, buses, streets = read_shapefiles(folder_path)
+    streets, topology = clean_streets(streets)
+    print(f"Street topology: {topology}")
+    return Dataset(houses, buses, streets, topology=topology, metro=read_metro(folder_path))
+
+def load_dataset(folder_path):
+    """
+    Загружает набор данных версии. Если есть актуальное колоночное хранилище (columnar_store) - из него,
+    без чтения shapefile, проекции и очистки улиц; иначе читает shapefile и сохраняет хранилище
+    для следующих загрузок.
+    """
+    source = dataset_fingerprint(folder_path)
+    stored = read_store(folder_path, source)
+    # Хранилище без необязательного слоя, папка которого есть в версии (собрано до загрузки метро), пересобирается
+    if stored is not None and all(name in stored[0] or find_shapefile(Path(folder_path) / name) is None
+                                  for name in Dataset.OPTIONAL_LAYERS):
+        layers, meta = stored
+        return Dataset.from_layers(layers, topology=meta.get("topology"))
+
+    dataset = dataset_from_shapefiles(folder_path)
+    try:
+        write_store(folder_path, source, dataset.to_layers(), {"topology": dataset.topology})
+    except OSError as e:
+        print(f"Columnar store for {folder_path} not saved: {e}")
+    return dataset
+
+def ingest_version(folder_path, progress=None):
+    """
+    Задача очереди: готовит колоночное хранилище версии после загрузки файлов и возвращает отчёт
+    об очистке улиц. Пока загружены не все слои (дома, остановки, улицы), ничего не делает и возвращает None.
+    """
+    folder_path = Path(folder_path)
+    if any(find_shapefile(folder_path / name) is None for name in ("buildings", "stations", "streets")):
+        return None
+    if progress is not None:
+        progress("ingest")
+    dataset = dataset_from_shapefiles(folder_path)
+    write_store(folder_path, dataset_fingerprint(folder_path), dataset.to_layers(), {"topology": dataset.topology})
+    return dataset.topology
+
+class Dataset:
+    """
+    Набор данных версии: слои в EPSG:4326, их геометрия в EPSG:3857 (проецируется один раз при загрузке)
+    и STRtree по проецированной геометрии для выборки окна вокруг точки.
+    centroids - центроиды домов в EPSG:4326 (точки привязки домов к графу) в порядке строк houses.
+    topology - отчёт об очистке топологии улиц (None, если не проводилась).
+    Необязательные слои (OPTIONAL_LAYERS, например выходы метро) есть в layers, только если загружены.
+    """
+
+    LAYERS = ("houses", "buses", "streets")
+    OPTIONAL_LAYERS = ("metro",)
+
+    def __init__(self, houses, buses, streets, projected=None, centroids=None, topology=None, metro=None):
+        self.layers = {"houses": houses, "buses": buses, "streets": streets}
+        if metro is not None:
+            self.layers["metro"] = metro
+        self.topology = topology
+        if projected is None:
+            projected = {name: np.asarray(frame.geometry.to_crs(epsg=3857).values, dtype=object)
+                         for name, frame in self.layers.items()}
+        self.projected = projected
+        self.centroids = place_points(houses) if centroids is None else centroids
+        self.index = {name: shapely.STRtree(geometry) for name, geometry in self.projected.items()}
+        self._population = {}
+        self._snapping = {}
+
+    @classmethod
+    def from_layers(cls, layers, topology=None):
+        """Набор данных из слоёв колоночного хранилища (см. to_layers)"""
+        names = cls.LAYERS + tuple(name for name in cls.OPTIONAL_LAYERS if name in layers)
+        frames = {name: layers[name][0] for name in names}
+        projected = {name: layers[name][1] for name in names}
+        return cls(**frames, projected=projected, centroids=layers["houses"][2]["centroids"], topology=topology)
+
+    def to_layers(self):
+        """Слои для columnar_store.write_store: (GeoDataFrame, координаты EPSG:3857, массивы)"""
+        return {
+            name: (frame, shapely.get_coordinates(self.projected[name]),
+                   {"centroids": self.centroids} if name == "houses" else {})
+            for name, frame in self.layers.items()
+        }
+
+    @property
+    def houses(self):
+        return self.layers["houses"]
+
+    @property
+    def buses(self):
+        return self.layers["buses"]
+
+    @property
+    def streets(self):
+        return self.layers["streets"]
+
+    def population(self, seed=POPULATION_SEED):
+        """
+        Население всех домов версии (Series по индексу houses), считается один раз на зерно.
+        Дом получает одно и то же население в любом окне, поэтому результаты воспроизводимы.
+        """
+        if seed not in self._population:
+            self._population[seed] = pd.Series(generate_population(self.houses, seed), index=self.houses.index)
+        return self._population[seed]
+
+    def house_points(self, houses):
+        """Центроиды домов из houses (строки этой версии, например окно clip)"""
+        return np.asarray(self.centroids)[self.houses.index.get_indexer(houses.index)]
+
+    def _points(self, layer):
+        return np.asarray(self.centroids) if layer == "houses" else place_points(self.layers[layer])
+
+    def snapping(self, layer):
+        """
+        Ближайший отрезок улицы для каждого места слоя houses или buses среди всех улиц версии
+        (считается один раз): (номер строки улицы, начало отрезка, конец отрезка, доля проекции).
+        """
+        if layer not in self._snapping:
+            starts, ends, street_rows = line_segments(self.streets.geometry.values, return_index=True)
+            points = self._points(layer)
+            if not len(starts):
+                # Улиц нет - места привяжутся к улицам окна в snap_places (если они там появятся)
+                empty = np.zeros((len(points), 2))
+                self._snapping[layer] = (np.full(len(points), -1), empty, empty, np.zeros(len(points)))
+            else:
+                segments, fractions = nearest_segments(points, starts, ends)
+                self._snapping[layer] = (street_rows[segments], starts[segments], ends[segments], fractions)
+        return self._snapping[layer]
+
+    def snap_places(self, layer, places, streets):
+        """
+        Привязка мест окна places (строки слоя houses или buses) к отрезкам улиц окна streets:
+        (начала отрезков, концы, доли) для add_places_to_graph или None, если в окне нет улиц.
+        Берётся из snapping; место, чья улица не попала в окно, привязывается заново к улицам окна -
+        результат тот же, что при поиске только по улицам окна.
+        """
+        starts, ends, window_rows = line_segments(streets.geometry.values, return_index=True)
+        if not len(starts):
+            return None
+        rows = self.layers[layer].index.get_indexer(places.index)
+        street_rows, snap_starts, snap_ends, fractions = (array[rows] for array in self.snapping(layer))
+        snap_starts, snap_ends, fractions = snap_starts.copy(), snap_ends.copy(), fractions.copy()
+
+        outside = ~np.isin(street_rows, self.streets.index.get_indexer(streets.index)[window_rows])
+        if outside.any():
+            segments, fractions[outside] = nearest_segments(self._points(layer)[rows[outside]], starts, ends)
+            snap_starts[outside], snap_ends[outside] = starts[segments], ends[segments]
+        return snap_starts, snap_ends, fractions
+
+    def clip(self, lat, long, radius=1000):
+        """
+        Возвращает (houses, buses, streets) в EPSG:4326 - объекты не дальше radius метров (EPSG:3857) от точки.
+        Кандидаты берутся из STRtree по квадрату окна, точное расстояние считается только для них.
+        """
+        center = gpd.GeoSeries([shapely.Point(long, lat)], crs="EPSG:4326").to_crs(epsg=3857).iloc[0]
+        window = shapely.box(center.x - radius, center.y - radius, center.x + radius, center.y + radius)
+        clipped = []
+        for name in self.LAYERS:
+            candidates = self.index[name].query(window)
+            inside = candidates[shapely.distance(self.projected[name][candidates], center) <= radius]
+            clipped.append(self.layers[name].iloc[np.sort(inside)])
+        return tuple(clipped)
+
+    def nearby(self, layer, points, radius):
+        """
+        Строки слоя layer не дальше radius метров (EPSG:3857) хотя бы от одной из точек
+        (массив N x 2 долгота/широта) - один запрос к STRtree по всем точкам.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        projected = gpd.GeoSeries(shapely.points(points), crs="EPSG:4326").to_crs(epsg=3857).values
+        _, rows = self.index[layer].query(np.asarray(projected, dtype=object), predicate="dwithin", distance=radius)
+        return self.layers[layer].iloc[np.unique(rows)]
+
+
+def dataset_fingerprint(folder_path):
+    """
+    Отпечаток содержимого версии: хеш имён, размеров и времени изменения всех файлов.
+    Служебные папки (начинаются с точки, например колоночное хранилище) не учитываются.
+    """
+    folder_path = Path(folder_path)
+    digest = hashlib.sha1()
+    for path in dataset_files(folder_path):
+        stat = path.stat()
+        digest.update(f"{path.relative_to(folder_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def dataset_files(folder_path):
+    """Файлы версии по порядку, без служебных папок (начинаются с точки) - в них обход не заходит"""
+    paths = []
+    for root, folders, files in os.walk(folder_path, followlinks=True):
+        folders[:] = [name for name in folders if not name.startswith(".")]
+        paths.extend(Path(root) / name for name in files if not name.startswith("."))
+    yield from sorted(paths)
+
+def estimate_nbytes(value):
+    """Приблизительный объём памяти набора данных (Dataset, словарь GeoDataFrame/DataFrame/массивов)"""
+    if isinstance(value, Dataset):
+        projected = sum(estimate_nbytes(geometry) for geometry in value.projected.values())
+        return estimate_nbytes(value.layers) + projected * 2  # проекция и STRtree
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    if isinstance(value, gpd.GeoDataFrame):
+        geometry = np.asarray(value.geometry.values, dtype=object)
+        # Для геометрий pandas видит только обёртки, поэтому считаем координаты отдельно
+        coords_bytes = int(shapely.get_num_coordinates(geometry).sum()) * 16 + len(geometry) * 100
+        return int(value.drop(columns=value.geometry.name).memory_usage(deep=True).sum()) + coords_bytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return int(shapely.get_num_coordinates(value).sum()) * 16 + len(value) * 100
+        return value.nbytes
+    return 0
+
+
+class DatasetCache:
+    """
+    LRU-кеш загруженных наборов данных с ограничением по объёму памяти.
+    Ключ - (сессия, версия, отпечаток содержимого): изменённые файлы версии дают новый ключ,
+    поэтому устаревшие данные не отдаются даже в процессах, до которых не дошла инвалидация.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # ключ -> (данные, объём)
+        self._lock = threading.Lock()
+
+    def get(self, session_id, version, folder_path, loader=load_dataset):
+        """Возвращает данные версии из кеша или загружает их через loader(folder_path)"""
+        key = (session_id, version, dataset_fingerprint(folder_path))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.emit(("cache", "hit"))
+                return self._entries[key][0]
+            self.misses += 1
+        metrics.emit(("cache", "miss"))
+
+        value = loader(folder_path)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = estimate_nbytes(value)
+        session_id, version, _ = key
+        with self._lock:
+            # Данные той же версии с другим отпечатком больше не понадобятся
+            for stale in [k for k in self._entries if k[:2] == (session_id, version) and k != key]:
+                self._remove(stale)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            # Самую свежую запись не вытесняем, даже если она одна больше бюджета
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+                metrics.emit(("cache", "eviction"))
+
+    def invalidate(self, session_id, version=None):
+        """Удаляет данные сессии (или одной её версии)"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == session_id and version in (None, k[1])]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+    def _remove(self, key):
+        _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+
+# Общий кеш процесса для data_process_new и find_bad_places2
+datasets = DatasetCache()
@@ -0,0 +1,733 @@
+# graph_engine.py
+import copy
+import heapq
+from collections import Counter
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+EARTH_RADIUS = 6371008.8  # средний радиус Земли, м
+
+NODE_STREET = 0
+NODE_HOUSE = 1
+NODE_BUS_STOP = 2
+
+NODE_TYPES = {"street": NODE_STREET, "house": NODE_HOUSE, "bus_stop": NODE_BUS_STOP}
+
+# --- Metric distance between lon/lat points ---
+def haversine(lon1, lat1, lon2, lat2):
+    """Расстояние по поверхности Земли в метрах между точками (долгота, широта), векторизовано."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# --- Index ranges ---
+def concat_ranges(starts, ends):
+    """Номера starts[i]:ends[i] для всех i подряд (векторизованный concatenate из arange)"""
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+
+class StreetGraph:
+    """
+    Компактный ориентированный граф улиц.
+    Вершины - целые числа 0..N-1, координаты хранятся в одном массиве coords (N x 2),
+    рёбра - в CSR-виде (indptr, indices, weights), совместимом с scipy.sparse.
+    Номер ребра - его позиция в CSR, поэтому массивы нагрузок выравниваются с indices/weights.
+    """
+
+    def __init__(self, coords, src, dst, weights):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        n = len(self.coords)
+        self.node_type = np.full(n, NODE_STREET, dtype=np.int8)
+        self.total_people = np.zeros(n)
+        self.place_nodes = {}
+        self.snap_nodes = {}  # уличная вершина, к которой привязано каждое место (в порядке place_nodes)
+        self.split_points = {}  # вершины деления отрезков (insert_points): (a, b) -> {доля от a: вершина}
+        self._node_index = None
+        self._set_edges(src, dst, weights)
+
+    # --- Construction ---
+    def _set_edges(self, src, dst, weights):
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        weights = np.asarray(weights, dtype=float)
+        n = len(self.coords)
+
+        # Петли не нужны, а из повторяющихся рёбер оставляем самое короткое
+        keep = src != dst
+        src, dst, weights = src[keep], dst[keep], weights[keep]
+        order = np.lexsort((weights, dst, src))
+        src, dst, weights = src[order], dst[order], weights[order]
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+        src, dst, weights = src[first], dst[first], weights[first]
+
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n)))).astype(np.int64)
+        self.indices = dst
+        self.weights = weights
+        self._edge_codes = src * n + dst  # отсортированы по (src, dst)
+        self._csr = None
+        self._csr_reverse = None
+
+    @classmethod
+    def from_networkx(cls, G):
+        """Строит StreetGraph из nx.DiGraph с вершинами-кортежами координат и весом 'weight'."""
+        nodes = list(G.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        src, dst, weights = [], [], []
+        for u, v, data in G.edges(data=True):
+            src.append(index[u])
+            dst.append(index[v])
+            weights.append(data.get("weight", 1.0))
+        graph = cls(np.array(nodes, dtype=float).reshape(-1, 2), src, dst, weights)
+        for node, data in G.nodes(data=True):
+            if "type" in data:
+                graph.node_type[index[node]] = NODE_TYPES.get(data["type"], NODE_STREET)
+            graph.total_people[index[node]] = data.get("total_people", 0)
+        return graph
+
+    # --- Sizes and accessors ---
+    @property
+    def number_of_nodes(self):
+        return len(self.coords)
+
+    @property
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def __len__(self):
+        return self.number_of_nodes
+
+    @property
+    def sources(self):
+        """Начальная вершина каждого ребра (в порядке CSR)."""
+        return np.repeat(np.arange(self.number_of_nodes), np.diff(self.indptr))
+
+    @property
+    def csr(self):
+        """Матрица весов scipy.sparse.csr_matrix (N x N); кешируется до изменения графа."""
+        if self._csr is None:
+            n = self.number_of_nodes
+            self._csr = csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+        return self._csr
+
+    @property
+    def csr_reverse(self):
+        """Транспонированная матрица весов - для поиска путей к заданной вершине."""
+        if self._csr_reverse is None:
+            n = self.number_of_nodes
+            # Транспонируем номера рёбер (с 1, чтобы ноль не потерялся): при смене весов
+            # структура обратной матрицы остаётся, переставляются только данные
+            order = csr_matrix((np.arange(1, self.number_of_edges + 1), self.indices, self.indptr), shape=(n, n)).T.tocsr()
+            self._reverse_order = order.data - 1
+            self._csr_reverse = csr_matrix((self.weights[self._reverse_order], order.indices, order.indptr), shape=(n, n))
+        return self._csr_reverse
+
+    def node_key(self, node):
+        """Ключ вершины в формате networkx-версии: кортеж координат."""
+        x, y = self.coords[node]
+        return (float(x), float(y))
+
+    def path_keys(self, nodes):
+        return [tuple(point) for point in self.coords[nodes].tolist()]
+
+    def edge_keys(self):
+        """Ключи рёбер ((x1, y1), (x2, y2)) в порядке CSR."""
+        starts = self.coords[self.sources].tolist()
+        ends = self.coords[self.indices].tolist()
+        return [(tuple(a), tuple(b)) for a, b in zip(starts, ends)]
+
+    @property
+    def node_index(self):
+        """Словарь кортеж координат -> номер вершины (строится по запросу)."""
+        if self._node_index is None:
+            self._node_index = {tuple(point): i for i, point in enumerate(self.coords.tolist())}
+        return self._node_index
+
+    def edge_ids(self, src, dst):
+        """Номера рёбер (src[i], dst[i]); -1, если ребра нет."""
+        codes = np.asarray(src, dtype=np.int64) * self.number_of_nodes + np.asarray(dst, dtype=np.int64)
+        if not len(self._edge_codes):
+            return np.full(len(codes), -1)
+        pos = np.searchsorted(self._edge_codes, codes).clip(max=len(self._edge_codes) - 1)
+        return np.where(self._edge_codes[pos] == codes, pos, -1)
+
+    def path_edge_ids(self, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return self.edge_ids(nodes[:-1], nodes[1:])
+
+    def edge_array(self, edge_loads):
+        """Переводит словарь {(u, v): значение} с ключами-координатами в массив по рёбрам."""
+        values = np.zeros(self.number_of_edges)
+        index = self.node_index
+        pairs = [(index[u], index[v], value) for (u, v), value in edge_loads.items()]
+        if pairs:
+            src, dst, vals = map(np.array, zip(*pairs))
+            ids = self.edge_ids(src, dst)
+            np.add.at(values, ids[ids >= 0], vals[ids >= 0])
+        return values
+
+    def edge_dict(self, values):
+        """Обратное к edge_array: словарь {(u, v): значение} для всех рёбер."""
+        return dict(zip(self.edge_keys(), np.asarray(values).tolist()))
+
+    # --- Mutation ---
+    def add_nodes(self, coords, node_type=NODE_STREET, total_people=0):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        start = self.number_of_nodes
+        src = self.sources
+        self.coords = np.vstack((self.coords, coords))
+        self.node_type = np.concatenate((self.node_type, np.full(len(coords), node_type, dtype=np.int8)))
+        self.total_people = np.concatenate((self.total_people, np.broadcast_to(total_people, len(coords)).astype(float)))
+        self._node_index = None
+        # Номера существующих рёбер меняются вместе с числом вершин, перестраиваем CSR
+        self._set_edges(src, self.indices, self.weights)
+        return np.arange(start, self.number_of_nodes)
+
+    def add_edges(self, src, dst, weights, both_directions=True):
+        """Добавляет рёбра; при совпадении концов остаётся более короткое."""
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), src.shape)
+        if both_directions:
+            src, dst, weights = np.concatenate((src, dst)), np.concatenate((dst, src)), np.concatenate((weights, weights))
+        self._set_edges(np.concatenate((self.sources, src)),
+                        np.concatenate((self.indices, dst)),
+                        np.concatenate((self.weights, weights)))
+
+    def remove_edges(self, src, dst):
+        """Удаляет рёбра (src[i], dst[i]); отсутствующие пропускаются."""
+        ids = self.edge_ids(src, dst)
+        keep = np.ones(self.number_of_edges, dtype=bool)
+        keep[ids[ids >= 0]] = False
+        self._set_edges(self.sources[keep], self.indices[keep], self.weights[keep])
+
+    def insert_points(self, starts, ends, fractions):
+        """
+        Делит рёбра улиц точками привязки: отрезок starts[i] -> ends[i] (концы - вершины графа)
+        получает уличную вершину в доле fractions[i] от начала, ребро в обе стороны заменяется цепочкой.
+        Совпадающие точки одного отрезка дают одну вершину, доля 0 или 1 - сам конец отрезка.
+        Отрезок, поделённый раньше (например, домами до остановок), остаётся одной цепочкой:
+        новые точки встают между прежними, а совпавшая с прежней точка получает её вершину.
+        Возвращает вершину привязки каждой точки.
+        """
+        # Концы отрезков - вершины улиц: точка места может совпасть с перекрёстком
+        streets = np.flatnonzero(self.node_type == NODE_STREET)
+        index = dict(zip(map(tuple, self.coords[streets].tolist()), streets.tolist()))
+        u = np.array([index[tuple(point)] for point in np.asarray(starts, dtype=float).reshape(-1, 2).tolist()], dtype=np.int64)
+        v = np.array([index[tuple(point)] for point in np.asarray(ends, dtype=float).reshape(-1, 2).tolist()], dtype=np.int64)
+        t = np.clip(np.asarray(fractions, dtype=float), 0, 1)
+        # Отрезок ориентируем от меньшего номера к большему, чтобы точки на u-v и v-u попали в одну цепочку
+        swap = u > v
+        a, b, t = np.where(swap, v, u), np.where(swap, u, v), np.where(swap, 1 - t, t)
+        snapped = np.where(t >= 1, b, a)
+        inner = (t > 0) & (t < 1) & (a != b)
+        if not inner.any():
+            return snapped
+
+        # Прежние точки деления тех же отрезков идут в общую цепочку вместе с новыми
+        old = [(sa, sb, st, node) for sa, sb in set(zip(a[inner].tolist(), b[inner].tolist()))
+               for st, node in self.split_points.get((sa, sb), {}).items()]
+        old_a, old_b, old_t, old_nodes = (np.array(column) for column in zip(*old)) if old else \
+            (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64))
+        splits, inverse = np.unique(np.column_stack((np.concatenate((old_a, a[inner])), np.concatenate((old_b, b[inner])),
+                                                     np.concatenate((old_t, t[inner])))), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        split_a, split_b, split_t = splits[:, 0].astype(np.int64), splits[:, 1].astype(np.int64), splits[:, 2]
+        nodes = np.full(len(splits), -1, dtype=np.int64)
+        nodes[inverse[:len(old)]] = old_nodes
+        new = nodes < 0
+        points = self.coords[split_a[new]] + split_t[new, None] * (self.coords[split_b[new]] - self.coords[split_a[new]])
+        # Прежняя цепочка отрезка (или само ребро a-b) заменяется новой
+        removed_src, removed_dst = self._chain_edges(old_a, old_b, old_t, old_nodes)
+        removed_src, removed_dst = (np.concatenate((removed_src, removed_dst, split_a, split_b)),
+                                    np.concatenate((removed_dst, removed_src, split_b, split_a)))
+        src, dst, weights = self.sources, self.indices, self.weights
+        nodes[new] = self.add_nodes(points)
+        snapped[inner] = nodes[inverse[len(old):]]
+        # Реестр заменяется целиком: копии графа (with_weights, copy.copy) делят его с исходным
+        split_points = dict(self.split_points)
+        for sa, sb, st, node in zip(split_a.tolist(), split_b.tolist(), split_t.tolist(), nodes.tolist()):
+            split_points[(sa, sb)] = {**split_points.get((sa, sb), {}), st: node}
+        self.split_points = split_points
+
+        chain_src, chain_dst = self._chain_edges(split_a, split_b, split_t, nodes)
+        lengths = haversine(*self.coords[chain_src].T, *self.coords[chain_dst].T)
+        codes = src * self.number_of_nodes + dst
+        keep = ~np.isin(codes, removed_src * self.number_of_nodes + removed_dst)
+        self._set_edges(np.concatenate((src[keep], chain_src, chain_dst)),
+                        np.concatenate((dst[keep], chain_dst, chain_src)),
+                        np.concatenate((weights[keep], lengths, lengths)))
+        return snapped
+
+    def remove_points(self, nodes):
+        """
+        Обратное insert_points: убирает вершины деления nodes из цепочек их отрезков. Соседи по цепочке
+        соединяются напрямую (без точек деления - снова ребро отрезка), у убранной вершины рёбер цепочки не остаётся.
+        """
+        changed = {}
+        for node in np.atleast_1d(np.asarray(nodes, dtype=np.int64)).tolist():
+            for segment, points in self.split_points.items():
+                fraction = next((st for st, point in points.items() if point == node), None)
+                if fraction is not None:
+                    changed.setdefault(segment, dict(points)).pop(fraction)
+                    break
+        if not changed:
+            return
+        before = [(sa, sb, st, point) for (sa, sb) in changed for st, point in self.split_points[(sa, sb)].items()]
+        after = [(sa, sb, st, point) for (sa, sb), points in changed.items() for st, point in points.items()]
+        removed_src, removed_dst = self._chain_edges(*(np.array(column) for column in zip(*before)))
+        ends = np.array(list(changed), dtype=np.int64)
+        if after:
+            chain_src, chain_dst = self._chain_edges(*(np.array(column) for column in zip(*after)))
+        else:
+            chain_src, chain_dst = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # Отрезки без точек деления - снова одно ребро
+        bare = np.array([not points for points in changed.values()])
+        chain_src = np.concatenate((chain_src, ends[bare, 0]))
+        chain_dst = np.concatenate((chain_dst, ends[bare, 1]))
+        split_points = dict(self.split_points)
+        for segment, points in changed.items():
+            if points:
+                split_points[segment] = points
+            else:
+                del split_points[segment]
+        self.split_points = split_points
+
+        src, dst, weights = self.sources, self.indices, self.weights
+        codes = src * self.number_of_nodes + dst
+        keep = ~np.isin(codes, np.concatenate((removed_src * self.number_of_nodes + removed_dst,
+                                               removed_dst * self.number_of_nodes + removed_src)))
+        lengths = haversine(*self.coords[chain_src].T, *self.coords[chain_dst].T)
+        self._set_edges(np.concatenate((src[keep], chain_src, chain_dst)),
+                        np.concatenate((dst[keep], chain_dst, chain_src)),
+                        np.concatenate((weights[keep], lengths, lengths)))
+
+    @staticmethod
+    def _chain_edges(split_a, split_b, split_t, nodes):
+        """Рёбра цепочек a -> n1 -> ... -> nk -> b по возрастанию доли (в одну сторону)"""
+        split_a, split_b = np.asarray(split_a, dtype=np.int64), np.asarray(split_b, dtype=np.int64)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if not len(nodes):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        order = np.lexsort((split_t, split_b, split_a))
+        split_a, split_b, nodes = split_a[order], split_b[order], nodes[order]
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = (split_a[1:] != split_a[:-1]) | (split_b[1:] != split_b[:-1])
+        last = np.append(first[1:], True)
+        return (np.concatenate((np.where(first, split_a, np.roll(nodes, 1)), nodes[last])),
+                np.concatenate((nodes, split_b[last])))
+
+    def subgraph(self, nodes):
+        """
+        Подграф на вершинах nodes: рёбра, оба конца которых в nodes, с теми же весами.
+        Вершины подграфа идут по возрастанию номеров в исходном графе; возвращает (подграф, эти номера).
+        Просматриваются только исходящие рёбра nodes - время не зависит от размера всего графа.
+        """
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        degrees = self.indptr[nodes + 1] - self.indptr[nodes]
+        edges = concat_ranges(self.indptr[nodes], self.indptr[nodes + 1])
+        src = np.repeat(np.arange(len(nodes)), degrees)
+        dst = np.minimum(np.searchsorted(nodes, self.indices[edges]), max(len(nodes) - 1, 0))
+        keep = nodes[dst] == self.indices[edges] if len(nodes) else np.zeros(0, dtype=bool)
+        graph = StreetGraph(self.coords[nodes], src[keep], dst[keep], self.weights[edges[keep]])
+        graph.node_type = self.node_type[nodes]
+        graph.total_people = self.total_people[nodes]
+        return graph, nodes
+
+    def with_weights(self, weights):
+        """
+        Граф с той же структурой (массивы общие) и своими весами рёбер; исходный граф не меняется.
+        Уже построенные матрицы CSR переиспользуют структуру исходных.
+        """
+        graph = copy.copy(self)
+        graph.weights = np.asarray(weights, dtype=float)
+        n = self.number_of_nodes
+        if self._csr is not None:
+            graph._csr = csr_matrix((graph.weights, self.indices, self.indptr), shape=(n, n))
+        if self._csr_reverse is not None:
+            reverse = self._csr_reverse
+            graph._csr_reverse = csr_matrix((graph.weights[self._reverse_order], reverse.indices, reverse.indptr),
+                                            shape=(n, n))
+        return graph
+
+    def set_weights(self, weights):
+        """Заменяет веса рёбер, не трогая структуру CSR."""
+        self.weights = np.asarray(weights, dtype=float)
+        if self._csr is not None:
+            self._csr.data = self.weights
+        if self._csr_reverse is not None:
+            self._csr_reverse.data = self.weights[self._reverse_order]
+        return self
+
+    # --- Shortest paths ---
+    def shortest_path_tree(self, sources, reverse=False, limit=np.inf):
+        """
+        Дейкстра из каждой вершины sources.
+        reverse=True ищет пути К вершинам sources (по обращённым рёбрам).
+        Возвращает (dist, predecessors) формы (len(sources), N).
+        """
+        graph = self.csr_reverse if reverse else self.csr
+        return dijkstra(graph, directed=True, indices=np.atleast_1d(sources),
+                        return_predecessors=True, limit=limit)
+
+    def nearest_source_tree(self, sources, reverse=False, limit=np.inf):
+        """
+        Одна дейкстра сразу из всех вершин sources (сетевая диаграмма Вороного).
+        reverse=True ищет пути К sources. Возвращает массивы длины N: (расстояние до ближайшей
+        из sources, предок на пути к ней, сама ближайшая вершина; -1 - ни одна не достижима).
+        """
+        sources = np.atleast_1d(np.asarray(sources, dtype=np.int64))
+        n = self.number_of_nodes
+        if not len(sources):
+            return np.full(n, np.inf), np.full(n, -9999, dtype=np.int32), np.full(n, -1, dtype=np.int64)
+        graph = self.csr_reverse if reverse else self.csr
+        dist, predecessors, nearest = dijkstra(graph, directed=True, indices=sources, return_predecessors=True,
+                                               limit=limit, min_only=True)
+        return dist, predecessors, np.where(nearest < 0, -1, nearest).astype(np.int64)
+
+
+def reconstruct_path(predecessors, source, target):
+    """
+    Восстанавливает путь source -> target по массиву предков одной дейкстры из source.
+    Возвращает список вершин или None, если target недостижима.
+    """
+    if source == target:
+        return [source]
+    if predecessors[target] < 0:
+        return None
+    path = [target]
+    node = target
+    while node != source:
+        node = predecessors[node]
+        path.append(node)
+    path.reverse()
+    return path
+
+
+def reconstruct_path_to(predecessors, node, target):
+    """
+    Путь node -> target по массиву предков обратной дейкстры из target
+    (predecessors[v] - следующая вершина на пути от v к target).
+    """
+    if node == target:
+        return [node]
+    if predecessors[node] < 0:
+        return None
+    path = [node]
+    while node != target:
+        node = predecessors[node]
+        path.append(node)
+    return path
+
+
+def paths_to(predecessors, nodes, target):
+    """
+    Пути от каждой вершины nodes до target по обратному дереву (как reconstruct_path_to),
+    все пути проходятся одновременно - по шагу дерева за итерацию.
+    Возвращает матрицу путей (строка на вершину, хвост заполнен target) и длины путей (0 - недостижима).
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    reachable = (nodes == target) | (predecessors[nodes] >= 0)
+    steps = [np.where(reachable, nodes, target)]
+    while (steps[-1] != target).any():
+        current = steps[-1]
+        steps.append(np.where(current == target, target, predecessors[current]))
+    paths = np.stack(steps, axis=1)
+    lengths = np.where(reachable, (paths != target).sum(axis=1) + 1, 0)
+    return paths, lengths
+
+
+# --- Loads along shortest path trees ---
+def tree_depths(predecessors):
+    """
+    Число рёбер от каждой вершины до корня дерева кратчайших путей (0 для корня и недостижимых).
+    Считается удвоением указателей: log(глубины) векторных шагов вместо обхода вершин.
+    """
+    n = len(predecessors)
+    has_parent = predecessors >= 0
+    jump = np.where(has_parent, predecessors, np.arange(n))
+    depth = has_parent.astype(np.int64)
+    while True:
+        next_jump = jump[jump]
+        if np.array_equal(next_jump, jump):
+            return depth
+        depth = depth + depth[jump]
+        jump = next_jump
+
+def tree_edge_loads(G, dist, predecessors, node_weights):
+    """
+    Нагрузка рёбер от маршрутов всех вершин к корню обратного дерева (G.shortest_path_tree(..., reverse=True)).
+    Вершина v с весом w добавляет w на каждое ребро пути v -> корень, поэтому нагрузка ребра (v, predecessors[v])
+    равна сумме весов поддерева v - она накапливается по уровням от листьев к корню.
+    """
+    acc = np.where(np.isfinite(dist), node_weights, 0.0)
+    loads = np.zeros(G.number_of_edges)
+    depth = tree_depths(predecessors)
+    order = np.argsort(-depth, kind="stable")
+    bounds = np.flatnonzero(np.diff(depth[order])) + 1
+    for level in np.split(order, bounds):
+        if depth[level[0]] == 0:
+            break
+        parents = predecessors[level]
+        loads[G.edge_ids(level, parents)] += acc[level]
+        np.add.at(acc, parents, acc[level])
+    return loads
+
+
+def last_value_per_node(n, nodes, values):
+    """
+    Значение последнего по порядку места в каждой вершине (как при перезаписи ключей словаря маршрутов).
+    Возвращает (массив значений по вершинам, маска вершин с местами).
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    result = np.zeros(n)
+    has_place = np.zeros(n, dtype=bool)
+    unique_nodes, last = np.unique(nodes[::-1], return_index=True)
+    result[unique_nodes] = np.asarray(values, dtype=float)[::-1][last]
+    has_place[unique_nodes] = True
+    return result, has_place
+
+
+# --- Contraction of degree-2 chains ---
+class ContractedGraph:
+    """
+    Граф для поиска путей, в котором цепочки уличных вершин с двумя соседями стянуты в одно ребро
+    с суммарным весом. Остаются перекрёстки и тупики, вершины мест и вершины keep (например, вершины
+    привязки домов и остановок). Если две цепочки соединяют одни и те же вершины, внутренняя вершина
+    остаётся, чтобы каждому ребру graph соответствовала ровно одна цепочка исходных рёбер.
+    - graph - StreetGraph на оставленных вершинах, nodes - их номера в исходном графе G,
+      index - номер в graph каждой вершины G (-1 - вершина стянута);
+    - edge_chain - ребро graph, в которое вошло каждое ребро G (-1 - кольцо без оставленных вершин:
+      через него не проходит ни один путь);
+    - chain_edges[chain_offsets[c]:chain_offsets[c + 1]] - рёбра G ребра c по порядку.
+    Номера вершин graph возрастают вместе с номерами в G, поэтому порядок обхода при равных
+    расстояниях тот же. Веса graph - суммы текущих весов G; после G.set_weights нужно вызвать set_weights.
+    """
+
+    def __init__(self, G, keep=()):
+        self.G = G
+        n = G.number_of_nodes
+        kept = (np.diff(G.indptr) != 2) | (np.bincount(G.indices, minlength=n) != 2) | (G.node_type != NODE_STREET)
+        kept[np.asarray(keep, dtype=np.int64)] = True
+        while True:
+            chains = self._chains(G, kept)
+            if chains is not None:
+                break
+        edge_root, depth, tails, heads = chains
+
+        self.nodes = np.flatnonzero(kept)
+        self.index = np.full(n, -1, dtype=np.int64)
+        self.index[self.nodes] = np.arange(len(self.nodes))
+        roots = np.flatnonzero(edge_root == np.arange(G.number_of_edges))
+        weights = np.bincount(edge_root[edge_root >= 0], weights=G.weights[edge_root >= 0], minlength=G.number_of_edges)
+        self.graph = StreetGraph(G.coords[self.nodes], self.index[tails[roots]], self.index[heads[roots]], weights[roots])
+        self.graph.node_type = G.node_type[self.nodes]
+        self.graph.total_people = G.total_people[self.nodes]
+
+        # Номер ребра graph для каждой цепочки и каждого ребра G
+        chain_of_root = np.full(G.number_of_edges, -1, dtype=np.int64)
+        chain_of_root[roots] = self.graph.edge_ids(self.index[tails[roots]], self.index[heads[roots]])
+        self.edge_chain = np.where(edge_root >= 0, chain_of_root[np.maximum(edge_root, 0)], -1)
+        valid = np.flatnonzero(self.edge_chain >= 0)
+        self.chain_edges = valid[np.lexsort((depth[valid], self.edge_chain[valid]))]
+        self.chain_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.edge_chain[valid],
+                                                                        minlength=self.graph.number_of_edges))))
+
+    @staticmethod
+    def _chains(G, kept):
+        """
+        Цепочки рёбер от оставленной вершины до следующей оставленной.
+        Для каждого ребра G - первое ребро его цепочки (-1 - кольцо) и номер в цепочке, для каждого
+        первого ребра - начало и конец цепочки. None, если пришлось оставить ещё вершины (kept изменён).
+        """
+        n, m = G.number_of_nodes, G.number_of_edges
+        src, dst = G.sources, G.indices
+        is_start = kept[src]
+
+        # Предыдущее ребро цепочки: у вершины a (две исходящие) ребро a -> b продолжает ребро c -> a,
+        # где c - второй сосед a
+        other = np.where(is_start, 0, G.indptr[src] + 1 - (np.arange(m) - G.indptr[src]))
+        previous = np.where(is_start, -1, G.edge_ids(dst[other], src))
+        broken = ~is_start & (previous < 0)
+        if broken.any():
+            # Несимметричные рёбра - такие вершины не стягиваем
+            kept[src[broken]] = True
+            return None
+
+        parent = np.where(is_start, np.arange(m), previous)
+        depth = (~is_start).astype(np.int64)
+        for _ in range(int(np.ceil(np.log2(m + 1))) + 1):
+            depth = depth + depth[parent]
+            parent = parent[parent]
+        # Рёбра колец без оставленных вершин до начала цепочки не доходят
+        edge_root = np.where(is_start[parent], parent, -1)
+
+        is_end = kept[dst] & (edge_root >= 0)
+        tails = np.full(m, -1, dtype=np.int64)
+        heads = np.full(m, -1, dtype=np.int64)
+        tails[edge_root[is_end]] = src[edge_root[is_end]]
+        heads[edge_root[is_end]] = dst[is_end]
+
+        # Петли и параллельные цепочки: оставляем вершину после начала цепочки
+        roots = np.flatnonzero(edge_root == np.arange(m))
+        codes = tails[roots] * n + heads[roots]
+        _, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        repeated = np.isin(codes, codes[first[counts > 1]]) & ~kept[dst[roots]]
+        loops = (tails[roots] == heads[roots]) & ~kept[dst[roots]]
+        if (repeated | loops).any():
+            kept[dst[roots[repeated | loops]]] = True
+            return None
+        return edge_root, depth, tails, heads
+
+    def set_weights(self, weights=None):
+        """Веса graph по весам рёбер G (по умолчанию текущим)"""
+        weights = self.G.weights if weights is None else np.asarray(weights, dtype=float)
+        valid = self.edge_chain >= 0
+        self.graph.set_weights(np.bincount(self.edge_chain[valid], weights=weights[valid],
+                                           minlength=self.graph.number_of_edges))
+        return self
+
+    def expand_edges(self, edges):
+        """Рёбра G по порядку для последовательности рёбер graph"""
+        edges = np.asarray(edges, dtype=np.int64)
+        if not len(edges):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.chain_edges[self.chain_offsets[edge]:self.chain_offsets[edge + 1]] for edge in edges])
+
+    def expand_path(self, path):
+        """Путь по вершинам graph -> список вершин G"""
+        if len(path) < 2:
+            return self.nodes[np.asarray(path, dtype=np.int64)].tolist()
+        edges = self.expand_edges(self.graph.path_edge_ids(path))
+        return [int(self.nodes[path[0]])] + self.G.indices[edges].tolist()
+
+    def expand_tree(self, predecessors):
+        """
+        Обратное дерево по вершинам graph (predecessors[v] - следующая вершина к корню) ->
+        то же дерево по вершинам G: следующая вершина G для каждой вершины G, -1 - вне дерева
+        """
+        tree_nodes = np.flatnonzero(predecessors >= 0)
+        edges = self.graph.edge_ids(tree_nodes, predecessors[tree_nodes])
+        chain = self.chain_edges[concat_ranges(self.chain_offsets[edges], self.chain_offsets[edges + 1])]
+        next_nodes = np.full(self.G.number_of_nodes, -1, dtype=np.int64)
+        next_nodes[self.G.sources[chain]] = self.G.indices[chain]
+        return next_nodes
+
+    def expand_loads(self, loads):
+        """Значения по рёбрам graph -> значения по рёбрам G (каждое ребро цепочки получает значение цепочки)"""
+        loads = np.asarray(loads, dtype=float)
+        return np.where(self.edge_chain >= 0, loads[np.maximum(self.edge_chain, 0)], 0.0)
+
+
+# --- k nearest targets ---
+class NearestTargets:
+    """
+    Дейкстра с ранней остановкой: поиск прекращается, как только найдены k ближайших целей.
+    Массивы CSR переводятся в списки один раз - обход списков в Python заметно быстрее,
+    чем поэлементный доступ к numpy-массивам.
+    """
+
+    def __init__(self, G, targets):
+        self.indptr = G.indptr.tolist()
+        self.indices = G.indices.tolist()
+        self.weights = G.weights.tolist()
+        # Повторяющиеся цели (несколько остановок в одной вершине) учитываются с кратностью
+        self.targets = Counter(np.asarray(targets).tolist())
+
+    def search(self, source, k):
+        """
+        Возвращает [(цель, расстояние, путь)] для не более чем k ближайших целей,
+        в порядке возрастания расстояния (при равенстве - меньший номер вершины раньше).
+        """
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+        dist = {source: 0.0}
+        predecessors = {source: -1}
+        settled = set()
+        found = []
+        heap = [(0.0, source)]
+        while heap and len(found) < k:
+            d, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            for _ in range(min(self.targets.get(node, 0), k - len(found))):
+                found.append((node, d))
+            for e in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[e]
+                candidate = d + weights[e]
+                if candidate < dist.get(neighbour, np.inf):
+                    dist[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    heapq.heappush(heap, (candidate, neighbour))
+
+        result = []
+        for target, d in found:
+            path = [target]
+            while path[-1] != source:
+                path.append(predecessors[path[-1]])
+            path.reverse()
+            result.append((target, d, path))
+        return result
+
+
+# --- Build graph from street geometries ---
+def line_segments(geometries, return_index=False):
+    """
+    Разбивает LineString/MultiLineString на отрезки.
+    Возвращает массивы координат начал и концов отрезков (M x 2),
+    с return_index=True - ещё и номер геометрии каждого отрезка.
+    """
+    parts, geometry_index = shapely.get_parts(np.asarray(geometries, dtype=object), return_index=True)
+    lines = shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING
+    parts, geometry_index = parts[lines], geometry_index[lines]
+    coords, part_index = shapely.get_coordinates(parts, return_index=True)
+    start = np.nonzero(part_index[1:] == part_index[:-1])[0]
+    if return_index:
+        return coords[start], coords[start + 1], geometry_index[part_index[start]]
+    return coords[start], coords[start + 1]
+
+
+# --- Snapping places onto street segments ---
+def _mercator(coords):
+    """Долгота/широта в координаты Меркатора (радианы): проекция конформна, ближайший отрезок выбирается как по метрам"""
+    coords = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+    return np.column_stack((coords[:, 0], np.log(np.tan(np.pi / 4 + coords[:, 1] / 2))))
+
+def nearest_segments(points, starts, ends):
+    """
+    Ближайший отрезок для каждой точки - один запрос к STRtree по всем точкам.
+    Возвращает (номер отрезка, доля t от начала отрезка до проекции точки на него, 0..1).
+    """
+    points, starts, ends = _mercator(points), _mercator(starts), _mercator(ends)
+    if not len(points) or not len(starts):
+        return np.full(len(points), -1, dtype=np.int64), np.zeros(len(points))
+    tree = shapely.STRtree(shapely.linestrings(np.stack((starts, ends), axis=1)))
+    point_index, segment = tree.query_nearest(shapely.points(points), all_matches=False)
+    segments = np.empty(len(points), dtype=np.int64)
+    segments[point_index] = segment
+
+    direction = ends[segments] - starts[segments]
+    length = np.einsum("ij,ij->i", direction, direction)
+    offset = np.einsum("ij,ij->i", points - starts[segments], direction)
+    fractions = np.clip(np.divide(offset, length, out=np.zeros(len(points)), where=length > 0), 0, 1)
+    return segments, fractions
+
+
+def create_street_graph(streets):
+    """
+    Векторизованная альтернатива create_graph: строит StreetGraph по слою улиц (EPSG:4326).
+    Мультилинии раскладываются на части, веса рёбер - длины отрезков в метрах.
+    Возвращает (граф, массив координат уличных вершин) - как create_graph.
+    """
+    starts, ends = line_segments(streets.geometry.values)
+    nodes, inverse = np.unique(np.vstack((starts, ends)), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    u, v = inverse[:len(starts)], inverse[len(starts):]
+    lengths = haversine(starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+    G = StreetGraph(nodes, np.concatenate((u, v)), np.concatenate((v, u)), np.concatenate((lengths, lengths)))
+    return G, G.coords.copy()
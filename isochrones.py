@@ -0,0 +1,211 @@
+# isochrones.py
+"""
+Изохроны пешеходной доступности: какие дома в пределах 5/10/15 минут от выбранных остановок
+или выходов метро.
+
+Одна дейкстра сразу от всех источников, ограниченная самым большим порогом, - и пояса, и время до
+каждого дома берутся из одного поиска. Граф строится только по улицам, до которых можно дойти
+за этот порог. Результаты кешируются по (версия, набор источников, пороги), чтобы ползунки
+на карте отвечали сразу.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+from dataset_cache import datasets, dataset_fingerprint
+from graph_engine import EARTH_RADIUS, NODE_TYPES, create_street_graph
+from street_graph import POPULATION_SEED, add_places_to_graph, place_points
+
+# Скорость пешехода, м/мин (75 м/мин = 4.5 км/ч)
+WALK_SPEED = float(os.environ.get("WALK_SPEED", 75))
+# Пороги по умолчанию, мин; больше ISOCHRONE_MAX_MINUTES не считаем
+ISOCHRONE_THRESHOLDS = (5, 10, 15)
+ISOCHRONE_MAX_MINUTES = float(os.environ.get("ISOCHRONE_MAX_MINUTES", 60))
+# Полоса вокруг достижимых улиц, из которой складывается полигон пояса, м
+ISOCHRONE_BUFFER = float(os.environ.get("ISOCHRONE_BUFFER", 40))
+# Сколько результатов держать в кеше процесса
+ISOCHRONE_CACHE_SIZE = int(os.environ.get("ISOCHRONE_CACHE_SIZE", 128))
+
+# Источник -> слой набора данных
+ISOCHRONE_SOURCES = {"stops": "buses", "metro": "metro"}
+
+
+def check_thresholds(thresholds):
+    """Пороги в минутах: по возрастанию, без повторов, больше нуля и не больше ISOCHRONE_MAX_MINUTES"""
+    thresholds = sorted({float(value) for value in (thresholds or ISOCHRONE_THRESHOLDS)})
+    if thresholds[0] <= 0 or thresholds[-1] > ISOCHRONE_MAX_MINUTES:
+        raise ValueError(f"Thresholds must be in (0, {ISOCHRONE_MAX_MINUTES:g}] minutes")
+    return tuple(thresholds)
+
+
+# --- Band polygons ---
+def _reachable_segments(G, dist, limit):
+    """
+    Достижимые за limit метров части уличных рёбер: от начала ребра до точки, где кончается запас.
+    Ребро, пройденное целиком в обе стороны, берётся один раз.
+    """
+    sources, targets = G.sources, G.indices
+    street = (G.node_type[sources] == NODE_TYPES["street"]) & (G.node_type[targets] == NODE_TYPES["street"])
+    weights = np.maximum(G.weights, 1e-9)
+    fraction = np.clip((limit - dist[sources]) / weights, 0, 1)
+    both_whole = (fraction >= 1) & (dist[targets] + weights <= limit)
+    keep = street & (dist[sources] < limit) & ~(both_whole & (sources > targets))
+    starts = G.coords[sources[keep]]
+    ends = starts + fraction[keep, None] * (G.coords[targets[keep]] - starts)
+    return starts, ends
+
+def _band_areas(G, dist, distances):
+    """
+    Полигоны доступности для каждого порога (в метрах): полоса ISOCHRONE_BUFFER вокруг достижимых улиц.
+    Считается в равнопромежуточной проекции вокруг средней широты, возвращается в долготе/широте.
+    """
+    cos_lat = np.cos(np.radians(G.coords[:, 1].mean()))
+    scale = np.radians(1) * EARTH_RADIUS * np.array([cos_lat, 1.0])
+    areas = []
+    for limit in distances:
+        starts, ends = _reachable_segments(G, dist, limit)
+        if not len(starts):
+            areas.append((shapely.Polygon(), 0.0))
+            continue
+        # Полосы по отрезкам и каскадное объединение в десятки раз быстрее буфера мультилинии
+        lines = shapely.linestrings(np.stack((starts, ends), axis=1) * scale)
+        area = shapely.union_all(shapely.buffer(lines, ISOCHRONE_BUFFER, quad_segs=4))
+        areas.append((shapely.transform(area, lambda coords: coords / scale), float(shapely.area(area))))
+    return areas
+
+
+# --- Isochrones ---
+def compute_isochrones(data, source="stops", ids=None, thresholds=ISOCHRONE_THRESHOLDS, lat=None, long=None,
+                       radius=1000, seed=POPULATION_SEED):
+    """
+    Изохроны от остановок (source="stops") или выходов метро (source="metro") набора данных data.
+    Источники - строки слоя с индексами ids; без ids - все источники в radius метров от (lat, long),
+    без точки - все источники версии.
+    Возвращает словарь: источники, пояса {"from", "to", "houses", "people", "area", "polygon" (GeoJSON)}
+    и дома, до которых можно дойти за наибольший порог, с временем в минутах и поясом.
+    """
+    thresholds = check_thresholds(thresholds)
+    layer = ISOCHRONE_SOURCES[source]
+    if layer not in data.layers:
+        raise ValueError(f"Version has no {source} layer")
+    places = data.layers[layer]
+    if ids is not None:
+        missing = sorted(set(ids) - set(places.index.tolist()))
+        if missing:
+            raise KeyError(f"{source} {', '.join(map(str, missing))} not found")
+        places = places.loc[list(ids)]
+    elif lat is not None and long is not None:
+        places = data.nearby(layer, [(long, lat)], radius)
+
+    result = {
+        "source": source,
+        "walk_speed": WALK_SPEED,
+        "thresholds": list(thresholds),
+        "sources": [{"id": place_id, "x": x, "y": y}
+                    for place_id, (x, y) in zip(places.index.tolist(), place_points(places).tolist())],
+        "bands": [],
+        "houses": [],
+    }
+    distances = np.array(thresholds) * WALK_SPEED
+
+    # Улицы и дома, до которых можно дойти (3857 растягивает метры в 1 / cos(широты) раз)
+    points = place_points(places)
+    reach = (distances[-1] + ISOCHRONE_BUFFER) / np.cos(np.radians(np.abs(points[:, 1]).max())) if len(points) else 0
+    streets = data.nearby("streets", points, reach)
+    if not len(places) or not len(streets):
+        result["bands"] = [{"from": low, "to": high, "houses": 0, "people": 0.0, "area": 0.0, "polygon": None}
+                           for low, high in zip((0,) + thresholds[:-1], thresholds)]
+        return result
+    houses = data.nearby("houses", points, reach)
+    houses = houses.assign(Total_People=data.population(seed).loc[houses.index])
+
+    G, node_coords = create_street_graph(streets)
+    tree = cKDTree(node_coords)
+    add_places_to_graph(houses, G, tree, node_coords, 'house', points=data.house_points(houses),
+                        snap=data.snap_places("houses", houses, streets))
+    add_places_to_graph(places, G, tree, node_coords, 'bus_stop', snap=data.snap_places(layer, places, streets))
+
+    # Одна дейкстра от всех источников, все пороги - из неё
+    dist, _, _ = G.nearest_source_tree(G.place_nodes['bus_stop'], limit=distances[-1])
+    house_nodes = G.place_nodes['house']
+    minutes = dist[house_nodes] / WALK_SPEED
+    band = np.searchsorted(distances, dist[house_nodes], side="left")
+    reached = band < len(thresholds)
+    people = houses["Total_People"].to_numpy(dtype=float)
+    band_houses = np.bincount(band[reached], minlength=len(thresholds))
+    band_people = np.bincount(band[reached], weights=people[reached], minlength=len(thresholds))
+
+    # Пояс - кольцо между соседними порогами
+    previous, previous_area = shapely.Polygon(), 0.0
+    for low, high, area, count, total in zip((0,) + thresholds[:-1], thresholds, _band_areas(G, dist, distances),
+                                             band_houses, band_people):
+        polygon, size = area
+        ring = shapely.difference(polygon, previous)
+        result["bands"].append({
+            "from": low, "to": high, "houses": int(count), "people": float(total),
+            "area": size - previous_area,
+            "polygon": None if shapely.is_empty(ring) else shapely.geometry.mapping(ring),
+        })
+        previous, previous_area = polygon, size
+
+    house_points = data.house_points(houses)
+    result["houses"] = [
+        {"id": house_id, "x": x, "y": y, "minutes": round(value, 2), "band": thresholds[band_index]}
+        for house_id, (x, y), value, band_index in zip(np.asarray(houses.index)[reached].tolist(),
+                                                      house_points[reached].tolist(), minutes[reached].tolist(),
+                                                      band[reached].tolist())
+    ]
+    return result
+
+
+class IsochroneCache:
+    """LRU-кеш готовых изохрон; ключ включает отпечаток файлов версии, поэтому изменённая версия считается заново"""
+
+    def __init__(self, max_items=ISOCHRONE_CACHE_SIZE):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+
+isochrone_cache = IsochroneCache()
+
+
+def get_isochrones(folder_path, id, version, source="stops", ids=None, thresholds=None, lat=None, long=None,
+                   radius=1000, seed=POPULATION_SEED, progress=None):
+    """
+    Изохроны версии из кеша или compute_isochrones. Задача очереди (jobs): кеш изохрон и наборов данных -
+    в процессе задачи. Нет слоя источников или порогов - ValueError, нет источников с ids - KeyError.
+    """
+    progress = progress or (lambda name: None)
+    folder_path = Path(folder_path)
+    thresholds = check_thresholds(thresholds)
+    if source not in ISOCHRONE_SOURCES:
+        raise ValueError(f"Unknown source {source}")
+    sources = ("ids", tuple(sorted(ids))) if ids is not None else ("window", lat, long, radius if lat is not None else None)
+    key = (id, version, dataset_fingerprint(folder_path), source, sources, thresholds, seed)
+    cached = isochrone_cache.get(key)
+    if cached is not None:
+        return cached
+    progress("load")
+    data = datasets.get(id, version, folder_path)
+    progress("isochrones")
+    return isochrone_cache.put(key, compute_isochrones(data, source, ids, thresholds, lat, long, radius, seed))
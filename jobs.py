@@ -0,0 +1,334 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+
+import data_process_new
+import metrics
+from dataset_cache import datasets, ingest_version
+import find_bad_places2
+import isochrones
+import tiles
+import what_if
+
+# Количество процессов для расчётов и максимум задач в очереди (ожидающих и выполняющихся)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 2))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 16))
+# Сколько секунд хранить завершённые задачи
+JOB_TTL = int(os.environ.get("JOB_TTL", 3600))
+# Сколько окон помнить для выбора процесса (см. JobManager.submit)
+JOB_AFFINITY_SIZE = int(os.environ.get("JOB_AFFINITY_SIZE", 1024))
+
+# Тип задачи -> функция расчёта; функция принимает аргумент progress(stage)
+TASKS = {
+    "routes": data_process_new.find_routes_and_places,
+    "raport": find_bad_places2.generate_raport,
+    "precompute": tiles.precompute_tiles,
+    "ingest": ingest_version,
+    "isochrones": isochrones.get_isochrones,
+    "what_if": what_if.create_what_if,
+    "what_if_edit": what_if.edit_what_if,
+    "what_if_delete": what_if.delete_what_if,
+}
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+# --- Worker side ---
+_progress_queue = None
+_worker = None
+
+def _init_worker(progress_queue, worker):
+    global _progress_queue, _worker
+    _progress_queue = progress_queue
+    _worker = worker
+    # Измерения из расчётов уходят в метрики основного процесса
+    metrics.set_sink(lambda event: progress_queue.put(("metric", event)))
+
+def _report_cache():
+    """Отправляет состояние кеша наборов данных процесса в основной процесс"""
+    _progress_queue.put(("cache", _worker, datasets.stats()))
+
+def _run_job(job_id, kind, args, kwargs):
+    def progress(stage):
+        _progress_queue.put(("stage", job_id, stage, time.time()))
+
+    progress("started")
+    try:
+        return TASKS[kind](*args, progress=progress, **kwargs)
+    finally:
+        _report_cache()
+
+def _invalidate_datasets(session_id, version):
+    datasets.invalidate(session_id, version)
+    _report_cache()
+
+
+# --- Main process side ---
+class Job:
+    def __init__(self, kind, session_id, args, kwargs):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.session_id = session_id
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.stages = []  # [(этап, время начала)]
+        self.created_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.cancel_requested = False
+        self.future = None
+        self.worker = None  # номер процесса, в котором идёт расчёт
+        self.cache_key = None  # ключ ответа в кеше готовых результатов (result_cache)
+
+    @property
+    def stage(self):
+        return self.stages[-1][0] if self.stages else None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": [{"stage": stage, "started_at": started_at} for stage, started_at in self.stages],
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+        }
+
+
+class JobManager:
+    """
+    Очередь расчётных задач поверх процессов ProcessPoolExecutor (по одному на исполнителя).
+    Тяжёлые расчёты идут в отдельных процессах и не блокируют event loop FastAPI;
+    этапы расчёта приходят из процессов через общую очередь и видны в статусе задачи.
+    Задачи одного окна (affinity) по возможности попадают в тот же процесс - там уже запомнены
+    этапы его расчёта (см. analysis_pipeline).
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, ttl=JOB_TTL):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executors = [None] * max_workers
+        self._progress_queue = None
+        self._affinity = OrderedDict()  # окно -> номер процесса
+        self._cache_stats = {}  # номер процесса -> последний отчёт его кеша наборов данных
+
+    def _ensure_executor(self, worker):
+        # spawn: fork процесса с работающими потоками uvicorn небезопасен
+        context = multiprocessing.get_context("spawn")
+        if self._progress_queue is None:
+            self._progress_queue = context.Queue()
+            threading.Thread(target=self._read_progress, args=(self._progress_queue,), daemon=True).start()
+        if self._executors[worker] is None:
+            self._executors[worker] = ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                                          initargs=(self._progress_queue, worker))
+        return self._executors[worker]
+
+    def _choose_worker(self, affinity):
+        """
+        Процесс для задачи: тот, что считал это окно, если он загружен не больше остальных,
+        иначе наименее загруженный
+        """
+        pending = [0] * self.max_workers
+        for job in self._jobs.values():
+            if job.status in ("queued", "running") and job.worker is not None:
+                pending[job.worker] += 1
+        worker = min(range(self.max_workers), key=pending.__getitem__)
+        if affinity is not None:
+            previous = self._affinity.pop(affinity, None)
+            if previous is not None and previous < self.max_workers and pending[previous] <= pending[worker]:
+                worker = previous
+            self._affinity[affinity] = worker
+            while len(self._affinity) > JOB_AFFINITY_SIZE:
+                self._affinity.popitem(last=False)
+        return worker
+
+    def _read_progress(self, queue):
+        while True:
+            message = queue.get()
+            if message is None:
+                break
+            if message[0] == "metric":
+                metrics.handle(message[1])
+                continue
+            if message[0] == "cache":
+                _, worker, stats = message
+                with self._lock:
+                    self._cache_stats[worker] = stats
+                continue
+            _, job_id, stage, started_at = message
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    if job.status == "queued":
+                        job.status = "running"
+                    self._observe_stage(job, started_at)
+                    job.stages.append((stage, started_at))
+
+    @staticmethod
+    def _observe_stage(job, finished_at):
+        """Длительность предыдущего этапа (для первого - ожидание в очереди)"""
+        if job.stages:
+            stage, started_at = job.stages[-1]
+            if stage == "started":
+                return
+        else:
+            stage, started_at = "queued", job.created_at
+        metrics.emit(("stage", job.kind, stage, finished_at - started_at))
+
+    def submit(self, kind, session_id, *args, affinity=None, worker=None, **kwargs):
+        """
+        Ставит задачу в очередь. affinity - ключ окна расчёта (например, версия, точка, радиус, зерно):
+        задачи с одним ключом по возможности идут в один процесс. worker - номер процесса, в котором задача
+        должна идти обязательно (нужно состояние этого процесса, например анализ what-if); номер процесса
+        задачи - Job.worker.
+        """
+        if kind not in TASKS:
+            raise KeyError(kind)
+        if worker is not None and not 0 <= worker < self.max_workers:
+            raise ValueError(f"No worker {worker}")
+        with self._lock:
+            self._purge()
+            pending = sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"Too many jobs in queue ({pending})")
+            job = Job(kind, session_id, args, kwargs)
+            job.worker = self._choose_worker(affinity) if worker is None else worker
+            self._jobs[job.id] = job
+        try:
+            job.future = self._ensure_executor(job.worker).submit(_run_job, job.id, kind, args, kwargs)
+        except BrokenProcessPool:
+            # Процесс упал (например, по памяти) - пересоздаём его
+            self._executors[job.worker].shutdown(wait=False)
+            self._executors[job.worker] = None
+            with self._lock:
+                self._cache_stats.pop(job.worker, None)
+            job.future = self._ensure_executor(job.worker).submit(_run_job, job.id, kind, args, kwargs)
+        job.future.add_done_callback(lambda future, job=job: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        with self._lock:
+            job.finished_at = time.time()
+            if future.cancelled() or job.cancel_requested:
+                job.status = "cancelled"
+            elif future.exception() is not None:
+                job.status = "failed"
+                job.error = repr(future.exception())
+            else:
+                job.status = "done"
+            if job.status != "cancelled":
+                self._observe_stage(job, job.finished_at)
+            metrics.jobs_total.inc(kind=job.kind, status=job.status)
+
+    def get(self, job_id, session_id=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or (session_id is not None and job.session_id != session_id):
+            return None
+        return job
+
+    def result(self, job):
+        if job.status != "done":
+            raise RuntimeError(f"Job {job.id} is {job.status}")
+        return job.future.result()
+
+    def exception(self, job):
+        """Исключение упавшей задачи (как его выбросил расчёт) или None"""
+        if job.status != "failed":
+            return None
+        return job.future.exception()
+
+    async def wait(self, job):
+        """Ждёт завершения задачи, не блокируя event loop"""
+        try:
+            await asyncio.wrap_future(job.future)
+        except (CancelledError, Exception):
+            pass
+        if job.status == "failed":
+            raise RuntimeError(job.error)
+        return self.result(job)
+
+    def cancel(self, job):
+        """
+        Отменяет задачу. Задача из очереди снимается сразу; выполняющийся расчёт прервать нельзя,
+        его результат будет отброшен.
+        """
+        with self._lock:
+            if job.status not in ("queued", "running"):
+                return False
+            job.cancel_requested = True
+        # Колбэк завершения сам переведёт задачу в cancelled
+        job.future.cancel()
+        return True
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+    def cache_stats(self):
+        """
+        Кеши наборов данных процессов задач (по последним отчётам процессов): суммы по всем процессам
+        и значения каждого в workers
+        """
+        with self._lock:
+            workers = dict(self._cache_stats)
+        total = {name: sum(stats[name] for stats in workers.values())
+                 for name in ("entries", "bytes", "max_bytes", "hits", "misses", "evictions")}
+        requests = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / requests if requests else 0.0
+        total["workers"] = {worker: workers[worker] for worker in sorted(workers)}
+        return total
+
+    def invalidate_datasets(self, session_id, version=None):
+        """
+        Удаляет данные сессии (или версии) из кешей запущенных процессов задач.
+        Удаление идёт в очереди процесса - после уже поставленных в неё задач.
+        """
+        for executor in self._executors:
+            if executor is not None:
+                try:
+                    executor.submit(_invalidate_datasets, session_id, version)
+                except (BrokenProcessPool, RuntimeError):
+                    # Процесс упал или остановлен - его кеша больше нет
+                    pass
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.ttl]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        if self._progress_queue is not None:
+            with self._lock:
+                futures = [job.future for job in self._jobs.values() if job.future is not None]
+            for future in futures:
+                future.cancel()
+            for executor in self._executors:
+                if executor is not None:
+                    executor.shutdown(wait=False)
+            self._progress_queue.put(None)
+            self._executors = [None] * self.max_workers
+            self._progress_queue = None
+            self._cache_stats = {}
+
+
+jobs = JobManager()
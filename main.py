@@ -1,27 +1,31 @@
-from fastapi import FastAPI, File, UploadFile, Request, HTTPException, Response
-from fastapi.responses import FileResponse
-from typing import List
+from fastapi import FastAPI, File, UploadFile, Request, HTTPException, Response, Body, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from typing import Any, Dict, List
 import shutil
 import os
 import uuid
-import data_process_new
-import json
 from fastapi.middleware.cors import CORSMiddleware
-import find_bad_places2
-from datetime import datetime
+from jobs import jobs, JobQueueFull
+from compact_format import dumps, iter_ndjson
+from street_graph import POPULATION_SEED
+from assignment import ASSIGNMENT_METHODS
+from what_if import WHAT_IF_MAX_ANALYSES
+from isochrones import ISOCHRONE_SOURCES
+from tiles import tiled_routes
+from uploads import UploadError, save_dataset
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from result_cache import quantize, results
+from catalog import catalog
+import metrics
+import time
+from collections import OrderedDict
 
 # Папка для хранения загруженных файлов
 BASE_SAVE_FOLDER = "./uploaded_files/"
 
-# Ожидаемые расширения файлов
-EXPECTED_EXTENSIONS = {
-    "shp": "shp",
-    "shx": "shx",
-    "dbf": "dbf",
-    "prj": "prj",
-    "qmd": "qmd",
-    "cpg": "cpg"
-}
+# Папка для незавершённых загрузок (вне папок сессий, на том же диске - для атомарного rename)
+UPLOAD_STAGING_FOLDER = os.path.join(BASE_SAVE_FOLDER, ".uploads")
 
 # Функция для получения или генерации ID сессии
 def get_session_id(request: Request) -> str:
@@ -32,18 +36,6 @@ def get_session_id(request: Request) -> str:
     session_id = "FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF"
     return session_id
 
-def get_folders_in_directory(session_id: str):
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    
-    # Проверяем, существует ли директория
-    if not os.path.exists(session_folder):
-        return []
-    
-    # Получаем список всех элементов в папке, фильтруем только папки
-    folders = [f for f in os.listdir(session_folder) if os.path.isdir(os.path.join(session_folder, f))]
-    
-    return folders
-
 from fastapi import FastAPI, HTTPException, Request, Response
 import os
 
@@ -66,46 +58,24 @@ app.add_middleware(
                    "Authorization"]
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Метка - шаблон маршрута (/api/jobs/{job_id}), а не сам путь, чтобы не плодить ряды
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.http_latency.observe(time.perf_counter() - started, method=request.method, path=path)
+        metrics.http_requests.inc(method=request.method, path=path, status=status)
+
 # Папка для хранения файлов
 BASE_SAVE_FOLDER = "./uploaded_files/"
 
-def get_files_in_session_folder(session_id: str, version = None):
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    
-    # Проверяем, существует ли директория
-    if not os.path.exists(session_folder):
-        raise HTTPException(status_code=404, detail="Session folder not found")
-    
-    # Получаем список всех папок и файлов внутри папки session_id
-    result = {}
-    if version != None:
-        folder_path = os.path.join(session_folder, version)
-        result[version] = {}
-        # Проверяем, что это директория
-        if os.path.isdir(folder_path):
-            # Получаем список файлов в папке
-            for folder_name_2 in os.listdir(folder_path):
-                result[version][folder_name_2] = []
-                ppth = os.path.join(folder_path, folder_name_2)
-                if os.path.isdir(ppth):
-                    files = os.listdir(ppth)
-                    result[version][folder_name_2] = files
-    else:
-        for folder_name in os.listdir(session_folder):
-            folder_path = os.path.join(session_folder, folder_name)
-            result[folder_name] = {}
-            # Проверяем, что это директория
-            if os.path.isdir(folder_path):
-                # Получаем список файлов в папке
-                for folder_name_2 in os.listdir(folder_path):
-                    result[folder_name][folder_name_2] = []
-                    ppth = os.path.join(folder_path, folder_name_2)
-                    if os.path.isdir(ppth):
-                        files = os.listdir(ppth)
-                        result[folder_name][folder_name_2] = files
-        
-    return result
-
 @app.get("/api/files/")
 async def list_files(request: Request, response: Response, version = None):
     # Извлекаем session_id из cookies
@@ -115,40 +85,20 @@ async def list_files(request: Request, response: Response, version = None):
         response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
     
     try:
-        # Получаем список файлов для session_id
-        files = get_files_in_session_folder(session_id, version)
-        return {"versions": files}
+        # Список файлов для session_id - один запрос к каталогу
+        files = await run_in_threadpool(catalog.files, session_id, version)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not files and not os.path.exists(os.path.join(BASE_SAVE_FOLDER, session_id)):
+        raise HTTPException(status_code=404, detail="Session folder not found")
+    return {"versions": files}
 
-# Путь к файлу метаданных
-def get_metadata_path(session_folder: str):
-    return os.path.join(session_folder, "metadata.json")
-
-# Функция для записи метаданных
-def write_metadata(session_folder: str, version: str):
-    metadata_path = get_metadata_path(session_folder)
-    # Если файл метаданных существует, загружаем его
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r") as f:
-            metadata = json.load(f)
-    else:
-        metadata = {}
-    
-    # Добавляем или обновляем информацию о версии
-    metadata[version] = {"created_at": datetime.utcnow().isoformat()}
-    
-    # Записываем обновленные метаданные обратно в файл
-    with open(metadata_path, "w") as f:
-        json.dump(metadata, f)
-
-# Функция для чтения метаданных
-def read_metadata(session_folder: str):
-    metadata_path = get_metadata_path(session_folder)
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r") as f:
-            return json.load(f)
-    return {}
+@app.get("/api/catalog/")
+async def get_catalog(request: Request, response: Response, version: str = None):
+    # Версии с наборами: число объектов, охват, размеры и sha256 файлов
+    session_id = get_session_id(request)
+    response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
+    return {"versions": await run_in_threadpool(catalog.describe, session_id, version)}
 
 import shutil
 
@@ -160,30 +110,24 @@ async def get_folders(request: Request, response: Response):
         response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
     session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
     try:
-        folders = get_folders_in_directory(session_id)
-        # Проверка наличия папки "default"
-        if "default" not in folders:
-            session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-            
+        # Версии и время их создания - из каталога
+        folders_info = await run_in_threadpool(catalog.versions, session_id)
+        # Проверка наличия версии "default"
+        if not any(folder["version"] == "default" for folder in folders_info):
             # Создаем папки, если их нет
             os.makedirs(session_folder, exist_ok=True)
 
-            # Записываем время создания версии в метаданные
-            write_metadata(session_folder, "default_data")
             # Папка "default" отсутствует, копируем данные из default_data
             default_data_folder = "default_data"
             default_version_folder = os.path.join(session_folder, "default")
             # Копируем все содержимое из default_data в папку "default"
-            if os.path.exists(default_data_folder):
-                shutil.copytree(default_data_folder, default_version_folder)
-            else:
+            if not os.path.exists(default_data_folder):
                 raise HTTPException(status_code=404, detail="default_data folder not found")
-            # После копирования создаем метаданные для версии "default"
-            write_metadata(session_folder, "default")
-            folders = get_folders_in_directory(session_id)
-        # Чтение метаданных и добавление времени создания
-        metadata = read_metadata(session_folder)
-        folders_info = [{"version": folder, "created_at": metadata.get(folder, {}).get("created_at")} for folder in folders]
+            if not os.path.exists(default_version_folder):
+                await run_in_threadpool(shutil.copytree, default_data_folder, default_version_folder)
+            # После копирования заносим версию "default" в каталог
+            await run_in_threadpool(catalog.sync_version, session_id, "default")
+            folders_info = await run_in_threadpool(catalog.versions, session_id)
         response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
         return {"folders": folders_info}
     
@@ -198,57 +142,135 @@ async def upload_files(
     response: Response,
     files: List[UploadFile] = File(...),
     request: Request = None,
+    wait: bool = True,
 ):
     # Получаем или генерируем ID сессии
     session_id = get_session_id(request)
     
     # Формируем путь для сессии и версии
     response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
+    for name in (dataset_name, version):
+        if not name or name.startswith(".") or os.path.basename(name) != name:
+            raise HTTPException(status_code=400, detail=f"Invalid name {name}")
     session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
     version_folder = os.path.join(session_folder, version)
     dataset_folder = os.path.join(version_folder, dataset_name)
-    
-    # Создаем папки, если их нет
-    os.makedirs(version_folder, exist_ok=True)
-    os.makedirs(dataset_folder, exist_ok=True)
 
-    # Записываем время создания версии в метаданные
-    write_metadata(session_folder, version)
+    # Запись и проверка файлов - в пуле потоков, чтобы не блокировать event loop.
+    # Версия появляется (и набор заменяется) только если комплект файлов прошёл проверку
+    try:
+        saved = await run_in_threadpool(save_dataset, [(file.filename, file.file) for file in files],
+                                        dataset_folder, UPLOAD_STAGING_FOLDER)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    # Когда загружены все слои, версия один раз переводится в колоночный формат для быстрой загрузки,
+    # улицы при этом очищаются - отчёт об очистке возвращается клиенту. Чтение shapefile, очистка и запись
+    # хранилища идут задачей в процессе расчётов; wait=False - ответ сразу, с id задачи ingest_job
+    topology, ingest_job = None, None
+    try:
+        ingest_job = jobs.submit("ingest", session_id, version_folder)
+        if wait:
+            topology = await jobs.wait(ingest_job)
+    except (JobQueueFull, RuntimeError) as e:
+        # Не страшно: хранилище будет собрано при первом расчёте
+        print(f"Ingest of {version_folder} failed: {e}")
 
-    file_paths = []
-    
-    # Обрабатываем каждый файл
-    for file in files:
-        extension = file.filename.split('.')[-1]
-        if extension in EXPECTED_EXTENSIONS:
-            new_filename = file.filename
-            file_location = os.path.join(dataset_folder, new_filename)
-            with open(file_location, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            file_paths.append(file_location)
-        else:
-            raise HTTPException(status_code=400, detail=f"Invalid file extension for {file.filename}")
-    
-    return {"uploaded_files": file_paths}
-
-# @app.get("/api/get_routes/")
-# async def upload_files(
-#     version: str,
-#     response: Response,
-#     request: Request = None,
-# ):
-#     # Получаем или генерируем ID сессии
-#     session_id = get_session_id(request)
-#     # Проверяем, существует ли директория
-#     session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-#     if not os.path.exists(session_folder):
-#         response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-#         raise HTTPException(status_code=404, detail="Session folder not found")
-#     # Формируем путь для сессии и версии
-#     response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-#     session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-#     version_folder = os.path.join(session_folder, version)
-#     return data_process_new.find_routes_and_places(version_folder, session_id, version)
+    # Заносим набор в каталог (транзакция - параллельные загрузки не теряют записи)
+    await run_in_threadpool(catalog.record_dataset, session_id, version, dataset_name, saved)
+
+    # Файлы версии изменились - закешированные в процессах задач данные больше не актуальны
+    jobs.invalidate_datasets(session_id, version)
+
+    return {
+        "uploaded_files": [os.path.join(dataset_folder, file["name"]) for file in saved],
+        "files": saved,
+        "topology": topology,
+        "ingest_job": ingest_job.to_dict() if ingest_job is not None else None,
+    }
+
+# # --- Фоновые задачи расчёта ---
+# Режимы распределения нагрузки: кратчайшие пути или равновесие с учётом загруженности
+ASSIGNMENT_MODES = ("free_flow",) + ASSIGNMENT_METHODS
+
+def submit_job(kind: str, session_id: str, version_folder: str, version: str, lat: float, long: float, radius: float,
+               seed: int = POPULATION_SEED, cache_key: str = None, **options):
+    args = (version_folder, session_id, version)
+    if lat is not None and long is not None:
+        args += (lat, long)
+    try:
+        # Маршруты и отчёт одного окна считаются в одном процессе - общие этапы не повторяются
+        job = jobs.submit(kind, session_id, *args, radius=radius, seed=seed,
+                          affinity=(version_folder, lat, long, radius, seed), **options)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    job.cache_key = cache_key
+    return job
+
+def check_choice(name: str, value: str, choices):
+    if value not in choices:
+        raise HTTPException(status_code=400, detail=f"Unknown {name} {value}")
+
+# # --- Кеш готовых ответов ---
+# Одинаковые запросы к неизменённой версии отдаются с диска без расчёта (result_cache)
+async def result_cache_key(kind: str, session_id: str, version: str, lat: float, long: float, radius: float,
+                           seed: int, assignment: str, format: str = "json"):
+    extension = "pdf" if kind == "raport" else ("ndjson" if format == "compact" else "json")
+    # Хеш содержимого берётся из каталога (файлы читаются, только если изменились) - в пуле потоков
+    content = await run_in_threadpool(catalog.content_hash, session_id, version)
+    return results.key(kind, content, version, extension, lat=lat, long=long, radius=radius, seed=seed,
+                       assignment=assignment)
+
+async def cached_response(kind: str, key: str):
+    body = await run_in_threadpool(results.get, key)
+    metrics.result_cache_requests.inc(kind=kind, result="miss" if body is None else "hit")
+    if body is None:
+        return None
+    headers = {"Content-Disposition": 'attachment; filename="report.pdf"'} if key.endswith(".pdf") else None
+    return Response(content=body, media_type=results.media_type(key), headers=headers)
+
+def cache_stream(key, chunks):
+    # Строки отдаются клиенту сразу, в кеш поток попадает целиком, когда закончился
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    results.put(key, b"".join(parts))
+
+def job_response(job, result):
+    # Запись в кеш - фоновой задачей после отправки ответа
+    def store(body):
+        return BackgroundTask(results.put, job.cache_key, body) if job.cache_key else None
+
+    if job.kind == "raport":
+        # PDF собирается в памяти задачи и отдаётся как есть
+        return Response(content=result, media_type='application/pdf', background=store(result),
+                        headers={"Content-Disposition": 'attachment; filename="report.pdf"'})
+    if job.kwargs.get("output_format") == "compact":
+        # Построчный поток: клиент начинает рисовать, не дожидаясь всего ответа
+        chunks = iter_ndjson(result)
+        return StreamingResponse(cache_stream(job.cache_key, chunks) if job.cache_key else chunks,
+                                 media_type="application/x-ndjson")
+    body = dumps(result)
+    return Response(content=body, media_type="application/json", background=store(body))
+
+async def wait_for_job(job):
+    try:
+        result = await jobs.wait(job)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return job_response(job, result)
+
+def get_version_folder(request: Request, response: Response, version: str):
+    # Получаем или генерируем ID сессии
+    session_id = get_session_id(request)
+    response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
+    # Проверяем, существует ли директория
+    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
+    if not os.path.exists(session_folder):
+        raise HTTPException(status_code=404, detail="Session folder not found")
+    # Формируем путь для сессии и версии
+    return session_id, os.path.join(session_folder, version)
 
 @app.get("/api/get_routes/")
 async def upload_files(
@@ -257,21 +279,40 @@ async def upload_files(
     request: Request = None,
     lat: float = None,
     long: float = None,
+    radius: float = 1000,
+    seed: int = POPULATION_SEED,
+    assignment: str = "free_flow",
+    wait: bool = True,
+    format: str = "json",
+    source: str = "window",
 ):
-    # Получаем или генерируем ID сессии
-    session_id = get_session_id(request)
-    # Проверяем, существует ли директория
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    if not os.path.exists(session_folder):
-        response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-        raise HTTPException(status_code=404, detail="Session folder not found")
-    # Формируем путь для сессии и версии
-    response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    version_folder = os.path.join(session_folder, version)
-    if lat != None and long != None:
-        return data_process_new.find_routes_and_places(version_folder, session_id, version, lat, long)
-    return data_process_new.find_routes_and_places(version_folder, session_id, version)
+    check_choice("format", format, ("json", "compact"))
+    check_choice("assignment", assignment, ASSIGNMENT_MODES)
+    check_choice("source", source, ("window", "tiles"))
+    session_id, version_folder = get_version_folder(request, response, version)
+    lat, long = quantize(lat), quantize(long)
+    # Приближённый ответ из предрасчитанных плиток (POST /api/precompute/) - только по явному запросу:
+    # дома берутся из плиток с центром в круге, остановки - в пределах TILE_RADIUS от центра плитки
+    if source == "tiles":
+        result = None
+        if assignment == "free_flow" and lat is not None and long is not None:
+            result = await run_in_threadpool(tiled_routes, version_folder, lat, long, radius, seed, format)
+        if result is None:
+            raise HTTPException(status_code=409, detail="No precomputed tiles for this request")
+        if format == "compact":
+            return StreamingResponse(iter_ndjson(result), media_type="application/x-ndjson")
+        return Response(content=dumps(result), media_type="application/json")
+    key = await result_cache_key("routes", session_id, version, lat, long, radius, seed, assignment, format)
+    if wait:
+        cached = await cached_response("routes", key)
+        if cached is not None:
+            return cached
+    options = {"output_format": "compact"} if format == "compact" else {}
+    job = submit_job("routes", session_id, version_folder, version, lat, long, radius, seed,
+                     cache_key=key, assignment=assignment, **options)
+    if not wait:
+        return job.to_dict()
+    return await wait_for_job(job)
 
 @app.get("/api/get_raport/")
 async def upload_files(
@@ -280,29 +321,206 @@ async def upload_files(
     request: Request = None,
     lat: float = None,
     long: float = None,
+    radius: float = 1000,
+    seed: int = POPULATION_SEED,
+    assignment: str = "free_flow",
+    wait: bool = True,
 ):
-    # Получаем или генерируем ID сессии
-    session_id = get_session_id(request)
-    # Проверяем, существует ли директория
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    if not os.path.exists(session_folder):
-        response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-        raise HTTPException(status_code=404, detail="Session folder not found")
-    # Формируем путь для сессии и версии
-    response.headers["Set-Cookie"] = f"session_id={session_id}; Path=/; HttpOnly=false;"
-    session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
-    version_folder = os.path.join(session_folder, version)
-    report_path = None
+    check_choice("assignment", assignment, ASSIGNMENT_MODES)
+    session_id, version_folder = get_version_folder(request, response, version)
+    lat, long = quantize(lat), quantize(long)
+    key = await result_cache_key("raport", session_id, version, lat, long, radius, seed, assignment)
+    if wait:
+        cached = await cached_response("raport", key)
+        if cached is not None:
+            return cached
+    job = submit_job("raport", session_id, version_folder, version, lat, long, radius, seed,
+                     cache_key=key, assignment=assignment)
+    if not wait:
+        return job.to_dict()
+    return await wait_for_job(job)
+
+@app.post("/api/precompute/")
+async def precompute(
+    version: str,
+    response: Response,
+    request: Request = None,
+    seed: int = POPULATION_SEED,
+):
+    # Фоновый предрасчёт плиток всей версии; статус и сводка - через /api/jobs/{job_id}
+    session_id, version_folder = get_version_folder(request, response, version)
+    if not os.path.isdir(version_folder):
+        raise HTTPException(status_code=404, detail="Version not found")
+    try:
+        return jobs.submit("precompute", session_id, version_folder, session_id, version, seed=seed).to_dict()
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+@app.post("/api/jobs/")
+async def create_job(
+    kind: str,
+    version: str,
+    response: Response,
+    request: Request = None,
+    lat: float = None,
+    long: float = None,
+    radius: float = 1000,
+    seed: int = POPULATION_SEED,
+    assignment: str = "free_flow",
+    format: str = "json",
+):
+    check_choice("job kind", kind, ("routes", "raport"))
+    check_choice("format", format, ("json", "compact"))
+    check_choice("assignment", assignment, ASSIGNMENT_MODES)
+    session_id, version_folder = get_version_folder(request, response, version)
+    lat, long = quantize(lat), quantize(long)
+    key = await result_cache_key(kind, session_id, version, lat, long, radius, seed, assignment, format)
+    options = {"output_format": "compact"} if kind == "routes" and format == "compact" else {}
+    return submit_job(kind, session_id, version_folder, version, lat, long, radius, seed,
+                      cache_key=key, assignment=assignment, **options).to_dict()
+
+def get_job_or_404(request: Request, job_id: str):
+    job = jobs.get(job_id, get_session_id(request))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str, request: Request):
+    return get_job_or_404(request, job_id).to_dict()
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str, request: Request):
+    job = get_job_or_404(request, job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return job_response(job, jobs.result(job))
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str, request: Request):
+    job = get_job_or_404(request, job_id)
+    if not jobs.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return job.to_dict()
+
+# # --- What-if: правки поверх сохранённого расчёта ---
+# Анализ хранится в процессе задач, который его создал: analysis_id -> номер процесса
+what_if_workers = OrderedDict()
+
+def submit_task(kind: str, session_id: str, *args, **kwargs):
+    try:
+        return jobs.submit(kind, session_id, *args, **kwargs)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+async def task_result(job):
+    # Результат задачи без кеша ответов; ошибки во входных данных расчёта - 404 и 400
+    try:
+        return await jobs.wait(job)
+    except RuntimeError as e:
+        error = jobs.exception(job)
+        if isinstance(error, KeyError):
+            raise HTTPException(status_code=404, detail=str(error.args[0]) if error.args else "Not found")
+        if isinstance(error, ValueError):
+            raise HTTPException(status_code=400, detail=str(error))
+        raise HTTPException(status_code=500, detail=str(e))
+
+def get_analysis_worker_or_404(analysis_id: str):
+    worker = what_if_workers.get(analysis_id)
+    if worker is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return worker
+
+async def what_if_task(kind: str, request: Request, analysis_id: str, *args):
+    worker = get_analysis_worker_or_404(analysis_id)
+    return await task_result(submit_task(kind, get_session_id(request), analysis_id, get_session_id(request), *args,
+                                         worker=worker))
+
+@app.post("/api/what_if/")
+async def create_what_if(
+    version: str,
+    response: Response,
+    request: Request = None,
+    lat: float = None,
+    long: float = None,
+    radius: float = 1000,
+    seed: int = POPULATION_SEED,
+):
+    session_id, version_folder = get_version_folder(request, response, version)
+    args = (version_folder, session_id, version)
     if lat is not None and long is not None:
-        report_path = find_bad_places2.generate_raport(version_folder, session_id, version, lat, long)
-    else:
-        report_path = find_bad_places2.generate_raport(version_folder, session_id, version)
-    
-    # Проверяем, существует ли PDF файл и возвращаем его
-    if os.path.exists(report_path):
-        return FileResponse(report_path, media_type='application/pdf', filename="report.pdf")
-    
-    raise HTTPException(status_code=404, detail="Report not found")
+        args += (lat, long)
+    # Анализ строится в процессе задач - там же, где маршруты этого окна
+    job = submit_task("what_if", session_id, *args, radius=radius, seed=seed,
+                      affinity=(version_folder, lat, long, radius, seed))
+    result = await task_result(job)
+    what_if_workers[result["analysis_id"]] = job.worker
+    # Процессы помнят не больше WHAT_IF_MAX_ANALYSES анализов каждый
+    while len(what_if_workers) > WHAT_IF_MAX_ANALYSES * jobs.max_workers:
+        what_if_workers.popitem(last=False)
+    return result
+
+@app.get("/api/what_if/{analysis_id}")
+async def get_what_if(analysis_id: str, request: Request):
+    return await what_if_task("what_if_edit", request, analysis_id, [])
+
+@app.post("/api/what_if/{analysis_id}/edits")
+async def edit_what_if(analysis_id: str, request: Request, edits: List[Dict[str, Any]] = Body(...)):
+    # Пакет правок применяется целиком: при ошибке (404 - нет объекта, 400 - неверная правка) анализ не меняется
+    return await what_if_task("what_if_edit", request, analysis_id, edits)
+
+@app.delete("/api/what_if/{analysis_id}")
+async def delete_what_if(analysis_id: str, request: Request):
+    result = await what_if_task("what_if_delete", request, analysis_id)
+    what_if_workers.pop(analysis_id, None)
+    return result
+
+# # --- Изохроны пешеходной доступности ---
+@app.get("/api/isochrones/")
+async def isochrones(
+    version: str,
+    response: Response,
+    request: Request = None,
+    source: str = "stops",
+    ids: List[int] = Query(None),
+    thresholds: List[float] = Query(None),
+    lat: float = None,
+    long: float = None,
+    radius: float = 1000,
+    seed: int = POPULATION_SEED,
+):
+    # Источники - остановки или выходы метро с id из ids; без ids - все в radius метров от точки
+    check_choice("source", source, ISOCHRONE_SOURCES)
+    session_id, version_folder = get_version_folder(request, response, version)
+    # Граф и поиск путей - в процессе задач; кеш изохрон и наборов данных - там же
+    job = submit_task("isochrones", session_id, version_folder, session_id, version, source, ids, thresholds,
+                      lat, long, radius, seed, affinity=(version_folder, lat, long, radius, seed))
+    return await task_result(job)
+
+@app.on_event("shutdown")
+def shutdown_jobs():
+    jobs.shutdown()
+
+@app.get("/api/cache_stats/")
+async def cache_stats():
+    # Кеши наборов данных живут в процессах задач - их состояние процессы присылают после каждой задачи;
+    # объём кеша готовых ответов - из этого процесса
+    return {**jobs.cache_stats(), "results": await run_in_threadpool(results.stats)}
+
+@app.get("/api/metrics")
+async def get_metrics():
+    # Значения, которые считаются при чтении: задачи в очереди по статусам и кеши наборов данных
+    # процессов задач (по их последним отчётам; процессы, ещё не выполнившие задач, не показываются)
+    counts = jobs.counts()
+    metrics.jobs_current.replace({(status,): counts.get(status, 0)
+                                  for status in ("queued", "running", "done", "failed", "cancelled")})
+    workers = jobs.cache_stats()["workers"]
+    metrics.cache_bytes.replace({(worker,): stats["bytes"] for worker, stats in workers.items()})
+    metrics.cache_entries.replace({(worker,): stats["entries"] for worker, stats in workers.items()})
+    metrics.cache_hit_rate.replace({(worker,): stats["hit_rate"] for worker, stats in workers.items()})
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.delete("/api/delete_version/")
 async def delete_version(request: Request, response: Response, version: str):
@@ -314,7 +532,6 @@ async def delete_version(request: Request, response: Response, version: str):
     
     session_folder = os.path.join(BASE_SAVE_FOLDER, session_id)
     version_folder = os.path.join(session_folder, version)
-    metadata_path = get_metadata_path(session_folder)
 
     # Проверяем, существует ли папка версии
     if not os.path.exists(version_folder):
@@ -322,20 +539,12 @@ async def delete_version(request: Request, response: Response, version: str):
 
     try:
         # Удаляем папку версии
-        shutil.rmtree(version_folder)
-        
-        # Удаляем запись из метаданных
-        if os.path.exists(metadata_path):
-            with open(metadata_path, "r") as f:
-                metadata = json.load(f)
-            
-            if version in metadata:
-                del metadata[version]
-            
-            # Записываем обновленные метаданные
-            with open(metadata_path, "w") as f:
-                json.dump(metadata, f)
-        
+        await run_in_threadpool(shutil.rmtree, version_folder)
+        jobs.invalidate_datasets(session_id, version)
+
+        # Удаляем запись из каталога
+        await run_in_threadpool(catalog.delete_version, session_id, version)
+
         return {"message": f"Version {version} deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,192 @@
+# metrics.py
+"""
+Метрики приложения в текстовом формате Prometheus (/api/metrics) без внешних зависимостей.
+
+Расчёты идут в процессах очереди задач, поэтому события измерений (emit) там не пишутся в метрики
+напрямую, а уходят в основной процесс через очередь прогресса (см. jobs._init_worker и set_sink).
+"""
+import bisect
+import threading
+import time
+
+# Границы гистограмм: длительности в секундах и размеры (число вершин, рёбер, домов)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values):
+        """Заменяет все значения: {кортеж меток: значение} - для метрик, пересчитываемых при чтении"""
+        with self._lock:
+            self._values = {tuple(map(str, key)): value for key, value in values.items()}
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Application metrics ---
+http_requests = Counter("http_requests_total", "HTTP requests by route and status", ("method", "path", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "path"))
+jobs_total = Counter("jobs_total", "Finished jobs by kind and status", ("kind", "status"))
+jobs_current = Gauge("jobs", "Jobs in the queue by status", ("status",))
+stage_latency = Histogram("pipeline_stage_duration_seconds", "Pipeline stage duration", ("kind", "stage"))
+loop_latency = Histogram("pipeline_loop_duration_seconds", "Duration of instrumented pipeline loops", ("loop",))
+loop_items = Counter("pipeline_loop_items_total", "Items processed by instrumented pipeline loops", ("loop",))
+graph_size = Histogram("graph_size", "Street graph and window sizes per calculation", ("item",), SIZE_BUCKETS)
+cache_requests = Counter("dataset_cache_requests_total", "Dataset cache lookups by result", ("result",))
+cache_evictions = Counter("dataset_cache_evictions_total", "Datasets evicted from the cache")
+cache_bytes = Gauge("dataset_cache_bytes", "Memory used by the dataset cache of each job worker", ("worker",))
+cache_entries = Gauge("dataset_cache_entries", "Datasets held in the cache of each job worker", ("worker",))
+cache_hit_rate = Gauge("dataset_cache_hit_rate", "Dataset cache hit rate of each job worker", ("worker",))
+result_cache_requests = Counter("result_cache_requests_total", "Result cache lookups by kind and result",
+                                ("kind", "result"))
+
+
+# --- Events ---
+# События измерений - кортежи (тип, ...), чтобы их можно было передать между процессами
+def handle(event):
+    """Записывает событие в метрики текущего процесса"""
+    kind = event[0]
+    if kind == "loop":
+        _, loop, count, seconds = event
+        loop_latency.observe(seconds, loop=loop)
+        loop_items.inc(count, loop=loop)
+    elif kind == "graph":
+        for item, value in event[1].items():
+            graph_size.observe(value, item=item)
+    elif kind == "cache":
+        _, result = event
+        if result == "eviction":
+            cache_evictions.inc()
+        else:
+            cache_requests.inc(result=result)
+    elif kind == "stage":
+        _, job_kind, stage, seconds = event
+        stage_latency.observe(seconds, kind=job_kind, stage=stage)
+
+_sink = handle
+
+def set_sink(sink):
+    """Куда отправлять события: по умолчанию - в метрики этого процесса, в процессах задач - в очередь"""
+    global _sink
+    _sink = sink or handle
+
+def emit(event):
+    try:
+        _sink(event)
+    except Exception:
+        # Метрики не должны ломать расчёт
+        pass
+
+
+# --- Hooks for pipeline code ---
+def track(iterable, loop):
+    """Обёртка цикла вместо tqdm: после завершения сообщает число элементов и время цикла"""
+    started = time.perf_counter()
+    count = 0
+    for count, item in enumerate(iterable, 1):
+        yield item
+    emit(("loop", loop, count, time.perf_counter() - started))
+
+def observe_graph(G, houses, bus_stops):
+    """Размеры графа и окна одного расчёта"""
+    # У StreetGraph размеры - свойства, у networkx - методы
+    nodes, edges = G.number_of_nodes, G.number_of_edges
+    emit(("graph", {
+        "nodes": nodes() if callable(nodes) else nodes,
+        "edges": edges() if callable(edges) else edges,
+        "houses": houses,
+        "bus_stops": bus_stops,
+    }))
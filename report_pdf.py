@@ -0,0 +1,141 @@
+# report_pdf.py
+"""
+FPDF для отчётов без файлов на диске: картинки берутся из памяти, документ отдаётся байтами,
+а шрифт разбирается один раз на процесс.
+"""
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+from fpdf import FPDF
+
+# Шрифт с кириллицей, по умолчанию - рядом с модулем (не зависит от текущей папки)
+REPORT_FONT = os.environ.get("REPORT_FONT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "arial.ttf"))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_SPACES = {0: "DeviceGray", 2: "DeviceRGB", 3: "Indexed", 4: "DeviceGray", 6: "DeviceRGB"}
+
+# Разобранные шрифты процесса: (семейство, стиль, файл) -> (описание шрифта, записи font_files)
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+
+def parse_png(data):
+    """
+    Разбирает PNG из памяти в описание картинки FPDF 1.7 (как FPDF._parsepng).
+    Альфа-канал отделяется numpy по строкам целиком: фильтры PNG работают по каналам,
+    поэтому отфильтрованные байты можно делить без распаковки фильтров.
+    """
+    data = bytes(data)
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        raise ValueError("Not a PNG image")
+    w, h, bpc, ct, compression, filter_method, interlace = struct.unpack(">IIBBBBB", data[16:29])
+    if bpc > 8:
+        raise ValueError("16-bit PNG is not supported")
+    if ct not in PNG_COLOR_SPACES or compression or filter_method or interlace:
+        raise ValueError("Unsupported PNG format")
+    colspace = PNG_COLOR_SPACES[ct]
+
+    pal, trns, chunks = "", "", []
+    pos = 8
+    while pos + 8 <= len(data):
+        length, = struct.unpack(">I", data[pos:pos + 4])
+        kind, chunk = data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if kind == b"PLTE":
+            pal = chunk
+        elif kind == b"tRNS":
+            if ct == 0:
+                trns = [chunk[1]]
+            elif ct == 2:
+                trns = [chunk[1], chunk[3], chunk[5]]
+            elif chunk.find(b"\x00") != -1:
+                trns = [chunk.find(b"\x00")]
+        elif kind == b"IDAT":
+            chunks.append(chunk)
+        elif kind == b"IEND":
+            break
+    if colspace == "Indexed" and not pal:
+        raise ValueError("PNG palette is missing")
+
+    info = {
+        "w": w, "h": h, "cs": colspace, "bpc": bpc, "f": "FlateDecode",
+        "dp": f"/Predictor 15 /Colors {3 if colspace == 'DeviceRGB' else 1} /BitsPerComponent {bpc} /Columns {w}",
+        "pal": pal, "trns": trns,
+    }
+    image = b"".join(chunks)
+    if ct >= 4:
+        # Строка: байт фильтра и пиксели (цвет + альфа); байт фильтра нужен обоим потокам
+        channels = 2 if ct == 4 else 4
+        rows = np.frombuffer(zlib.decompress(image), dtype=np.uint8).reshape(h, 1 + channels * w)
+        pixels = rows[:, 1:].reshape(h, w, channels)
+        image = zlib.compress(np.hstack((rows[:, :1], pixels[:, :, :-1].reshape(h, -1))).tobytes())
+        info["smask"] = zlib.compress(np.hstack((rows[:, :1], pixels[:, :, -1])).tobytes())
+    info["data"] = image
+    return info
+
+
+class ReportPDF(FPDF):
+    """
+    FPDF 1.7 с картинками из памяти (add_png) и общим на процесс разбором шрифтов.
+    Переопределяет внутренние методы FPDF 1.7.2 (_parsepng, add_font) - версия закреплена в req.txt.
+    output_bytes() возвращает документ без записи на диск.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.memory_images = {}
+
+    def add_png(self, name, data):
+        """Регистрирует PNG (bytes или BytesIO) под именем name для image(name, ...)"""
+        self.memory_images[name] = data.getvalue() if hasattr(data, "getvalue") else bytes(data)
+
+    def _parsepng(self, name):
+        if name not in self.memory_images:
+            return super()._parsepng(name)
+        info = parse_png(self.memory_images[name])
+        if "smask" in info and self.pdf_version < "1.4":
+            self.pdf_version = "1.4"
+        return info
+
+    def add_font(self, family, style='', fname='', uni=False):
+        key = (family.lower(), style.upper(), fname, uni)
+        with _fonts_lock:
+            cached = _fonts.get(key)
+        if cached is None:
+            super().add_font(family, style, fname, uni)
+            fontkey = self._fontkey(family, style)
+            if uni:
+                # Метрики берутся из готового .pkl рядом со шрифтом, а в нём путь к .ttf относительный -
+                # подмножество шрифта читается по пути файла, найденного add_font
+                self.fonts[fontkey]["ttffile"] = self.font_files[fontkey]["ttffile"]
+            files = {name: dict(self.font_files[name]) for name in (fontkey, fname) if name in self.font_files}
+            with _fonts_lock:
+                _fonts[key] = (dict(self.fonts[fontkey]), files)
+            return
+
+        font, files = cached
+        fontkey = font["fontkey"] if "fontkey" in font else self._fontkey(family, style)
+        if fontkey in self.fonts:
+            return
+        # Описание общее, но номер шрифта и набор символов у каждого документа свои
+        font = dict(font, i=len(self.fonts) + 1)
+        if "subset" in font:
+            font["subset"] = list(range(0, 57 if hasattr(self, "str_alias_nb_pages") else 32))
+        self.fonts[fontkey] = font
+        self.font_files.update({name: dict(value) for name, value in files.items()})
+
+    @staticmethod
+    def _fontkey(family, style):
+        # Та же нормализация ключа, что в FPDF.add_font
+        family = family.lower()
+        if family == "arial":
+            family = "helvetica"
+        style = style.upper()
+        return family + ("BI" if style == "IB" else style)
+
+    def output_bytes(self):
+        """PDF целиком в памяти (FPDF 1.7 хранит документ строкой latin-1)"""
+        return self.output(dest='S').encode("latin1")
@@ -0,0 +1,136 @@
+# result_cache.py
+"""
+Дисковый кеш готовых ответов get_routes и get_raport (JSON, NDJSON, PDF).
+
+Ключ - хеш содержимого файлов версии и параметров расчёта (окно, зерно, метод распределения, формат),
+поэтому изменённая версия получает новые ключи, а одинаковые данные - те же. Записи - готовые тела ответов:
+попадание - это чтение файла. Объём ограничен RESULT_CACHE_BYTES: при записи вытесняются записи,
+которые дольше всего не читались. Записи пишутся через временный файл и rename - несколько процессов
+могут делить одну папку.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# Папка кеша (служебная папка рядом с сессиями - не видна в списках версий)
+RESULT_CACHE_FOLDER = os.environ.get("RESULT_CACHE_FOLDER", os.path.join("uploaded_files", ".results"))
+# Предел объёма кеша, по умолчанию 2 ГБ; 0 - кеш выключен
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 2 * 1024 ** 3))
+# Координаты центра окна округляются до этого числа знаков (5 знаков - около метра)
+RESULT_CACHE_PRECISION = int(os.environ.get("RESULT_CACHE_PRECISION", 5))
+# Меняется вместе с форматом ответов, чтобы старые записи не отдавались
+RESULT_CACHE_FORMAT = 1
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "pdf": "application/pdf",
+}
+
+
+def quantize(value):
+    """Координата центра окна, округлённая для ключа кеша (None остаётся None)"""
+    return None if value is None else round(float(value), RESULT_CACHE_PRECISION)
+
+
+class ResultCache:
+    """Кеш тел ответов в папке folder: файл <ключ>.<расширение>, время изменения - время последнего чтения"""
+
+    def __init__(self, folder=RESULT_CACHE_FOLDER, max_bytes=RESULT_CACHE_BYTES):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, kind, content, version, extension, **params):
+        """
+        Ключ записи: хеш содержимого версии content (см. catalog.Catalog.content_hash), версия, вид расчёта
+        и его параметры (lat/long уже округлены). extension (json, ndjson, pdf) задаёт тип ответа.
+        """
+        document = {
+            "format": RESULT_CACHE_FORMAT,
+            "kind": kind,
+            "content": content,
+            "version": version,
+            "params": params,
+        }
+        digest = hashlib.sha256(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{digest}.{extension}"
+
+    @staticmethod
+    def media_type(key):
+        return MEDIA_TYPES[key.rsplit(".", 1)[-1]]
+
+    def get(self, key):
+        """Тело ответа или None; прочитанная запись становится самой свежей для вытеснения"""
+        if not self.enabled:
+            return None
+        path = self.folder / key
+        try:
+            with open(path, "rb") as input:
+                body = input.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return body
+
+    def contains(self, key):
+        return self.enabled and (self.folder / key).exists()
+
+    def put(self, key, body):
+        """Сохраняет тело ответа и вытесняет старые записи сверх max_bytes. Ошибки диска не мешают ответу."""
+        if not self.enabled or len(body) > self.max_bytes or self.contains(key):
+            return
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            temporary = self.folder / f".{key}.{uuid.uuid4().hex}"
+            with open(temporary, "wb") as output:
+                output.write(body)
+            os.replace(temporary, self.folder / key)
+            self.evict()
+        except OSError as e:
+            print(f"Result cache entry {key} not saved: {e}")
+
+    def evict(self):
+        """Удаляет записи, которые дольше всего не читались, пока объём больше max_bytes"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.startswith("."):
+                    # Незавершённая запись другого процесса; брошенные удаляем через час
+                    try:
+                        if entry.stat().st_mtime < time.time() - 3600:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def stats(self):
+        entries = [entry.stat().st_size for entry in os.scandir(self.folder)
+                   if not entry.name.startswith(".")] if self.folder.exists() else []
+        return {"entries": len(entries), "bytes": sum(entries), "max_bytes": self.max_bytes}
+
+
+# Общий кеш процесса API
+results = ResultCache()
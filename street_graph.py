@@ -1,27 +1,37 @@
 # utils.py
 from shapely.geometry import Point, LineString
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from io import BytesIO
 import geopandas as gpd
 import networkx as nx
 from shapely.geometry import Point
 import numpy as np
+import pandas as pd
+import shapely
 import matplotlib.cm as cm
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
-from tqdm import tqdm
+from metrics import track
+from assignment import ASSIGNMENT_GAP, ASSIGNMENT_MAX_ITERATIONS, equilibrium_assignment
+from graph_engine import StreetGraph, ContractedGraph, NearestTargets, NODE_TYPES, haversine, paths_to, reconstruct_path, reconstruct_path_to
 
 # --- Create Graph from Streets ---
 def create_graph(streets):
     G = nx.DiGraph()
     nodes = set()
     for _, row in streets.iterrows():
-        coords = list(row.geometry.coords)
-        for start, end in zip(coords[:-1], coords[1:]):
-            distance = Point(start).distance(Point(end))
-            G.add_edge(start, end, weight=distance)
-            G.add_edge(end, start, weight=distance)
-            nodes.add(start)
-            nodes.add(end)
+        for line in getattr(row.geometry, "geoms", [row.geometry]):
+            coords = list(line.coords)
+            for start, end in zip(coords[:-1], coords[1:]):
+                distance = Point(start).distance(Point(end))
+                G.add_edge(start, end, weight=distance)
+                G.add_edge(end, start, weight=distance)
+                nodes.add(start)
+                nodes.add(end)
     return G, list(nodes)
 
 # --- Find nearest node ---
@@ -29,9 +39,22 @@ def find_nearest_node(point, tree, node_coords):
     dist, idx = tree.query((point.x, point.y))
     return tuple(node_coords[idx]), dist
 
+# --- Place coordinates (centroids for polygons) ---
+def place_points(places):
+    geometries = np.asarray(places.geometry.values, dtype=object)
+    return shapely.get_coordinates(shapely.centroid(geometries))
+
 # --- Add Places (houses, bus stops) to Graph ---
-def add_places_to_graph(places, G, tree, node_coords, place_type):
-    for _, place in tqdm(places.iterrows(), desc=f"Adding {place_type}", total=len(places)):
+def add_places_to_graph(places, G, tree, node_coords, place_type, points=None, snap=None):
+    """
+    Только для StreetGraph:
+    - points - готовые точки мест (например, центроиды из Dataset.house_points);
+    - snap - привязка к ближайшим отрезкам улиц (начала, концы, доли; см. Dataset.snap_places):
+      место соединяется с проекцией на отрезок, а не с ближайшей вершиной улицы.
+    """
+    if isinstance(G, StreetGraph):
+        return _add_places_to_street_graph(places, G, tree, node_coords, place_type, points, snap)
+    for _, place in track(places.iterrows(), loop=f"Adding {place_type}"):
         point = place.geometry.centroid if place_type == "house" else place.geometry
         nearest_node, dist = find_nearest_node(point, tree, node_coords)
         new_node = (point.x, point.y)
@@ -42,7 +65,87 @@ def add_places_to_graph(places, G, tree, node_coords, place_type):
             G.nodes[new_node]['total_people'] = place["Total_People"]
         else: 
             G.nodes[new_node]['total_people'] = 0
-        
+
+def _add_places_to_street_graph(places, G, tree, node_coords, place_type, points=None, snap=None):
+    """
+    Векторизованный вариант для StreetGraph: все места привязываются одним запросом -
+    к отрезкам улиц (snap, отрезки делятся вершинами привязки) или к KD-дереву вершин.
+    Каждое место получает собственную вершину, номера сохраняются в G.place_nodes[place_type],
+    а уличные вершины привязки - в G.snap_nodes[place_type].
+    """
+    if points is None:
+        points = place_points(places)
+    if snap is not None:
+        nearest = G.insert_points(*snap)
+    else:
+        _, nearest = tree.query(points)
+        nearest = np.asarray(nearest, dtype=np.int64)
+    if place_type == "house":
+        total_people = places["Total_People"].to_numpy(dtype=float)
+    else:
+        total_people = 0
+    new_nodes = G.add_nodes(points, NODE_TYPES[place_type], total_people)
+    distances = haversine(points[:, 0], points[:, 1], G.coords[nearest, 0], G.coords[nearest, 1])
+    G.add_edges(new_nodes, nearest, distances)
+    G.place_nodes[place_type] = new_nodes
+    G.snap_nodes[place_type] = nearest
+
+# --- Nearest stops ---
+def nearest_stop_routes(G):
+    """
+    Маршрут каждого дома G до ближайшей по сети остановки.
+    Возвращает ({координаты дома: точки пути или None}, ближайшая остановка каждой вершины или -1).
+    """
+    house_nodes = G.place_nodes['house']
+    routes = {}
+
+    # Одна дейкстра сразу от всех остановок (по обращённым рёбрам): каждая вершина получает
+    # ближайшую по сети остановку и предка на пути к ней, маршрут дома - проход по предкам
+    _, predecessors, nearest = G.nearest_source_tree(G.place_nodes['bus_stop'], reverse=True)
+    for house_node in house_nodes.tolist():
+        bus_node = nearest[house_node]
+        path = reconstruct_path_to(predecessors, house_node, bus_node) if bus_node >= 0 else None
+        # Если пути нет, записываем None
+        routes[G.node_key(house_node)] = G.path_keys(path) if path is not None else None
+    return routes, nearest
+
+# --- Stop catchments ---
+def stop_catchments(G, stop_of_node, house_nodes, people, stop_points):
+    """
+    Зоны обслуживания остановок по сети: stop_of_node - номер ближайшей по сети остановки
+    для каждой вершины G (-1 - ни одна не достижима), people - жители домов house_nodes.
+    Полигон зоны - объединение ячеек Вороного уличных вершин, отнесённых к остановке,
+    в пределах выпуклой оболочки вершин; жители - сумма по домам, чья вершина относится к остановке.
+    Возвращает список {"x", "y", "houses", "people", "polygon" (GeoJSON или None)} в порядке stop_points.
+    """
+    stop_points = np.asarray(stop_points, dtype=float).reshape(-1, 2)
+    stop_count = len(stop_points)
+    house_stop = stop_of_node[np.asarray(house_nodes, dtype=np.int64)]
+    served = house_stop >= 0
+    houses = np.bincount(house_stop[served], minlength=stop_count)
+    served_people = np.bincount(house_stop[served], weights=np.asarray(people, dtype=float)[served],
+                                minlength=stop_count)
+
+    polygons = [None] * stop_count
+    street = np.flatnonzero((G.node_type == NODE_TYPES["street"]) & (stop_of_node >= 0))
+    if len(street) > 1:
+        points = shapely.points(G.coords[street])
+        area = shapely.convex_hull(shapely.multipoints(points))
+        cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=area))
+        # Порядок ячеек не совпадает с порядком точек: каждая точка лежит внутри своей ячейки
+        cell, point = shapely.STRtree(points).query(cells, predicate="contains")
+        cell_stop = stop_of_node[street[point]]
+        clip = shapely.get_type_id(area) == shapely.GeometryType.POLYGON
+        for stop in np.unique(cell_stop).tolist():
+            polygon = shapely.coverage_union_all(cells[cell[cell_stop == stop]])
+            if clip:
+                polygon = shapely.intersection(polygon, area)
+            polygons[stop] = shapely.geometry.mapping(polygon)
+
+    return [
+        {"x": x, "y": y, "houses": int(count), "people": float(total), "polygon": polygon}
+        for (x, y), count, total, polygon in zip(stop_points.tolist(), houses, served_people, polygons)
+    ]
 
 # --- Compute paths and loads ---
 def compute_paths_and_loads(G, sources, targets):
@@ -51,7 +154,7 @@ def compute_paths_and_loads(G, sources, targets):
 
     edge_loads = {edge: 0 for edge in G.edges}
     
-    for source, target_flows in tqdm(flow_distribution.items(), desc="Calculating loads"):
+    for source, target_flows in track(flow_distribution.items(), loop="Calculating loads"):
         if source not in paths:
             continue
         for target, flow in target_flows.items():
@@ -66,6 +169,10 @@ def compute_paths_and_loads(G, sources, targets):
 
 # --- Update Edge Weights based on Loads ---
 def update_weights(G, edge_loads, capacity=300):
+    if isinstance(G, StreetGraph):
+        loads = G.edge_array(edge_loads)
+        G.set_weights(G.weights * (1 + loads / capacity * 2))
+        return
     for edge, load in edge_loads.items():
         weight = G[edge[0]][edge[1]]['weight']
         congestion = load / capacity
@@ -90,89 +197,142 @@ def update_weights(G, edge_loads, capacity=300):
 #     plt.title("Heatmap of Pedestrian Congestion")
 #     plt.show()
 
-def plot_heatmap(G, edge_loads, buses):
-    # Extract the load values
-    loads = np.array(list(edge_loads.values()))
-    norm = plt.Normalize(vmin=0, vmax=loads.max())
-    cmap = plt.cm.Reds
+def _edge_segments(G, edge_loads):
+    """
+    Отрезки рёбер (E x 2 x 2) и нагрузки (E) в порядке edge_loads.
+    Для StreetGraph берутся прямо из массивов графа, без обхода словаря.
+    """
+    if isinstance(G, StreetGraph) and len(edge_loads) == G.number_of_edges:
+        segments = np.stack([G.coords[G.sources], G.coords[G.indices]], axis=1)
+        return segments, G.edge_array(edge_loads), G.edge_keys()
+    keys = list(edge_loads.keys())
+    segments = np.array(keys, dtype=float).reshape(-1, 2, 2)
+    return segments, np.fromiter(edge_loads.values(), dtype=float, count=len(keys)), keys
 
-    # Увеличиваем размер изображения
-    fig, ax = plt.subplots(figsize=(20, 18))  # Увеличен размер до 24x18 дюймов
+def _heatmap_colors(loads, cmap=cm.Reds):
+    norm = plt.Normalize(vmin=0, vmax=loads.max() if len(loads) else 0)
+    return norm, cmap(norm(loads))
 
-    edge_colors = []
+def _edge_color_list(keys, loads, colors):
+    return [(u, v, load, tuple(color)) for (u, v), load, color in zip(keys, loads.tolist(), colors.tolist())]
 
-    for (u, v, data) in G.edges(data=True):
-        load = edge_loads[(u, v)]
-        color = cmap(norm(load))
-        edge_colors.append((u, v, load, color))
-        ax.plot([u[0], v[0]], [u[1], v[1]], color=color, linewidth=2)
+def heatmap_edge_colors(G, edge_loads):
+    """
+    Цвета рёбер тепловой карты без отрисовки: список (u, v, нагрузка, RGBA).
+    Палитра применяется сразу ко всему массиву нагрузок.
+    """
+    _, loads, keys = _edge_segments(G, edge_loads)
+    _, colors = _heatmap_colors(loads)
+    return _edge_color_list(keys, loads, colors)
 
-    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array([])  # Make the ScalarMappable a no-op
-    plt.colorbar(sm, ax=ax, label='Load Intensity')
-    plt.title("Heatmap of Pedestrian Congestion")
-    heatmap_path = 'heatmap_image.png'
-    plt.tight_layout()
+def _save_figure(fig, dpi):
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi)
+    buffer.seek(0)
+    return buffer
 
-    # Plot buses after the heatmap to ensure they're visible on top
+def plot_heatmap(G, edge_loads, buses, dpi=100, figsize=(20, 18)):
+    """
+    Рисует тепловую карту нагрузки рёбер одной коллекцией линий.
+    Возвращает (PNG в BytesIO, цвета рёбер как в heatmap_edge_colors).
+    """
+    segments, loads, keys = _edge_segments(G, edge_loads)
+    cmap = cm.Reds
+    norm, colors = _heatmap_colors(loads, cmap)
+
+    # Figure без pyplot: не трогает глобальное состояние и безопасна в потоках
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots()
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=2))
+    ax.autoscale_view()
+
+    sm = cm.ScalarMappable(cmap=cmap, norm=norm)
+    sm.set_array([])
+    fig.colorbar(sm, ax=ax, label='Load Intensity')
+    ax.set_title("Heatmap of Pedestrian Congestion")
+    fig.tight_layout()
+
+    # Остановки поверх тепловой карты
     buses.plot(ax=ax, color='green', markersize=10, label='Bus Stops', zorder=5)
+    ax.legend()
 
-    # Add legend and save the figure
-    plt.legend()
-    plt.savefig(heatmap_path, format='png')
+    return _save_figure(fig, dpi), _edge_color_list(keys, loads, colors)
 
-    plt.close(fig)
-    return heatmap_path, edge_colors
+# --- Population synthesis ---
+# Зерно генератора по умолчанию: одинаковые данные дают одинаковое население при каждом запросе
+POPULATION_SEED = 0
 
-# --- Calculate people in one apartment ---
-def calculate_people_in_apartment(mean=2, std_dev=1):
-    people = int(np.random.normal(mean, std_dev))
-    return max(1, min(people, 4))  # Limit to 1-4 people
+def normal_distribution(mean=2, std_dev=1):
+    """Распределение людей в квартире: нормальное, draw(rng, size) -> массив"""
+    return lambda rng, size: rng.normal(mean, std_dev, size)
 
-# --- Calculate total people in a house based on apartments ---
-def calculate_total_people_in_house(house, mean=2, std_dev=1):
+def generate_population(houses, seed=None, mean=2, std_dev=1, distributions=None, type_column=None):
     """
-    Рассчитывает общее количество людей в доме на основе количества квартир.
+    Рассчитывает общее количество людей в каждом доме по количеству квартир.
+    Все квартиры разыгрываются одним вызовом генератора на каждый тип дома.
     Параметры:
-    - house: строка датафрейма с данными о доме
-    - mean: среднее количество людей в квартире
-    - std_dev: стандартное отклонение для нормального распределения
+    - houses: GeoDataFrame с колонкой 'Apartments' (0 квартир считается как 10)
+    - seed: зерно numpy.random.Generator; None - каждый раз новое население
+    - mean, std_dev: нормальное распределение для домов без своего распределения
+    - distributions: словарь {тип дома: draw(rng, size)}, тип берётся из колонки type_column
     Возвращает:
-    - Общее количество людей в доме
+    - Массив людей по домам: в каждой квартире от 1 до 4 человек, плюс 30 на дом
     """
-    apartments = int(house['Apartments'])  # Количество квартир
-    if apartments == 0:
-        apartments = 10
-    total_people = sum([calculate_people_in_apartment(mean, std_dev) for _ in range(apartments)])+30  # Суммируем количество людей
-    return total_people
+    rng = np.random.default_rng(seed)
+    apartments = houses['Apartments'].to_numpy(dtype=float).astype(np.int64)
+    apartments[apartments == 0] = 10
+    apartments = np.maximum(apartments, 0)
+
+    default = normal_distribution(mean, std_dev)
+    if distributions and type_column is not None:
+        types = houses[type_column].to_numpy()
+        groups = [(distributions.get(kind, default), np.flatnonzero(types == kind)) for kind in pd.unique(types)]
+    else:
+        groups = [(default, np.arange(len(houses)))]
+
+    total_people = np.zeros(len(houses))
+    for draw, house_ids in groups:
+        counts = apartments[house_ids]
+        # Как int(): дробная часть отбрасывается, затем ограничение 1-4 человека
+        people = np.clip(draw(rng, int(counts.sum())).astype(np.int64), 1, 4)
+        total_people[house_ids] = np.bincount(np.repeat(np.arange(len(house_ids)), counts),
+                                              weights=people, minlength=len(house_ids))
+    return (total_people + 30).astype(np.int64)
 
 # --- Добавление столбца с количеством людей в домах ---
-def add_population_column_to_houses(houses, mean=2, std_dev=1):
+def add_population_column_to_houses(houses, mean=2, std_dev=1, seed=None, distributions=None, type_column=None):
     """
     Для каждого дома в датафрейме houses рассчитывает общее количество людей и добавляет новый столбец 'Total_People'.
-    Параметры:
-    - houses: GeoDataFrame с данными о домах
-    - mean: среднее количество людей в квартире
-    - std_dev: стандартное отклонение для нормального распределения
+    Параметры - как у generate_population.
     Возвращает:
     - GeoDataFrame с добавленным столбцом 'Total_People', содержащим количество людей в доме
     """
-    houses['Total_People'] = houses.apply(lambda row: calculate_total_people_in_house(row, mean, std_dev), axis=1)
+    houses['Total_People'] = generate_population(houses, seed, mean, std_dev, distributions, type_column)
     return houses
 
 # --- Calculate population for all houses in GeoDataFrame ---
-def calculate_population(houses, mean=2, std_dev=1):
+def calculate_population(houses, mean=2, std_dev=1, seed=None):
     if 'Apartments' in houses.columns:
-        houses['Total_People'] = houses.apply(lambda row: calculate_total_people_in_house(row, mean, std_dev), axis=1)
+        houses['Total_People'] = generate_population(houses, seed, mean, std_dev)
     else:
         print("Column 'Apartments' missing in data.")
     return houses
 
 # Внутри функции assign_routes_to_population
-def assign_routes_to_population(G, houses, buses, tree, node_coords):
+def assign_routes_to_population(G, houses, buses, tree, node_coords, batched=True):
     """
     Назначение маршрутов для населения, идущего от домов к ближайшим остановкам.
+    Параметры:
+    - batched: True - одна обратная дейкстра на каждую остановку, пути дом -> остановка
+      восстанавливаются из массивов предков; False - отдельный поиск для каждой пары дом-остановка
+    Результат в обоих режимах одинаковый (с точностью до выбора среди путей равной длины).
     """
+    if isinstance(G, StreetGraph) or batched:
+        graph, house_nodes, bus_nodes, people = _route_demand(G, houses, buses, tree, node_coords)
+        if batched:
+            return _routes_from_stop_trees(graph, house_nodes, bus_nodes, people)
+        return _routes_from_house_trees(graph, house_nodes, bus_nodes, people)
+
     route_distribution = {}
 
     # Итерация по домам
@@ -215,60 +375,184 @@ def assign_routes_to_population(G, houses, buses, tree, node_coords):
 
     return route_distribution
 
-def cpu_shortest_path_usage(houses, buses, G):
-    house_nodes = np.array([(c.x, c.y) for c in houses.geometry.centroid])
-    bus_nodes = np.array([(g.x, g.y) for g in buses.geometry])
-    
-    usage = defaultdict(int)
-    
-    for house_node in tqdm(house_nodes, desc="Calculating paths"):
-        distances = []
+def _route_demand(G, houses, buses, tree, node_coords):
+    """
+    Граф StreetGraph (G или его копия из networkx), уличные вершины домов и остановок
+    и число людей, идущих от каждого дома к остановкам.
+    """
+    graph = G if isinstance(G, StreetGraph) else StreetGraph.from_networkx(G)
+    if "house" in graph.snap_nodes and "bus_stop" in graph.snap_nodes:
+        # Места уже привязаны к улицам в add_places_to_graph - повторный поиск не нужен
+        house_nodes, bus_nodes = graph.snap_nodes["house"], graph.snap_nodes["bus_stop"]
+        people = houses['Total_People'].to_numpy() * 0.51 / 60
+        return graph, np.atleast_1d(house_nodes), np.atleast_1d(bus_nodes), people
+    _, house_indices = tree.query(place_points(houses))
+    _, bus_indices = tree.query(place_points(buses))
+    if graph is G:
+        house_nodes, bus_nodes = house_indices, bus_indices
+    else:
+        # Номера вершин KD-дерева переводим в номера вершин StreetGraph
+        index = graph.node_index
+        house_nodes = np.array([index[tuple(node_coords[i])] for i in house_indices], dtype=np.int64)
+        bus_nodes = np.array([index[tuple(node_coords[i])] for i in bus_indices], dtype=np.int64)
+    people = houses['Total_People'].to_numpy() * 0.51 / 60
+    return graph, np.atleast_1d(house_nodes), np.atleast_1d(bus_nodes), people
+
+def _route_info(G, path, total_people):
+    return {
+        'path': G.path_keys(path),
+        'nodes': np.array(path),
+        'total_people': total_people
+    }
+
+def _routes_from_house_trees(G, house_nodes, bus_nodes, people):
+    """Одна дейкстра из каждого дома, пути до всех остановок берутся из массива предков."""
+    route_distribution = {}
+
+    for house_node, total_people in zip(house_nodes, people):
+        _, predecessors = G.shortest_path_tree(house_node)
         for bus_node in bus_nodes:
-            try:
-                length = nx.shortest_path_length(G, source=tuple(house_node), target=tuple(bus_node), weight='weight')
-                distances.append((bus_node, length))
-            except nx.NetworkXNoPath:
+            path = reconstruct_path(predecessors[0], house_node, bus_node)
+            if path is None:
                 continue
-        
-        nearest_stops = sorted(distances, key=lambda x: x[1])[:2]
-        
-        for bus_node, _ in nearest_stops:
-            path = nx.shortest_path(G, source=tuple(house_node), target=tuple(bus_node), weight='weight')
-            for start, end in zip(path[:-1], path[1:]):
-                usage[(start, end)] += 1
-    
+            route_distribution[(G.node_key(house_node), G.node_key(bus_node))] = _route_info(G, path, total_people)
+
+    return route_distribution
+
+def _routes_from_stop_trees(G, house_nodes, bus_nodes, people):
+    """
+    Пакетный режим: обратная дейкстра из каждой остановки (один вызов на все остановки)
+    по графу со стянутыми цепочками; пути разворачиваются обратно в вершины G.
+    predecessors[j][v] - следующая вершина на пути от v к остановке j.
+    """
+    route_distribution = {}
+    if len(house_nodes) == 0 or len(bus_nodes) == 0:
+        return route_distribution
+
+    routing = ContractedGraph(G, keep=np.concatenate((house_nodes, bus_nodes)))
+    stops, stop_rows = np.unique(bus_nodes, return_inverse=True)
+    _, predecessors = routing.graph.shortest_path_tree(routing.index[stops], reverse=True)
+
+    # Дерево каждой остановки разворачивается в вершины G один раз, пути всех домов до неё
+    # проходятся одновременно - без восстановления и разворота пути на каждую пару
+    houses, house_rows = np.unique(house_nodes, return_inverse=True)
+    stop_paths = [paths_to(routing.expand_tree(predecessors[row]), houses, stop) for row, stop in enumerate(stops)]
+
+    # Порядок обхода тот же, что в попарном режиме, чтобы совпадали и ключи, и перезаписи
+    for house_node, house_row, total_people in zip(house_nodes, house_rows.ravel(), people):
+        for bus_node, row in zip(bus_nodes, stop_rows.ravel()):
+            paths, lengths = stop_paths[row]
+            if not lengths[house_row]:
+                continue
+            path = paths[house_row, :lengths[house_row]]
+            route_distribution[(G.node_key(house_node), G.node_key(bus_node))] = _route_info(G, path, total_people)
+
+    return route_distribution
+
+def cpu_shortest_path_usage(houses, buses, G, k=2, workers=None):
+    """
+    Считает, сколько раз каждое ребро входит в пути от домов до k ближайших по сети остановок.
+    Для каждого дома выполняется одна дейкстра, которая останавливается на k-й найденной остановке;
+    поиск идёт по графу со стянутыми цепочками, счётчики разворачиваются обратно на рёбра G.
+    Параметры:
+    - k: количество ближайших остановок для каждого дома
+    - workers: количество процессов для ProcessPoolExecutor; None - считать в текущем процессе
+    Возвращает:
+    - defaultdict {(начало ребра, конец ребра): количество путей}
+    """
+    if isinstance(G, StreetGraph):
+        graph = G
+        house_nodes = G.place_nodes["house"]
+        bus_nodes = G.place_nodes["bus_stop"]
+    else:
+        graph = StreetGraph.from_networkx(G)
+        index = graph.node_index
+        house_nodes = [index[tuple(point)] for point in place_points(houses).tolist()]
+        bus_nodes = [index[(g.x, g.y)] for g in buses.geometry]
+    house_nodes = np.asarray(house_nodes, dtype=np.int64)
+    bus_nodes = np.asarray(bus_nodes, dtype=np.int64)
+    routing = ContractedGraph(graph, keep=np.concatenate((house_nodes, bus_nodes)))
+    house_nodes, bus_nodes = routing.index[house_nodes], routing.index[bus_nodes]
+
+    if workers and workers > 1 and len(house_nodes) > 1:
+        counts = Counter()
+        chunks = np.array_split(house_nodes, min(len(house_nodes), workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_usage_worker,
+                                 initargs=(routing.graph, bus_nodes)) as executor:
+            for part in executor.map(_usage_worker, chunks, repeat(k)):
+                counts.update(part)
+    else:
+        search = NearestTargets(routing.graph, bus_nodes)
+        counts = _count_path_usage(search, track(house_nodes, loop="Calculating paths"), k)
+
+    # Пары вершин стянутого графа -> его рёбра -> рёбра G
+    edge_counts = np.zeros(routing.graph.number_of_edges)
+    if counts:
+        pairs = np.array(list(counts.keys()), dtype=np.int64)
+        np.add.at(edge_counts, routing.graph.edge_ids(pairs[:, 0], pairs[:, 1]), list(counts.values()))
+    edge_counts = routing.expand_loads(edge_counts)
+
+    usage = defaultdict(int)
+    sources = graph.sources
+    for edge in np.flatnonzero(edge_counts):
+        usage[(graph.node_key(sources[edge]), graph.node_key(graph.indices[edge]))] += int(edge_counts[edge])
+
     return usage
 
+def _count_path_usage(search, house_nodes, k):
+    counts = Counter()
+    for house_node in house_nodes:
+        for _, _, path in search.search(int(house_node), k):
+            counts.update(zip(path[:-1], path[1:]))
+    return counts
+
+# Поиск для процессов пула: граф передаётся один раз при запуске процесса
+_worker_search = None
+
+def _init_usage_worker(graph, bus_nodes):
+    global _worker_search
+    _worker_search = NearestTargets(graph, bus_nodes)
+
+def _usage_worker(house_nodes, k):
+    return _count_path_usage(_worker_search, house_nodes, k)
+
 # Визуализация результата
-def plot_street_usage(streets, street_usage, houses, buses):
-    fig, ax = plt.subplots(figsize=(12, 12))
+def plot_street_usage(streets, street_usage, houses, buses, dpi=100, figsize=(12, 12)):
+    """Рисует использование улиц маршрутами одной коллекцией линий, возвращает PNG в BytesIO"""
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots()
     streets.plot(ax=ax, color='lightgray', linewidth=0.5)
-    
-    max_usage = max(street_usage.values())
-    for (start, end), usage in street_usage.items():
-        line = LineString([start, end])
-        usage_norm = usage / max_usage
-        gpd.GeoSeries([line]).plot(ax=ax, color=cm.viridis(usage_norm), linewidth=2)
-    
+
+    if street_usage:
+        segments = np.array(list(street_usage.keys()), dtype=float).reshape(-1, 2, 2)
+        usage = np.fromiter(street_usage.values(), dtype=float, count=len(street_usage))
+        ax.add_collection(LineCollection(segments, colors=cm.viridis(usage / usage.max()), linewidths=2))
+        ax.autoscale_view()
+
     houses.plot(ax=ax, color='blue', markersize=10, label='Houses')
     buses.plot(ax=ax, color='red', markersize=10, label='Bus Stops')
-    plt.legend()
-    route_path = "routes.png"
-    plt.savefig(route_path, format='png')
-
-    plt.close(fig)
-    return route_path
+    ax.legend()
+    return _save_figure(fig, dpi)
 
 def calculate_population_loads(G, route_distribution):
     """
     Рассчитывает нагрузку на ребра графа на основе распределения маршрутов от домов к остановкам.
     Каждый маршрут имеет количество людей, идущих по пути.
     """
+    if isinstance(G, StreetGraph):
+        loads = np.zeros(G.number_of_edges)
+        for route_info in track(route_distribution.values(), loop="Calculating loads"):
+            nodes = route_info.get('nodes')
+            if nodes is None:
+                nodes = [G.node_index[point] for point in route_info['path']]
+            np.add.at(loads, G.path_edge_ids(nodes), route_info['total_people'])
+        return G.edge_dict(loads)
+
     # Словарь для хранения нагрузки на ребра
     edge_loads = {edge: 0 for edge in G.edges}
     
     # Итерация по маршрутам в route_distribution
-    for (house_node, bus_stop_node), route_info in tqdm(route_distribution.items(), desc="Calculating loads"):
+    for (house_node, bus_stop_node), route_info in track(route_distribution.items(), loop="Calculating loads"):
         path = route_info['path']
         total_people = route_info['total_people']
         
@@ -281,6 +565,23 @@ def calculate_population_loads(G, route_distribution):
         
     return edge_loads
 
+def calculate_equilibrium_loads(G, houses, buses, tree, node_coords, capacity=300, method="frank_wolfe",
+                                max_iterations=ASSIGNMENT_MAX_ITERATIONS, gap=ASSIGNMENT_GAP):
+    """
+    Нагрузка на рёбра при равновесном распределении (см. assignment.equilibrium_assignment)
+    вместо однократного update_weights по нагрузке кратчайших путей.
+    Веса G после расчёта соответствуют итоговой нагрузке.
+    Возвращает (словарь {(u, v): нагрузка}, сведения о сходимости).
+    """
+    graph, house_nodes, bus_nodes, people = _route_demand(G, houses, buses, tree, node_coords)
+    loads, info = equilibrium_assignment(graph, house_nodes, people, bus_nodes, capacity, method, max_iterations, gap)
+    edge_loads = graph.edge_dict(loads)
+    if graph is not G:
+        # Веса networkx-графа обновляем по тем же стоимостям
+        for (u, v), weight in graph.edge_dict(graph.weights).items():
+            G[u][v]['weight'] = weight
+    return edge_loads, info
+
 def summarize_traffic_data(G, edge_loads, route_distribution, buses):
     """
     Возвращает сводную аналитику по загруженности дорог, основанной на информации о маршрутах и нагрузках.
@@ -297,14 +598,15 @@ def summarize_traffic_data(G, edge_loads, route_distribution, buses):
       3. Количество перегруженных участков дорог (нагрузка > 800)
       4. Наибольший загруженный участок (длина самого длинного перегруженного участка)
     """
-    # 1. Количество участков дорог
-    edges = len(route_distribution)
-
-    num_bus_stops = buses.shape[0]
-    
     # 2. Сумма людей, которые прошли по дорогам
     total_people = sum(route_info['total_people'] for route_info in route_distribution.values())
+    return traffic_summary(buses.shape[0], len(route_distribution), total_people, edge_loads)
 
+def traffic_summary(num_bus_stops, routes_count, total_people, edge_loads):
+    """
+    Сводка по уже посчитанным величинам: число остановок, число маршрутов дом-остановка,
+    сумма людей по маршрутам и нагрузка рёбер (см. summarize_traffic_data).
+    """
     # 3. Количество перегруженных участков дорог (нагрузка на участке больше 800)
     overloaded_edges_count = sum(1 for load in edge_loads.values() if load > 800)
 
@@ -323,7 +625,8 @@ def summarize_traffic_data(G, edge_loads, route_distribution, buses):
         "total_people": total_people,    # Сумма людей, которые прошли по дорогам
         "overloaded_edges_count": overloaded_edges_count,  # Количество перегруженных участков дорог
         "longest_overloaded_edge_length": longest_overloaded_edge_length,  # Длина самого длинного перегруженного участка
-        "sytem_score": (edges - overloaded_edges_count) / edges
+        # Без маршрутов (нет остановок в окне) оценивать нечего
+        "sytem_score": (routes_count - overloaded_edges_count) / routes_count if routes_count else None
     }
     
     return summary
@@ -0,0 +1,7 @@
+# tests/conftest.py
+import os
+import sys
+
+# Модули лежат в корне репозитория, синтетический город - в benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
@@ -0,0 +1,122 @@
+# tests/test_catalog.py
+"""
+Каталог версий на SQLite во временной папке: запись наборов после загрузки, сверка версии с папкой,
+удаление версии и импорт сессий, созданных до каталога (metadata.json).
+"""
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+from sqlalchemy import func, select
+
+from catalog import Catalog, Dataset, DatasetFile, content_hash_of, file_sha256
+
+SESSION = "session"
+POINTS = [(37.49, 55.55), (37.5, 55.56), (37.51, 55.555)]
+
+
+def write_layer(folder, name="stations", points=POINTS):
+    folder.mkdir(parents=True, exist_ok=True)
+    frame = gpd.GeoDataFrame({"name": [str(i) for i in range(len(points))]},
+                             geometry=[Point(point) for point in points], crs="EPSG:4326")
+    frame.to_file(folder / f"{name}.shp")
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return Catalog(url=f"sqlite:///{tmp_path / 'catalog.sqlite'}", root=str(tmp_path / "sessions"))
+
+
+@pytest.fixture
+def root(catalog):
+    return Path(catalog.root)
+
+
+def count(catalog, model):
+    with catalog._transaction() as db:
+        return db.execute(select(func.count()).select_from(model)).scalar_one()
+
+
+def test_record_dataset(catalog, root):
+    folder = root / SESSION / "v1" / "stations"
+    write_layer(folder)
+    catalog.record_dataset(SESSION, "v1", "stations")
+
+    dataset = catalog.describe(SESSION)["v1"]["datasets"]["stations"]
+    assert dataset["feature_count"] == len(POINTS)
+    assert dataset["bbox"] == pytest.approx([37.49, 55.55, 37.51, 55.56])
+    assert [file["name"] for file in dataset["files"]] == sorted(path.name for path in folder.iterdir())
+    for file in dataset["files"]:
+        assert file["size"] == (folder / file["name"]).stat().st_size
+        assert file["sha256"] == file_sha256(folder / file["name"])
+    assert [entry["version"] for entry in catalog.versions(SESSION)] == ["v1"]
+
+    # sha256 от загрузки не пересчитывается, если размер файла совпадает
+    shp = folder / "stations.shp"
+    catalog.record_dataset(SESSION, "v1", "stations", [{"name": "stations.shp", "size": shp.stat().st_size,
+                                                        "sha256": "uploaded"}])
+    files = catalog.describe(SESSION)["v1"]["datasets"]["stations"]["files"]
+    assert {file["name"]: file["sha256"] for file in files}["stations.shp"] == "uploaded"
+    assert count(catalog, Dataset) == 1
+
+
+def test_sync_version(catalog, root):
+    version = root / SESSION / "v1"
+    write_layer(version / "stations")
+    write_layer(version / "metro", "metro", POINTS[:1])
+    (version / ".tiles").mkdir()
+
+    content_hash = catalog.sync_version(SESSION, "v1")
+    assert catalog.files(SESSION, "v1")["v1"].keys() == {"metro", "stations"}
+    assert catalog.content_hash(SESSION, "v1") == content_hash
+    expected = {name: [{"name": path.name, "size": path.stat().st_size, "sha256": file_sha256(path)}
+                       for path in (version / name).iterdir()] for name in ("metro", "stations")}
+    assert content_hash == content_hash_of(expected)
+
+    # Изменённый слой меняет хеш, удалённый набор пропадает из каталога
+    write_layer(version / "stations", points=POINTS[:2])
+    shutil.rmtree(version / "metro")
+    changed = catalog.content_hash(SESSION, "v1")
+    assert changed != content_hash
+    assert catalog.files(SESSION, "v1")["v1"].keys() == {"stations"}
+    assert catalog.describe(SESSION, "v1")["v1"]["datasets"]["stations"]["feature_count"] == 2
+    assert catalog.sync_version(SESSION, "v1") == changed
+
+
+def test_delete_version(catalog, root):
+    for version in ("v1", "v2"):
+        write_layer(root / SESSION / version / "stations")
+        catalog.sync_version(SESSION, version)
+    files = count(catalog, DatasetFile)
+
+    catalog.delete_version(SESSION, "v1")
+    assert [entry["version"] for entry in catalog.versions(SESSION)] == ["v2"]
+    assert count(catalog, Dataset) == 1
+    assert count(catalog, DatasetFile) == files // 2
+    # Удаление отсутствующей версии - не ошибка
+    catalog.delete_version(SESSION, "missing")
+
+
+def test_import_session(catalog, root):
+    session = root / SESSION
+    for version in ("v1", "v2"):
+        write_layer(session / version / "stations")
+    (session / ".service").mkdir()
+    with open(session / "metadata.json", "w") as output:
+        json.dump({"v2": {"created_at": "2020-01-02T03:04:05"}}, output)
+
+    # Первое обращение к сессии без версий в каталоге заносит её папки
+    versions = catalog.versions(SESSION)
+    assert [entry["version"] for entry in versions] == ["v2", "v1"]
+    assert versions[0]["created_at"] == datetime(2020, 1, 2, 3, 4, 5).isoformat()
+    stations = sorted(path.name for path in (session / "v1" / "stations").iterdir())
+    assert catalog.files(SESSION)["v1"] == {"stations": stations}
+
+    # Повреждённый metadata.json не мешает импорту
+    (session / "metadata.json").write_text("{")
+    assert catalog.import_session(SESSION) == 2
+    assert catalog.import_session("missing") == 0
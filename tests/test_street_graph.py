@@ -0,0 +1,68 @@
+# tests/test_street_graph.py
+"""
+Пакетное назначение маршрутов (обратная дейкстра из каждой остановки) против исходного попарного
+поиска nx.shortest_path на окне default_data - для графа networkx и для StreetGraph.
+"""
+from pathlib import Path
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+
+from graph_engine import create_street_graph
+from street_graph import assign_routes_to_population, create_graph
+
+DEFAULT_DATA = Path(__file__).resolve().parent.parent / "default_data"
+
+# Окно по умолчанию пайплайна: радиус - в метрах EPSG:3857
+LAT, LONG, RADIUS = 55.555, 37.495, 1000
+
+
+def read_layer(layer):
+    return gpd.read_file(next((DEFAULT_DATA / layer).glob("*.shp")))
+
+
+def clip(frame):
+    center = gpd.GeoSeries([Point(LONG, LAT)], crs="EPSG:4326").to_crs(epsg=3857)[0]
+    projected = frame.to_crs(epsg=3857)
+    return frame.to_crs(epsg=4326)[projected.distance(center).to_numpy() <= RADIUS].reset_index(drop=True)
+
+
+@pytest.fixture(scope="module")
+def window():
+    houses, buses, streets = (clip(read_layer(layer)) for layer in ("buildings", "stations", "streets"))
+    # В default_data нет атрибутов домов - население разыгрывается
+    houses["Total_People"] = np.random.default_rng(0).integers(30, 300, len(houses))
+    return houses, buses, streets
+
+
+def networkx_graph(G):
+    """Граф networkx с теми же вершинами и весами рёбер, что у StreetGraph"""
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from(zip(G.path_keys(G.sources), G.path_keys(G.indices), G.weights.tolist()))
+    return graph
+
+
+@pytest.mark.parametrize("engine", ["networkx", "street_graph"])
+def test_batched_routes_match_per_pair(window, engine):
+    houses, buses, streets = window
+    if engine == "networkx":
+        G, node_coords = create_graph(streets)
+        reference = G
+    else:
+        G, node_coords = create_street_graph(streets)
+        reference = networkx_graph(G)
+    tree = cKDTree(node_coords)
+    batched = assign_routes_to_population(G, houses, buses, tree, node_coords, batched=True)
+    # Исходный попарный поиск nx.shortest_path по графу networkx
+    per_pair = assign_routes_to_population(reference, houses, buses, tree, node_coords, batched=False)
+
+    assert batched
+    # Тот же порядок ключей - значит и те же перезаписи у домов с общей вершиной
+    assert list(batched) == list(per_pair)
+    for key, route in batched.items():
+        assert route["path"] == per_pair[key]["path"], key
+        assert route["total_people"] == per_pair[key]["total_people"], key
@@ -0,0 +1,149 @@
+# tests/test_what_if.py
+"""
+Analysis против окна Pipeline на синтетическом городе: нагрузки, сводка и маршруты до ближайших
+остановок должны совпадать с полным пересчётом без правок и после каждой правки.
+"""
+import numpy as np
+import pytest
+
+from analysis_pipeline import Pipeline
+from dataset_cache import Dataset
+from graph_engine import NODE_TYPES
+from street_graph import (POPULATION_SEED, assign_routes_to_population, calculate_population_loads,
+                          generate_population, nearest_stop_routes, summarize_traffic_data)
+from synthetic import grid_city
+from what_if import Analysis, apply_edits
+
+# Окно на весь город: радиус - в метрах EPSG:3857, на этой широте они почти вдвое короче настоящих
+BLOCKS = 6
+LAT, LONG, RADIUS = 55.55, 37.5, BLOCKS * 200
+
+EDITS = ["add_building", "remove_building", "add_stop", "move_stop", "remove_stop", "close_segment", "open_segment"]
+
+
+class FixedPopulationDataset(Dataset):
+    """Население домов берётся из анализа (у добавленных домов оно своё)"""
+
+    def population(self, seed=POPULATION_SEED):
+        return self.houses['Total_People']
+
+
+@pytest.fixture
+def city():
+    # Сдвиг перекрёстков убирает равные по длине пути, иначе выбор среди них зависит от порядка обхода
+    houses, buses, streets = grid_city(BLOCKS, lat=LAT, long=LONG, jitter=0.2, seed=1)
+    houses["Total_People"] = generate_population(houses, POPULATION_SEED)
+    return houses, buses, streets
+
+
+@pytest.fixture
+def analysis(city):
+    houses, buses, streets = city
+    return Analysis.from_pipeline(Pipeline(FixedPopulationDataset(houses, buses, streets), LAT, LONG, RADIUS))
+
+
+def pipeline_result(analysis, streets):
+    """Нагрузки, сводка и маршруты окна Pipeline по текущим домам, остановкам и закрытым участкам анализа"""
+    pipeline = Pipeline(FixedPopulationDataset(analysis.houses, analysis.buses, streets), LAT, LONG, RADIUS,
+                        analysis.seed)
+    houses, buses, _ = pipeline.window()
+    G, tree, node_coords = pipeline.graph()
+    # Закрытые участки - по координатам концов среди уличных вершин (точки мест могут с ними совпадать)
+    closed = sorted(analysis.closed)
+    street_nodes = np.flatnonzero(G.node_type == NODE_TYPES["street"])
+    index = dict(zip(map(tuple, G.coords[street_nodes].tolist()), street_nodes.tolist()))
+    weights = G.weights.copy()
+    weights[G.edge_ids([index[analysis.G.node_key(u)] for u in analysis.G.sources[closed].tolist()],
+                       [index[analysis.G.node_key(v)] for v in analysis.G.indices[closed].tolist()])] = np.inf
+    G.set_weights(weights)
+    route_distribution = assign_routes_to_population(G, houses, buses, tree, node_coords)
+    edge_loads = calculate_population_loads(G, route_distribution)
+    summary = summarize_traffic_data(G, edge_loads, route_distribution, buses)
+    routes, _ = nearest_stop_routes(G)
+    return edge_loads, summary, routes
+
+
+def assert_matches_pipeline(analysis, streets):
+    edge_loads, summary, routes = pipeline_result(analysis, streets)
+    incremental = analysis.edge_loads()
+    assert incremental.keys() == edge_loads.keys()
+    # Номера вершин у анализа и пересчёта разные - сравниваем по ключам рёбер
+    assert list(incremental.values()) == pytest.approx([edge_loads[edge] for edge in incremental], abs=1e-6)
+    current = analysis.summary()
+    assert current.keys() == summary.keys()
+    for key, value in summary.items():
+        assert current[key] == (pytest.approx(value) if value is not None else None), key
+    assert analysis.routes() == routes
+
+
+def make_edit(analysis, op, rng, bounds):
+    x0, y0, x1, y1 = bounds
+    x, y = float(rng.uniform(x0, x1)), float(rng.uniform(y0, y1))
+    if op == "add_building":
+        return {"op": op, "x": x, "y": y, "apartments": int(rng.integers(1, 200))}
+    if op == "remove_building":
+        return {"op": op, "id": int(rng.choice(analysis.houses.index))}
+    if op == "add_stop":
+        return {"op": op, "x": x, "y": y}
+    if op == "move_stop":
+        return {"op": op, "id": int(rng.choice(analysis.buses.index)), "x": x, "y": y}
+    if op == "remove_stop":
+        return {"op": op, "id": int(rng.choice(analysis.buses.index))}
+    if op == "close_segment":
+        # Участок улицы, по которому идут маршруты, - иначе закрытие ничего не меняет
+        street = analysis.G.node_type == NODE_TYPES["street"]
+        used = street[analysis.G.sources] & street[analysis.G.indices] & (analysis.loads > 0)
+        edge = int(rng.choice(np.flatnonzero(used)))
+    else:
+        edge = int(rng.choice(sorted(analysis.closed)))
+    return {"op": op, "start": analysis.G.node_key(analysis.G.sources[edge]),
+            "end": analysis.G.node_key(analysis.G.indices[edge])}
+
+
+def test_no_edits(analysis, city):
+    assert_matches_pipeline(analysis, city[2])
+
+
+@pytest.mark.parametrize("op", EDITS)
+def test_single_edit(analysis, city, op):
+    rng = np.random.default_rng(EDITS.index(op))
+    bounds = city[2].total_bounds
+    if op == "open_segment":
+        analysis.apply(make_edit(analysis, "close_segment", rng, bounds))
+    analysis.apply(make_edit(analysis, op, rng, bounds))
+    assert_matches_pipeline(analysis, city[2])
+
+
+def test_edit_sequence(analysis, city):
+    rng = np.random.default_rng(0)
+    bounds = city[2].total_bounds
+    for op in EDITS * 3:
+        analysis.apply(make_edit(analysis, op, rng, bounds))
+        assert_matches_pipeline(analysis, city[2])
+
+
+def test_failed_batch_is_rolled_back(analysis, city):
+    before = analysis.result()
+    rng = np.random.default_rng(1)
+    bounds = city[2].total_bounds
+    # Пакет составляется до применения - open_segment в нём не нужен (нечего открывать)
+    edits = [make_edit(analysis, op, rng, bounds) for op in EDITS if op != "open_segment"]
+    edits.append({"op": "remove_building", "id": 10 ** 9})
+    with pytest.raises(KeyError) as error:
+        apply_edits(analysis, edits)
+    assert error.value.args[0] == f"Edit {len(edits) - 1}: House {10 ** 9} not found"
+    assert analysis.result() == before
+    # Состояние после отката согласовано: следующие правки считаются как обычно
+    for op in EDITS:
+        apply_edits(analysis, [make_edit(analysis, op, rng, bounds)])
+        assert_matches_pipeline(analysis, city[2])
+
+
+def test_edit_errors(analysis):
+    with pytest.raises(KeyError) as error:
+        apply_edits(analysis, [{"op": "close_segment", "start": [0.0, 0.0], "end": [1.0, 1.0]}])
+    assert error.value.args[0] == "Edit 0: Segment [0.0, 0.0] - [1.0, 1.0] not found"
+    with pytest.raises(ValueError, match="Edit 0: remove_stop needs id"):
+        apply_edits(analysis, [{"op": "remove_stop"}])
+    with pytest.raises(ValueError, match="Edit 0: Unknown edit"):
+        apply_edits(analysis, [{"op": "rename"}])
@@ -0,0 +1,366 @@
+# tiles.py
+"""
+Предрасчёт маршрутов и нагрузок всей версии по плиткам: окно вокруг любой точки собирается
+из готовых плиток за миллисекунды, без построения графа.
+
+Версия делится на квадраты TILE_SIZE (метры EPSG:3857, как radius окна). Дома плитки (ядро) идут
+ко всем остановкам в TILE_RADIUS от её центра - как в окне, построенном вокруг плитки; пути ищутся
+по улицам в TILE_RADIUS + TILE_HALO от центра (ореол). Плитка хранит только вклад своих домов:
+маршруты до ближайшей по сети остановки, число маршрутов и людей и нагрузку рёбер от их путей, -
+поэтому соседние плитки складываются без двойного счёта.
+
+Граф строится один раз по всей версии, каждая плитка считается на его подграфе. Хеш подграфа
+(улицы ореола с точками привязки, дома ядра с населением, остановки) - ключ результата плитки:
+повторный предрасчёт пересчитывает только плитки, у которых изменились входы.
+
+Окно собирается из плиток, чьи центры попали в круг radius вокруг точки (если таких нет - из плитки
+с самой точкой): дома и маршруты - этих плиток, нагрузка - их сумма, рёбра и остановки - в круге.
+Зон обслуживания остановок в таком ответе нет. Ответ приближённый (дома и остановки выбираются иначе,
+чем в окне), поэтому get_routes отдаёт его только по явному source=tiles.
+
+Папка TILE_FOLDER внутри версии (служебная, в отпечаток файлов не входит):
+- cache/<хеш>.npz - результаты отдельных плиток;
+- store/ - manifest.json (формат, отпечаток исходных файлов, зерно, параметры, хеши плиток)
+  и массивы всех плиток подряд; заменяется целиком в конце предрасчёта.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+import metrics
+from compact_format import compact_result
+from data_process_new import routes_result
+from dataset_cache import datasets, dataset_fingerprint
+from graph_engine import NODE_TYPES, concat_ranges, create_street_graph
+from street_graph import (POPULATION_SEED, add_places_to_graph, assign_routes_to_population,
+                          calculate_population_loads, heatmap_edge_colors, nearest_stop_routes, traffic_summary)
+
+TILE_FOLDER = ".tiles"
+TILE_FORMAT = 1
+# Сторона плитки, радиус остановок вокруг её центра и запас улиц для путей, м (EPSG:3857)
+TILE_SIZE = float(os.environ.get("TILE_SIZE", 250))
+TILE_RADIUS = float(os.environ.get("TILE_RADIUS", 1000))
+TILE_HALO = float(os.environ.get("TILE_HALO", 500))
+# Сколько прочитанных хранилищ плиток держать в процессе
+TILE_STORE_CACHE_SIZE = int(os.environ.get("TILE_STORE_CACHE_SIZE", 4))
+
+
+def _to_3857(points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if not len(points):
+        return np.zeros((0, 2))
+    return shapely.get_coordinates(gpd.GeoSeries(shapely.points(points), crs="EPSG:4326").to_crs(epsg=3857).values)
+
+def _ranges(offsets, numbers):
+    """Номера элементов offsets[i]:offsets[i + 1] для всех i из numbers, подряд"""
+    return concat_ranges(offsets[numbers], offsets[numbers + 1])
+
+def _within(tree, center, radius):
+    """Номера точек дерева в круге radius вокруг center, по возрастанию"""
+    if tree is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(np.asarray(tree.query_ball_point(center, radius), dtype=np.int64))
+
+
+# --- Tile computation ---
+def _tile_graph(G, rows, stops, street_nodes, street_tree, center):
+    """Подграф плитки: улицы ореола, дома ядра rows и остановки stops с их вершинами привязки"""
+    halo = street_nodes[street_tree.query_ball_point(center, TILE_RADIUS + TILE_HALO)]
+    places = [G.place_nodes["house"][rows], G.snap_nodes["house"][rows],
+              G.place_nodes["bus_stop"][stops], G.snap_nodes["bus_stop"][stops]]
+    sub, nodes = G.subgraph(np.concatenate([halo] + places))
+    house_nodes, house_snap, bus_nodes, bus_snap = (np.searchsorted(nodes, ids) for ids in places)
+    sub.place_nodes = {"house": house_nodes, "bus_stop": bus_nodes}
+    sub.snap_nodes = {"house": house_snap, "bus_stop": bus_snap}
+    return sub
+
+def _tile_hash(sub):
+    digest = hashlib.sha1(json.dumps([TILE_FORMAT, TILE_RADIUS, TILE_HALO]).encode())
+    for array in (sub.coords, sub.indptr, sub.indices, sub.weights, sub.node_type, sub.total_people,
+                  sub.place_nodes["house"], sub.snap_nodes["house"],
+                  sub.place_nodes["bus_stop"], sub.snap_nodes["bus_stop"]):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def _compute_tile(sub, houses, buses):
+    """Вклад домов ядра: их маршруты до ближайшей остановки, число маршрутов, люди и нагрузка рёбер"""
+    routes, _ = nearest_stop_routes(sub)
+    house_routes = [routes[sub.node_key(node)] or [] for node in sub.place_nodes["house"].tolist()]
+    route_distribution = assign_routes_to_population(sub, houses, buses, None, None)
+    loads = sub.edge_array(calculate_population_loads(sub, route_distribution))
+    edges = np.flatnonzero(loads)
+    return {
+        "house_points": sub.coords[sub.place_nodes["house"]],
+        "route_offsets": np.concatenate(([0], np.cumsum([len(route) for route in house_routes]))),
+        "route_points": np.array([point for route in house_routes for point in route], dtype=float).reshape(-1, 2),
+        "load_edges": np.hstack((sub.coords[sub.sources[edges]], sub.coords[sub.indices[edges]])),
+        "load_values": loads[edges],
+        "routes_count": np.array(len(route_distribution)),
+        "total_people": np.array(sum(info["total_people"] for info in route_distribution.values())),
+    }
+
+def _save_tile(path, tile):
+    temporary = path.with_name(f".{path.stem}.{uuid.uuid4().hex}.npz")
+    np.savez(temporary, **tile)
+    os.replace(temporary, path)
+
+
+# --- Precompute ---
+def precompute_tiles(folder_path, id, version, seed=POPULATION_SEED, progress=None):
+    """
+    Предрасчёт плиток версии (задача очереди, progress(stage) - этапы).
+    Плитки с неизменившимися входами берутся из кеша папки TILE_FOLDER.
+    Возвращает сводку: число плиток, пересчитанных и взятых из кеша, время.
+    """
+    folder_path = Path(folder_path)
+    stage = progress or (lambda name: None)
+    started = time.time()
+
+    stage("load")
+    data = datasets.get(id, version, folder_path)
+    source = dataset_fingerprint(folder_path)
+
+    stage("graph")
+    houses = data.houses.assign(Total_People=data.population(seed))
+    buses, streets = data.buses, data.streets
+    G, node_coords = create_street_graph(streets)
+    tree = cKDTree(node_coords)
+
+    stage("places")
+    add_places_to_graph(houses, G, tree, node_coords, 'house', points=data.house_points(houses),
+                        snap=data.snap_places("houses", houses, streets))
+    add_places_to_graph(buses, G, tree, node_coords, 'bus_stop', snap=data.snap_places("buses", buses, streets))
+    metrics.observe_graph(G, len(houses), len(buses))
+
+    stage("tiles")
+    projected = _to_3857(G.coords)
+    street_nodes = np.flatnonzero(G.node_type == NODE_TYPES["street"])
+    street_tree = cKDTree(projected[street_nodes])
+    stop_points = projected[G.place_nodes["bus_stop"]]
+    stop_tree = cKDTree(stop_points) if len(stop_points) else None
+
+    # Плитка дома - по его точке; дома плитки остаются в порядке строк
+    keys = np.floor(projected[G.place_nodes["house"]] / TILE_SIZE).astype(np.int64).reshape(-1, 2)
+    tiles, tile_of_house = np.unique(keys, axis=0, return_inverse=True)
+    tile_of_house = tile_of_house.ravel()
+    order = np.argsort(tile_of_house, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(tile_of_house, minlength=len(tiles)))))
+
+    cache = folder_path / TILE_FOLDER / "cache"
+    cache.mkdir(parents=True, exist_ok=True)
+    hashes, computed = [], 0
+    for number in metrics.track(range(len(tiles)), loop="Computing tiles"):
+        rows = order[bounds[number]:bounds[number + 1]]
+        center = (tiles[number] + 0.5) * TILE_SIZE
+        stops = np.sort(stop_tree.query_ball_point(center, TILE_RADIUS)).astype(np.int64) if stop_tree \
+            else np.zeros(0, dtype=np.int64)
+        sub = _tile_graph(G, rows, stops, street_nodes, street_tree, center)
+        digest = _tile_hash(sub)
+        if not (cache / f"{digest}.npz").exists():
+            _save_tile(cache / f"{digest}.npz", _compute_tile(sub, houses.iloc[rows], buses.iloc[stops]))
+            computed += 1
+        hashes.append(digest)
+
+    stage("store")
+    manifest = {
+        "format": TILE_FORMAT,
+        "source": source,
+        "seed": seed,
+        "tile_size": TILE_SIZE,
+        "tile_radius": TILE_RADIUS,
+        "tile_halo": TILE_HALO,
+        "tiles": hashes,
+        "built_at": time.time(),
+    }
+    _write_store(folder_path / TILE_FOLDER, G, tiles, hashes, projected, manifest)
+    # Результаты плиток, которых больше нет, не нужны
+    used = {f"{digest}.npz" for digest in hashes}
+    for path in cache.glob("*.npz"):
+        if path.name not in used:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    return {"tiles": len(tiles), "computed": computed, "reused": len(tiles) - computed,
+            "seconds": round(time.time() - started, 3)}
+
+def _write_store(folder, G, tiles, hashes, projected, manifest):
+    """
+    Собирает плитки в массивы подряд (смещения - границы плиток) и заменяет папку store целиком.
+    Рёбра - все рёбра графа версии, нагрузка плитки ссылается на них по номерам.
+    """
+    node_index = G.node_index
+    edge_starts, edge_ends = G.coords[G.sources], G.coords[G.indices]
+    arrays = {name: [] for name in ("house_points", "route_offsets", "route_points", "load_edges", "load_values")}
+    counts = {"houses": [0], "loads": [0], "routes_count": [], "total_people": []}
+    route_total = 0
+    for digest in hashes:
+        with np.load(folder / "cache" / f"{digest}.npz") as tile:
+            # Координаты рёбер плитки -> номера рёбер графа версии (подграф плитки - его часть)
+            ends = tile["load_edges"].reshape(-1, 2, 2)
+            src = [node_index[tuple(point)] for point in ends[:, 0].tolist()]
+            dst = [node_index[tuple(point)] for point in ends[:, 1].tolist()]
+            arrays["house_points"].append(tile["house_points"])
+            arrays["route_offsets"].append(tile["route_offsets"][1:] + route_total)
+            arrays["route_points"].append(tile["route_points"])
+            arrays["load_edges"].append(G.edge_ids(np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64)))
+            arrays["load_values"].append(tile["load_values"])
+            route_total += int(tile["route_offsets"][-1])
+            counts["houses"].append(counts["houses"][-1] + len(tile["house_points"]))
+            counts["loads"].append(counts["loads"][-1] + len(tile["load_values"]))
+            counts["routes_count"].append(int(tile["routes_count"]))
+            counts["total_people"].append(float(tile["total_people"]))
+
+    stops = G.place_nodes["bus_stop"]
+    store = {
+        "tiles": np.asarray(tiles, dtype=np.int64).reshape(-1, 2),
+        "house_offsets": np.array(counts["houses"], dtype=np.int64),
+        "house_points": np.vstack(arrays["house_points"] or [np.zeros((0, 2))]),
+        "route_offsets": np.concatenate([[0]] + arrays["route_offsets"]).astype(np.int64),
+        "route_points": np.vstack(arrays["route_points"] or [np.zeros((0, 2))]),
+        "load_offsets": np.array(counts["loads"], dtype=np.int64),
+        "load_edges": np.concatenate(arrays["load_edges"] or [np.zeros(0, dtype=np.int64)]),
+        "load_values": np.concatenate(arrays["load_values"] or [np.zeros(0)]),
+        "routes_count": np.array(counts["routes_count"], dtype=np.int64),
+        "total_people": np.array(counts["total_people"], dtype=float),
+        "stop_points": G.coords[stops],
+        "stop_projected": projected[stops],
+        "edge_starts": edge_starts,
+        "edge_ends": edge_ends,
+        "edge_projected": (projected[G.sources] + projected[G.indices]) / 2,
+    }
+
+    temporary = folder / f"store-{uuid.uuid4().hex}"
+    temporary.mkdir()
+    try:
+        for name, array in store.items():
+            np.save(temporary / f"{name}.npy", np.ascontiguousarray(array))
+        with open(temporary / "manifest.json", "w", encoding="utf-8") as output:
+            json.dump(manifest, output)
+        if (folder / "store").exists():
+            shutil.rmtree(folder / "store")
+        os.rename(temporary, folder / "store")
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+# --- Views ---
+class TileStore:
+    """
+    Прочитанное хранилище плиток версии; числовые массивы открыты через mmap.
+    Центры плиток, середины рёбер и остановки индексируются cKDTree при чтении - окно выбирает
+    их запросом к дереву, а не проходом по всему городу.
+    """
+
+    ARRAYS = ("tiles", "house_offsets", "house_points", "route_offsets", "route_points", "load_offsets",
+              "load_edges", "load_values", "routes_count", "total_people", "stop_points", "stop_projected",
+              "edge_starts", "edge_ends", "edge_projected")
+
+    def __init__(self, folder, manifest):
+        self.manifest = manifest
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(folder / f"{name}.npy", mmap_mode="r"))
+        self.tile_size = manifest["tile_size"]
+        self.tile_centers = (np.asarray(self.tiles) + 0.5) * self.tile_size
+        self.tile_numbers = {tuple(tile): number for number, tile in enumerate(np.asarray(self.tiles).tolist())}
+        self.tile_tree, self.edge_tree, self.stop_tree = (
+            cKDTree(points) if len(points) else None
+            for points in (self.tile_centers, np.asarray(self.edge_projected), np.asarray(self.stop_projected)))
+
+    def _tiles_in(self, center, radius):
+        numbers = _within(self.tile_tree, center, radius)
+        if not len(numbers):
+            # Окно меньше плитки - берётся плитка, в которой лежит точка
+            number = self.tile_numbers.get(tuple(np.floor(center / self.tile_size).astype(np.int64).tolist()))
+            numbers = np.array([] if number is None else [number], dtype=np.int64)
+        return numbers
+
+    def view(self, lat, long, radius=1000, output_format="json"):
+        """Результат get_routes для окна radius метров вокруг (lat, long), собранный из плиток"""
+        center = _to_3857([(long, lat)])[0]
+        numbers = self._tiles_in(center, radius)
+
+        houses = _ranges(self.house_offsets, numbers)
+        house_points = np.asarray(self.house_points[houses])
+        routes = {}
+        for house, point in zip(houses.tolist(), house_points.tolist()):
+            start, end = self.route_offsets[house], self.route_offsets[house + 1]
+            routes[tuple(point)] = [tuple(p) for p in self.route_points[start:end].tolist()] if end > start else None
+
+        # Нагрузка плиток складывается только на рёбрах окна
+        edges = _within(self.edge_tree, center, radius)
+        stops = _within(self.stop_tree, center, radius)
+        entries = _ranges(self.load_offsets, numbers)
+        load_edges = np.asarray(self.load_edges[entries])
+        positions = np.searchsorted(edges, load_edges).clip(max=max(len(edges) - 1, 0))
+        inside = np.flatnonzero(edges[positions] == load_edges) if len(edges) else np.zeros(0, dtype=np.int64)
+        loads = np.zeros(len(edges))
+        np.add.at(loads, positions[inside], self.load_values[entries[inside]])
+        stop_points = np.asarray(self.stop_points[stops])
+        edge_starts, edge_ends = np.asarray(self.edge_starts[edges]), np.asarray(self.edge_ends[edges])
+        edge_loads = dict(zip(zip(map(tuple, edge_starts.tolist()), map(tuple, edge_ends.tolist())),
+                              loads.tolist()))
+
+        summary = traffic_summary(len(stops), int(self.routes_count[numbers].sum()),
+                                  float(self.total_people[numbers].sum()), edge_loads)
+        summary["source"] = "tiles"
+        if output_format == "compact":
+            return compact_result(summary, house_points, stop_points, edge_starts, edge_ends, loads, routes)
+
+        points = lambda xy: gpd.GeoDataFrame(geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs="EPSG:4326")
+        heat_map = (None, heatmap_edge_colors(None, edge_loads))
+        return routes_result(summary, points(house_points), points(stop_points), heat_map, routes)
+
+
+_stores = OrderedDict()
+_stores_lock = threading.Lock()
+
+def get_tile_store(folder_path, seed=POPULATION_SEED):
+    """
+    Хранилище плиток версии или None: его нет, оно другого формата, другого зерна
+    или собрано по другим исходным файлам (версия изменилась после предрасчёта).
+    """
+    folder = Path(folder_path) / TILE_FOLDER / "store"
+    try:
+        key = (str(folder.resolve()), (folder / "manifest.json").stat().st_mtime_ns)
+    except OSError:
+        return None
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is not None:
+            _stores.move_to_end(key)
+    if store is None:
+        try:
+            with open(folder / "manifest.json", encoding="utf-8") as input:
+                manifest = json.load(input)
+            if manifest.get("format") != TILE_FORMAT:
+                return None
+            store = TileStore(folder, manifest)
+        except (OSError, ValueError):
+            return None
+        with _stores_lock:
+            _stores[key] = store
+            while len(_stores) > TILE_STORE_CACHE_SIZE:
+                _stores.popitem(last=False)
+    if store.manifest["seed"] != seed or store.manifest["source"] != dataset_fingerprint(folder_path):
+        return None
+    return store
+
+def tiled_routes(folder_path, lat, long, radius=1000, seed=POPULATION_SEED, output_format="json"):
+    """Результат get_routes из плиток или None, если готовых плиток для версии и зерна нет"""
+    store = get_tile_store(folder_path, seed)
+    if store is None:
+        return None
+    return store.view(lat, long, radius, output_format)
@@ -0,0 +1,192 @@
+# topology.py
+"""
+Очистка топологии слоя улиц перед построением графа.
+
+Вершины графа - точные координаты концов отрезков, поэтому улицы, концы которых расходятся
+на доли метра, не соединяются, а пересечения без общей вершины не дают перекрёстка. Очистка:
+1. делит отрезки в точках пересечения и там, где конец другой улицы лежит на отрезке (T-перекрёсток);
+2. объединяет вершины ближе tolerance метров (пары из KD-дерева, группы - компоненты связности);
+3. убирает изолированные куски сети суммарной длиной меньше min_component_length метров.
+Координаты вершин, которые не объединялись, не меняются.
+"""
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from graph_engine import EARTH_RADIUS, haversine
+
+# Допуск объединения вершин, м; 0 - не объединять
+STREET_MERGE_TOLERANCE = float(os.environ.get("STREET_MERGE_TOLERANCE", 0.5))
+# Изолированные куски сети короче этого (суммарно, м) удаляются; 0 - не удалять
+STREET_MIN_COMPONENT_LENGTH = float(os.environ.get("STREET_MIN_COMPONENT_LENGTH", 50))
+# Делить ли улицы в точках пересечения (0 - если в данных много мостов и тоннелей без общей вершины)
+STREET_SPLIT_INTERSECTIONS = os.environ.get("STREET_SPLIT_INTERSECTIONS", "1") != "0"
+
+
+# --- Local metric coordinates ---
+class _LocalProjection:
+    """Равнопромежуточная проекция вокруг средней широты: на масштабе города - метры с малой ошибкой"""
+
+    def __init__(self, coords):
+        self.cos_lat = np.cos(np.radians(coords[:, 1].mean())) if len(coords) else 1.0
+
+    def forward(self, coords):
+        return np.radians(coords) * EARTH_RADIUS * np.array([self.cos_lat, 1.0])
+
+    def inverse(self, xy):
+        return np.degrees(xy / EARTH_RADIUS / np.array([self.cos_lat, 1.0]))
+
+
+def _components(n, first, second):
+    """Номера компонент связности графа из n вершин с рёбрами first[i] - second[i]"""
+    graph = coo_matrix((np.ones(len(first)), (first, second)), shape=(n, n))
+    return connected_components(graph, directed=False)
+
+
+# --- Splitting ---
+def _split_points(xy_starts, xy_ends, tolerance):
+    """
+    Точки, в которых надо разделить отрезки: пересечения и проекции концов соседних отрезков
+    на расстоянии не больше tolerance. Точки ближе tolerance к концам отрезка не учитываются -
+    их соединит объединение вершин. Возвращает (номер отрезка, расстояние от начала, точка).
+    """
+    lines = shapely.linestrings(np.stack((xy_starts, xy_ends), axis=1))
+    first, second = shapely.STRtree(lines).query(lines, predicate="dwithin", distance=tolerance)
+    pairs = first < second
+    first, second = first[pairs], second[pairs]
+
+    segments, points = [], []
+    crossing = shapely.intersection(lines[first], lines[second])
+    is_point = shapely.get_type_id(crossing) == shapely.GeometryType.POINT
+    crossing_points = shapely.get_coordinates(crossing[is_point])
+    for side in (first, second):
+        segments.append(side[is_point])
+        points.append(crossing_points)
+    # Концы одного отрезка рядом с другим: конец остаётся на месте, отрезок делится в проекции
+    for target, other in ((first, second), (second, first)):
+        for ends in (xy_starts, xy_ends):
+            end_points = shapely.points(ends[other])
+            near = shapely.distance(lines[target], end_points) <= tolerance
+            projected = shapely.line_interpolate_point(lines[target][near],
+                                                       shapely.line_locate_point(lines[target][near], end_points[near]))
+            segments.append(target[near])
+            points.append(shapely.get_coordinates(projected))
+
+    segments = np.concatenate(segments).astype(np.int64)
+    points = np.concatenate(points).reshape(-1, 2)
+    along = np.hypot(*(points - xy_starts[segments]).T)
+    length = np.hypot(*(xy_ends[segments] - xy_starts[segments]).T)
+    inner = (along > tolerance) & (length - along > tolerance)
+    return segments[inner], along[inner], points[inner]
+
+
+# --- Cleaning ---
+def clean_streets(streets, tolerance=STREET_MERGE_TOLERANCE, min_component_length=STREET_MIN_COMPONENT_LENGTH,
+                  split_intersections=STREET_SPLIT_INTERSECTIONS):
+    """
+    Очищает топологию слоя улиц (GeoDataFrame в EPSG:4326, линии и мультилинии).
+    Возвращает (очищенный слой - те же строки и колонки без удалённых улиц, отчёт):
+    отчёт - словарь с числом компонент связности до и после, добавленных точек деления,
+    объединённых и удалённых вершин, удалённых компонент и улиц.
+    """
+    parts, rows = shapely.get_parts(np.asarray(streets.geometry.values, dtype=object), return_index=True)
+    lines = shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING
+    parts, rows = parts[lines], rows[lines]
+    coords, part_of_coord = shapely.get_coordinates(parts, return_index=True)
+    segment_start = np.flatnonzero(part_of_coord[1:] == part_of_coord[:-1])
+    segment_part = part_of_coord[segment_start]
+    projection = _LocalProjection(coords)
+    xy = projection.forward(coords)
+
+    report = {"components_before": 0, "components_after": 0, "split_points": 0, "merged_nodes": 0,
+              "removed_components": 0, "removed_nodes": 0, "removed_streets": 0}
+    if not len(segment_start):
+        report["removed_streets"] = len(streets)
+        return streets.iloc[:0], report
+    _, vertex_ids = np.unique(coords, axis=0, return_inverse=True)
+    vertex_ids = vertex_ids.ravel()
+    report["components_before"] = _components(vertex_ids.max() + 1, vertex_ids[segment_start],
+                                              vertex_ids[segment_start + 1])[0]
+
+    # Опорные точки каждого отрезка: начало, точки деления, конец; порядок - по расстоянию от начала
+    length = np.hypot(*(xy[segment_start + 1] - xy[segment_start]).T)
+    segment_ids = np.arange(len(segment_start))
+    station_segment = [segment_ids, segment_ids]
+    station_along = [np.zeros(len(segment_ids)), length]
+    station_lonlat = [coords[segment_start], coords[segment_start + 1]]
+    station_xy = [xy[segment_start], xy[segment_start + 1]]
+    if split_intersections:
+        split_segment, split_along, split_xy = _split_points(xy[segment_start], xy[segment_start + 1],
+                                                             max(tolerance, 1e-9))
+        report["split_points"] = len(split_segment)
+        station_segment.append(split_segment)
+        station_along.append(split_along)
+        station_lonlat.append(projection.inverse(split_xy))
+        station_xy.append(split_xy)
+    station_segment, station_along = np.concatenate(station_segment), np.concatenate(station_along)
+    station_lonlat, station_xy = np.concatenate(station_lonlat), np.concatenate(station_xy)
+    order = np.lexsort((station_along, station_segment))
+    station_segment, station_lonlat, station_xy = station_segment[order], station_lonlat[order], station_xy[order]
+
+    # Вершины: одинаковые координаты - одна вершина, вершины ближе tolerance - одна группа
+    # с координатами её первой вершины
+    unique_lonlat, node = np.unique(station_lonlat, axis=0, return_inverse=True)
+    node = node.ravel()
+    node_xy = np.zeros((len(unique_lonlat), 2))
+    node_xy[node] = station_xy
+    if tolerance > 0:
+        pairs = cKDTree(node_xy).query_pairs(tolerance, output_type="ndarray")
+        groups, group = _components(len(unique_lonlat), pairs[:, 0], pairs[:, 1])
+        _, representative = np.unique(group, return_index=True)
+        report["merged_nodes"] = len(unique_lonlat) - groups
+        node = representative[group[node]]
+
+    # Новые отрезки - соседние опорные точки одного исходного отрезка; нулевые (после объединения) убираются
+    same = station_segment[1:] == station_segment[:-1]
+    start_node, end_node = node[:-1][same], node[1:][same]
+    new_segment_part = segment_part[station_segment[:-1][same]]
+    nonzero = start_node != end_node
+    start_node, end_node, new_segment_part = start_node[nonzero], end_node[nonzero], new_segment_part[nonzero]
+
+    # Компоненты связности очищенной сети; короткие изолированные куски удаляются
+    used, compact = np.unique(np.concatenate((start_node, end_node)), return_inverse=True)
+    compact_start, compact_end = compact[:len(start_node)], compact[len(start_node):]
+    components, label = _components(len(used), compact_start, compact_end)
+    segment_length = haversine(*unique_lonlat[start_node].T, *unique_lonlat[end_node].T)
+    component_length = np.bincount(label[compact_start], weights=segment_length, minlength=components)
+    removed = component_length < min_component_length
+    keep = ~removed[label[compact_start]]
+    report["components_after"] = components - int(removed.sum())
+    report["removed_components"] = int(removed.sum())
+    report["removed_nodes"] = int(np.isin(label, np.flatnonzero(removed)).sum())
+    start_node, end_node, new_segment_part = start_node[keep], end_node[keep], new_segment_part[keep]
+
+    # Линии заново: подряд идущие отрезки одной части, разрыв - где отрезок удалён или часть сменилась
+    breaks = np.ones(len(start_node), dtype=bool)
+    breaks[1:] = (new_segment_part[1:] != new_segment_part[:-1]) | (start_node[1:] != end_node[:-1])
+    run = np.cumsum(breaks) - 1
+    last = np.append(breaks[1:], True)
+    line_nodes = np.concatenate((start_node, end_node[last]))
+    line_index = np.concatenate((run, run[last]))
+    order = np.argsort(line_index, kind="stable")
+    new_lines = shapely.linestrings(unique_lonlat[line_nodes[order]], indices=line_index[order])
+    line_rows = rows[new_segment_part[breaks]]
+
+    kept_rows, line_count = np.unique(line_rows, return_counts=True)
+    geometry = np.empty(len(kept_rows), dtype=object)
+    single = line_count == 1
+    first_line = np.searchsorted(line_rows, kept_rows)
+    geometry[single] = new_lines[first_line[single]]
+    if not single.all():
+        multi = np.isin(line_rows, kept_rows[~single])
+        geometry[~single] = shapely.multilinestrings(new_lines[multi], indices=np.searchsorted(kept_rows[~single], line_rows[multi]))
+
+    report["removed_streets"] = len(streets) - len(kept_rows)
+    cleaned = streets.iloc[kept_rows].copy()
+    cleaned[cleaned.geometry.name] = gpd.GeoSeries(geometry, index=cleaned.index, crs=streets.crs)
+    return cleaned, report
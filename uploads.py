@@ -0,0 +1,179 @@
+# uploads.py
+"""
+Приём файлов набора данных: потоковая запись на диск, проверка комплекта shapefile и атомарная публикация.
+
+Файлы пишутся в служебную папку (UPLOAD_STAGING_FOLDER) и попадают в папку версии одним rename
+только после проверки - незавершённая или битая загрузка не видна ни спискам версий, ни расчётам.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from pathlib import Path
+
+import geopandas as gpd
+
+# Предел объёма одной загрузки (сумма всех файлов, для zip - после распаковки), по умолчанию 1 ГБ
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 1024 ** 3))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Расширения файлов, которые принимаются в составе набора данных
+EXPECTED_EXTENSIONS = {"shp", "shx", "dbf", "prj", "qmd", "cpg"}
+# Без этих файлов shapefile не читается или не имеет системы координат
+REQUIRED_SIDECARS = ("shx", "dbf", "prj")
+# Поля, без которых расчёты не работают (см. dataset_cache.load_dataset)
+REQUIRED_FIELDS = {
+    "buildings": ("Apartments",),
+    "streets": ("Foot",),
+}
+
+
+# Блокировки подмены папок наборов процесса: папка набора -> Lock
+_swap_locks = {}
+_swap_locks_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """Загрузка отклонена; status_code - код ответа API"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadWriter:
+    """Пишет файлы загрузки в папку, считая общий объём и sha256 каждого файла"""
+
+    def __init__(self, folder, max_bytes=UPLOAD_MAX_BYTES):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.files = []
+
+    def write(self, name, stream):
+        """Копирует поток в файл name кусками по UPLOAD_CHUNK_SIZE"""
+        name = os.path.basename(name.replace("\\", "/"))
+        extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+        if extension not in EXPECTED_EXTENSIONS:
+            raise UploadError(f"Invalid file extension for {name}")
+        if any(file["name"].lower() == name.lower() for file in self.files):
+            raise UploadError(f"Duplicate file {name}")
+
+        digest = hashlib.sha256()
+        size = 0
+        with open(self.folder / name, "wb") as buffer:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                self.total_bytes += len(chunk)
+                if self.total_bytes > self.max_bytes:
+                    raise UploadError(f"Upload is larger than {self.max_bytes} bytes", status_code=413)
+                digest.update(chunk)
+                buffer.write(chunk)
+        self.files.append({"name": name, "size": size, "sha256": digest.hexdigest()})
+
+    def write_zip(self, name, stream):
+        """
+        Распаковывает архив по одному файлу, не читая его целиком в память.
+        Папки внутри архива не сохраняются; служебные файлы (__MACOSX, скрытые) пропускаются.
+        """
+        try:
+            archive = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            raise UploadError(f"{name} is not a valid zip archive")
+        with archive:
+            for member in archive.infolist():
+                member_name = os.path.basename(member.filename)
+                if member.is_dir() or not member_name or member_name.startswith(".") \
+                        or member.filename.startswith("__MACOSX/"):
+                    continue
+                with archive.open(member) as member_stream:
+                    self.write(member_name, member_stream)
+
+
+def validate_shapefile(folder, dataset_name):
+    """
+    Проверяет комплект shapefile в папке: один .shp, обязательные файлы рядом с ним (REQUIRED_SIDECARS),
+    система координат и поля REQUIRED_FIELDS. Читается только первая запись.
+    """
+    folder = Path(folder)
+    shapefiles = list(folder.glob("*.shp"))
+    if len(shapefiles) != 1:
+        raise UploadError(f"Expected exactly one .shp file for {dataset_name}, got {len(shapefiles)}")
+    shapefile = shapefiles[0]
+
+    present = {path.suffix.lower().lstrip(".") for path in folder.iterdir() if path.stem == shapefile.stem}
+    missing = [extension for extension in REQUIRED_SIDECARS if extension not in present]
+    if missing:
+        raise UploadError(f"{shapefile.name} is missing: {', '.join('.' + extension for extension in missing)}")
+
+    try:
+        sample = gpd.read_file(shapefile, rows=1)
+    except Exception as e:
+        raise UploadError(f"Cannot read {shapefile.name}: {e}")
+    if sample.crs is None:
+        raise UploadError(f"{shapefile.name} has no coordinate reference system")
+    missing = [field for field in REQUIRED_FIELDS.get(dataset_name, ()) if field not in sample.columns]
+    if missing:
+        raise UploadError(f"{shapefile.name} is missing fields: {', '.join(missing)}")
+
+
+def swap_dataset(staging, dataset_folder, staging_root):
+    """
+    Подмена папки набора: старая убирается в сторону, новая встаёт одним rename.
+    Подмены одного набора в процессе идут по очереди; если папку между двумя rename заняла
+    загрузка другого процесса - UploadError 409.
+    """
+    dataset_folder = os.path.normpath(dataset_folder)
+    with _swap_locks_lock:
+        lock = _swap_locks.setdefault(os.path.abspath(dataset_folder), threading.Lock())
+    with lock:
+        os.makedirs(os.path.dirname(dataset_folder), exist_ok=True)
+        previous = None
+        try:
+            if os.path.exists(dataset_folder):
+                previous = Path(staging_root) / f"{uuid.uuid4().hex}-previous"
+                os.rename(dataset_folder, previous)
+            os.rename(staging, dataset_folder)
+        except OSError as e:
+            if previous is not None and not os.path.exists(dataset_folder):
+                # Новая папка не встала - возвращаем старую
+                try:
+                    os.rename(previous, dataset_folder)
+                    previous = None
+                except OSError:
+                    pass
+            raise UploadError(f"Dataset {os.path.basename(dataset_folder)} is being replaced by another upload: {e}",
+                              status_code=409)
+        finally:
+            if previous is not None:
+                shutil.rmtree(previous, ignore_errors=True)
+
+
+def save_dataset(files, dataset_folder, staging_root, max_bytes=UPLOAD_MAX_BYTES):
+    """
+    Сохраняет загруженные файлы набора данных (пары (имя, поток); .zip распаковывается) в dataset_folder.
+    Файлы пишутся во временную папку внутри staging_root и после проверки заменяют dataset_folder целиком.
+    Блокирующая функция - из обработчиков API вызывается в пуле потоков.
+    Возвращает список {"name", "size", "sha256"} сохранённых файлов.
+    """
+    os.makedirs(staging_root, exist_ok=True)
+    staging = Path(staging_root) / uuid.uuid4().hex
+    staging.mkdir()
+    try:
+        writer = UploadWriter(staging, max_bytes)
+        for name, stream in files:
+            if name.lower().endswith(".zip"):
+                writer.write_zip(name, stream)
+            else:
+                writer.write(name, stream)
+        validate_shapefile(staging, os.path.basename(os.path.normpath(dataset_folder)))
+
+        swap_dataset(staging, dataset_folder, staging_root)
+        return writer.files
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
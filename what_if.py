@@ -0,0 +1,613 @@
+# what_if.py
+import copy
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+from analysis_pipeline import get_pipeline
+from data_process_new import routes_result
+from graph_engine import (NODE_TYPES, create_street_graph, haversine, last_value_per_node, line_segments,
+                          nearest_segments, reconstruct_path_to, tree_edge_loads)
+from street_graph import (POPULATION_SEED, add_places_to_graph, generate_population, heatmap_edge_colors, place_points, stop_catchments,
+                          traffic_summary)
+
+# Сколько анализов держать в памяти процесса
+WHAT_IF_MAX_ANALYSES = int(os.environ.get("WHAT_IF_MAX_ANALYSES", 32))
+
+
+class Analysis:
+    """
+    Расчёт маршрутов окна, который можно править по шагам (what-if): добавить или убрать дом,
+    добавить, перенести или убрать остановку, закрыть или открыть участок улицы.
+
+    Граф строится так же, как в Pipeline._graph: дома и остановки привязываются к ближайшим отрезкам улиц
+    (add_places_to_graph), отрезок делится вершиной привязки, а место - отдельная вершина графа.
+    Маршруты и нагрузки считаются так же, как assign_routes_to_population + calculate_population_loads:
+    от вершины привязки каждого дома ко всем остановкам по обратным деревьям кратчайших путей,
+    при нескольких домах у одной вершины берётся последний. Деревья остановок и суммарная нагрузка
+    хранятся, и правка пересчитывает только то, что затронула:
+    - дом - пути от его вершины до остановок;
+    - остановка - одно дерево (новое или удалённое);
+    - участок улицы - деревья, которые через него проходят (или станут проходить).
+    Новое место привязывается тем же add_places_to_graph (вершина деления встаёт в цепочку отрезка),
+    убранное - снимается вместе с вершиной деления, к которой больше ничего не привязано (remove_points).
+    Нагрузка и веса переходят на новые номера рёбер, пересчитываются деревья, проходившие через
+    заменённые рёбра. Закрытый участок остаётся в графе с бесконечным весом.
+    """
+
+    def __init__(self, houses, buses, streets, seed=POPULATION_SEED, closed_segments=(), snap=None):
+        self.id = str(uuid.uuid4())
+        self.session_id = None
+        self.seed = seed
+        self.lock = threading.Lock()
+
+        self.houses = houses.copy()
+        if 'Total_People' not in self.houses:
+            self.houses['Total_People'] = generate_population(self.houses, seed)
+        self.buses = buses.copy()
+        self._next_id = {"house": int(self.houses.index.max()) + 1 if len(self.houses) else 0,
+                         "bus_stop": int(self.buses.index.max()) + 1 if len(self.buses) else 0}
+
+        # Граф улиц с домами и остановками. snap - привязка домов и остановок к отрезкам улиц
+        # (Dataset.snap_places, как в пайплайне); без неё ищется по улицам окна тем же nearest_segments
+        self.G, self.node_coords = create_street_graph(streets)
+        self.tree = cKDTree(self.node_coords)
+        self.segments = line_segments(streets.geometry.values)
+        if snap is None:
+            snap = (self._nearest_segment(place_points(self.houses)), self._nearest_segment(place_points(self.buses)))
+        self.house_places, self.house_nodes = self._add_places(self.houses, 'house', snap[0])
+        self.bus_places, self.bus_nodes = self._add_places(self.buses, 'bus_stop', snap[1])
+        # Длина ребра от вершины привязки до остановки - часть пути до неё при выборе ближайшей
+        self.bus_offsets = self._place_lengths(self.bus_places, self.bus_nodes)
+
+        self.base_weights = self.G.weights.copy()
+        self.closed = set()  # номера закрытых рёбер
+        for start, end in closed_segments:
+            self.closed.update(self._segment_edges(start, end)[2].tolist())
+        if self.closed:
+            weights = self.base_weights.copy()
+            weights[sorted(self.closed)] = np.inf
+            self.G.set_weights(weights)
+
+        self.people = self.houses['Total_People'].to_numpy(dtype=float) * 0.51 / 60
+
+        # Вес вершины - люди последнего дома в ней, has_house - вершина является началом маршрутов
+        self.node_weights, self.has_house = last_value_per_node(self.G.number_of_nodes, self.house_nodes, self.people)
+
+        # Обратное дерево каждой уличной вершины с остановкой: {вершина: (dist, predecessors)}
+        self.trees = {}
+        self.loads = np.zeros(self.G.number_of_edges)
+        stops = np.unique(self.bus_nodes)
+        if len(stops):
+            dist, predecessors = self.G.shortest_path_tree(stops, reverse=True)
+            for stop, stop_dist, stop_predecessors in zip(stops.tolist(), dist, predecessors):
+                self.trees[stop] = (stop_dist, stop_predecessors)
+                self.loads += tree_edge_loads(self.G, stop_dist, stop_predecessors, self.node_weights)
+
+        # Маршрут каждого дома до ближайшей по сети остановки: (координаты остановки, вершина, путь)
+        self._routes = [None] * len(self.houses)
+        self._refresh_routes(set())
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        """Анализ окна Pipeline: те же дома с населением, остановки, улицы и привязка мест к улицам"""
+        houses, buses, streets = pipeline.window()
+        snap = (pipeline.data.snap_places("houses", houses, streets), pipeline.data.snap_places("buses", buses, streets))
+        return cls(houses, buses, streets, pipeline.seed, snap=snap)
+
+    # --- Snapping ---
+    def _nearest_segment(self, points):
+        """Привязка точек к ближайшим отрезкам улиц окна (начала, концы, доли) или None, если улиц нет"""
+        starts, ends = self.segments
+        if not len(starts):
+            return None
+        segments, fractions = nearest_segments(points, starts, ends)
+        return starts[segments], ends[segments], fractions
+
+    def _add_places(self, places, place_type, snap):
+        """Привязывает места к графу (add_places_to_graph); возвращает (вершины мест, вершины привязки)"""
+        add_places_to_graph(places, self.G, self.tree, self.node_coords, place_type, snap=snap)
+        return self.G.place_nodes[place_type].copy(), np.asarray(self.G.snap_nodes[place_type], dtype=np.int64).copy()
+
+    def _sync_places(self):
+        """Места графа - в порядке строк домов и остановок анализа (add_places_to_graph оставляет только новые)"""
+        self.G.place_nodes = {"house": self.house_places, "bus_stop": self.bus_places}
+        self.G.snap_nodes = {"house": self.house_nodes, "bus_stop": self.bus_nodes}
+
+    def _place_lengths(self, place_nodes, snap_nodes):
+        places, snapped = self.G.coords[place_nodes], self.G.coords[snap_nodes]
+        return haversine(places[:, 0], places[:, 1], snapped[:, 0], snapped[:, 1])
+
+    def _attach(self, place_type, places):
+        """
+        Добавляет вершину места places (одна строка), привязанную к ближайшему отрезку улицы окна, как
+        в пайплайне. Возвращает (вершина места, вершина привязки, длина ребра между ними,
+        вершины остановок пересчитанных деревьев).
+        """
+        snap = self._nearest_segment(place_points(places))
+        added = []
+        affected = self._change_graph(lambda: added.append(self._add_places(places, place_type, snap)))
+        (place,), (snap_node,) = added[0]
+        return int(place), int(snap_node), float(self._place_lengths([place], [snap_node])[0]), affected
+
+    def _detach(self, place, snap_node):
+        """
+        Убирает вершину места. Вершина деления, к которой больше не привязано мест
+        (house_nodes и bus_nodes уже без этого места), уходит из цепочки отрезка.
+        Возвращает вершины остановок пересчитанных деревьев.
+        """
+        def detach():
+            self.G.remove_edges([place, snap_node], [snap_node, place])
+            if snap_node not in self.house_nodes and snap_node not in self.bus_nodes:
+                self.G.remove_points([snap_node])
+        return self._change_graph(detach)
+
+    def _change_graph(self, change):
+        """
+        Меняет рёбра графа функцией change (новые вершины - только после существующих).
+        Нагрузка, длины и закрытые участки переходят на новые номера рёбер; новое ребро улицы, заменившее
+        часть закрытого участка, тоже закрыто. Пересчитываются деревья, в которых было удалённое ребро
+        или новое ребро сокращает путь; в остальных деревьях новые вершины получают расстояние через
+        соседей, а оставшиеся без рёбер вершины становятся недостижимыми.
+        Возвращает вершины остановок пересчитанных деревьев.
+        """
+        G = self.G
+        old = copy.copy(G)
+        old_nodes = G.number_of_nodes
+        change()
+        self._sync_places()
+        old_src, old_dst = old.sources, old.indices
+        ids = G.edge_ids(old_src, old_dst)  # новый номер каждого прежнего ребра, -1 - удалено
+        kept = ids >= 0
+
+        # Вершины, у которых не осталось рёбер: их собственный путь в дереве не важен
+        isolated = np.flatnonzero((np.diff(old.indptr) > 0) & (np.diff(G.indptr)[:old_nodes] == 0))
+        used = ~kept & ~np.isin(old_src, isolated)
+        affected = [stop for stop, (_, predecessors) in self.trees.items()
+                    if (predecessors[old_src[used]] == old_dst[used]).any()]
+        for stop in affected:
+            dist, predecessors = self.trees.pop(stop)
+            self.loads -= tree_edge_loads(old, dist, predecessors, self.node_weights)
+
+        # Рёбра переносятся по концам: номер ребра - позиция в CSR, она меняется при любой правке графа
+        closed = np.zeros(old.number_of_edges, dtype=bool)
+        closed[sorted(self.closed)] = True
+        created = np.ones(G.number_of_edges, dtype=bool)
+        created[ids[kept]] = False
+        loads = np.zeros(G.number_of_edges)
+        loads[ids[kept]] = self.loads[kept]
+        self.loads = loads
+        base_weights = G.weights.copy()
+        base_weights[ids[kept]] = self.base_weights[kept]
+        self.base_weights = base_weights
+        self.closed = set(ids[kept & closed].tolist())
+        ends = np.concatenate((old_src[~kept & closed], old_dst[~kept & closed]))
+        new_src, new_dst = G.sources[created], G.indices[created]
+        streets = G.node_type == NODE_TYPES["street"]
+        inherit = streets[new_src] & streets[new_dst] & (np.isin(new_src, ends) | np.isin(new_dst, ends))
+        self.closed.update(np.flatnonzero(created)[inherit].tolist())
+        weights = self.base_weights.copy()
+        weights[sorted(self.closed)] = np.inf
+        G.set_weights(weights)
+
+        count = G.number_of_nodes - old_nodes
+        self.node_weights = np.concatenate((self.node_weights, np.zeros(count)))
+        self.has_house = np.concatenate((self.has_house, np.zeros(count, dtype=bool)))
+        for stop, (dist, predecessors) in list(self.trees.items()):
+            dist = np.concatenate((dist, np.full(count, np.inf)))
+            predecessors = np.concatenate((predecessors, np.full(count, -9999, dtype=predecessors.dtype)))
+            dist[isolated], predecessors[isolated] = np.inf, -9999
+            # Новые вершины лежат на заменённом отрезке или висят на нём: путь идёт через соседнюю вершину
+            for node in range(old_nodes, G.number_of_nodes):
+                neighbours = G.indices[G.indptr[node]:G.indptr[node + 1]]
+                through = G.weights[G.indptr[node]:G.indptr[node + 1]] + dist[neighbours]
+                if len(through) and np.isfinite(through.min()):
+                    dist[node], predecessors[node] = through.min(), neighbours[np.argmin(through)]
+            self.trees[stop] = (dist, predecessors)
+            # Новые рёбра могут сократить путь (например, вершина деления на отрезке, который путь обходил)
+            if (dist[new_src] > G.weights[created] + dist[new_dst]).any():
+                self._remove_tree(stop)
+                affected.append(stop)
+        for stop in affected:
+            self._add_tree(stop)
+        return affected
+
+    @staticmethod
+    def _row(places, place_id, name):
+        try:
+            return places.index.get_loc(place_id)
+        except KeyError:
+            raise KeyError(f"{name} {place_id} not found")
+
+    @staticmethod
+    def _frame(geometry, crs, **columns):
+        return gpd.GeoDataFrame({name: [value] for name, value in columns.items()}, geometry=[geometry], crs=crs)
+
+    # --- Loads ---
+    def _add_path_load(self, node, delta):
+        """Добавляет delta на пути из вершины node до всех остановок"""
+        if delta == 0:
+            return
+        for stop, (dist, predecessors) in self.trees.items():
+            if np.isfinite(dist[node]):
+                path = reconstruct_path_to(predecessors, node, stop)
+                self.loads[self.G.path_edge_ids(path)] += delta
+
+    def _update_node(self, node):
+        """Пересчитывает вес вершины после изменения домов в ней"""
+        rows = np.flatnonzero(self.house_nodes == node)
+        weight = self.people[rows[-1]] if len(rows) else 0.0
+        self._add_path_load(node, weight - self.node_weights[node])
+        self.node_weights[node] = weight
+        self.has_house[node] = len(rows) > 0
+
+    def _add_tree(self, stop):
+        dist, predecessors = self.G.shortest_path_tree(stop, reverse=True)
+        self.trees[stop] = (dist[0], predecessors[0])
+        self.loads += tree_edge_loads(self.G, dist[0], predecessors[0], self.node_weights)
+
+    def _remove_tree(self, stop):
+        dist, predecessors = self.trees.pop(stop)
+        self.loads -= tree_edge_loads(self.G, dist, predecessors, self.node_weights)
+
+    # --- Buildings ---
+    def add_building(self, geometry, apartments=None, total_people=None):
+        """
+        Добавляет дом (geometry в EPSG:4326). Население - total_people или разыгрывается
+        по apartments тем же генератором, что и у остальных домов. Возвращает id дома.
+        """
+        house_id = self._next_id["house"]
+        self._next_id["house"] += 1
+        house = self._frame(geometry, self.houses.crs, Apartments=apartments or 0)
+        house.index = [house_id]
+        if total_people is None:
+            total_people = generate_population(house, (self.seed, house_id))[0]
+        house['Total_People'] = total_people
+
+        self.houses = pd.concat([self.houses, house])
+        place, node, _, affected = self._attach('house', house)
+        self.house_places = np.append(self.house_places, place)
+        self.house_nodes = np.append(self.house_nodes, node)
+        self._sync_places()
+        self.people = np.append(self.people, float(total_people) * 0.51 / 60)
+        self._routes.append(None)
+        self._update_node(node)
+        self._refresh_routes(set(affected), rows=[len(self.houses) - 1])
+        return house_id
+
+    def remove_building(self, house_id):
+        row = self._row(self.houses, house_id, "House")
+        node, place = self.house_nodes[row], self.house_places[row]
+        self.houses = self.houses.drop(index=house_id)
+        self.house_nodes = np.delete(self.house_nodes, row)
+        self.house_places = np.delete(self.house_places, row)
+        self.people = np.delete(self.people, row)
+        del self._routes[row]
+        self._update_node(node)
+        self._refresh_routes(set(self._detach(place, node)))
+
+    # --- Bus stops ---
+    def add_stop(self, geometry):
+        """Добавляет остановку (точка в EPSG:4326), возвращает её id"""
+        stop_id = self._next_id["bus_stop"]
+        self._next_id["bus_stop"] += 1
+        stop = self._frame(geometry, self.buses.crs)
+        stop.index = [stop_id]
+        self.buses = pd.concat([self.buses, stop])
+        place, node, offset, affected = self._attach('bus_stop', stop)
+        self.bus_places = np.append(self.bus_places, place)
+        self.bus_nodes = np.append(self.bus_nodes, node)
+        self._sync_places()
+        self.bus_offsets = np.append(self.bus_offsets, offset)
+        if node not in self.trees:
+            self._add_tree(node)
+        self._refresh_routes({node, *affected})
+        return stop_id
+
+    def remove_stop(self, stop_id):
+        row = self._row(self.buses, stop_id, "Stop")
+        node, place = int(self.bus_nodes[row]), self.bus_places[row]
+        self.buses = self.buses.drop(index=stop_id)
+        self.bus_nodes = np.delete(self.bus_nodes, row)
+        self.bus_places = np.delete(self.bus_places, row)
+        self.bus_offsets = np.delete(self.bus_offsets, row)
+        # Дерево нужно, пока в вершине есть другие остановки
+        if node not in self.bus_nodes:
+            self._remove_tree(node)
+        self._refresh_routes({node, *self._detach(place, node)})
+
+    def move_stop(self, stop_id, geometry):
+        row = self._row(self.buses, stop_id, "Stop")
+        old_node, old_place = int(self.bus_nodes[row]), self.bus_places[row]
+        self.buses.loc[stop_id, self.buses.geometry.name] = geometry
+        # Остановка привязывается заново: старая вершина деления уходит, если к ней больше ничего не привязано
+        self.bus_nodes[row] = -1
+        if old_node not in self.bus_nodes:
+            self._remove_tree(old_node)
+        affected = set(self._detach(old_place, old_node))
+        place, node, offset, changed = self._attach('bus_stop', self.buses.iloc[[row]])
+        self.bus_places[row], self.bus_nodes[row], self.bus_offsets[row] = place, node, offset
+        self._sync_places()
+        if node not in self.trees:
+            self._add_tree(node)
+        self._refresh_routes({old_node, node} | affected | set(changed))
+
+    # --- Street segments ---
+    def _segment_edges(self, start, end):
+        # Точки мест могут совпадать с вершинами улиц - ищем только среди уличных вершин
+        streets = np.flatnonzero(self.G.node_type == NODE_TYPES["street"])
+        index = dict(zip(map(tuple, self.G.coords[streets].tolist()), streets.tolist()))
+        try:
+            u, v = index[tuple(map(float, start))], index[tuple(map(float, end))]
+        except KeyError:
+            raise KeyError(f"Segment {start} - {end} not found")
+        edges = self.G.edge_ids([u, v], [v, u])
+        if (edges < 0).any():
+            raise KeyError(f"Segment {start} - {end} not found")
+        return u, v, edges
+
+    def _reweight(self, edges, weights, affected):
+        """Меняет веса рёбер и пересчитывает затронутые деревья"""
+        for stop in affected:
+            self._remove_tree(stop)
+        new_weights = self.G.weights.copy()
+        new_weights[edges] = weights
+        self.G.set_weights(new_weights)
+        for stop in affected:
+            self._add_tree(stop)
+        self._refresh_routes(set(affected))
+
+    def close_segment(self, start, end):
+        """Закрывает участок улицы между соседними вершинами start и end (координаты) в обе стороны"""
+        u, v, edges = self._segment_edges(start, end)
+        # Затронуты только деревья, в которых участок - ребро пути
+        affected = [stop for stop, (_, predecessors) in self.trees.items()
+                    if predecessors[u] == v or predecessors[v] == u]
+        self._reweight(edges, np.inf, affected)
+        self.closed.update(edges.tolist())
+
+    def open_segment(self, start, end):
+        u, v, edges = self._segment_edges(start, end)
+        weights = self.base_weights[edges]
+        # Деревья, в которых через открытый участок путь становится короче
+        affected = [stop for stop, (dist, _) in self.trees.items()
+                    if dist[v] + weights[0] < dist[u] or dist[u] + weights[1] < dist[v]]
+        self._reweight(edges, weights, affected)
+        self.closed.difference_update(edges.tolist())
+
+    # --- Nearest stop routes ---
+    def _stop_of_node(self):
+        """
+        Строка ближайшей по сети остановки для каждой вершины (-1 - ни одна не достижима) - по уже
+        посчитанным деревьям, как nearest_stop_routes: путь до остановки включает ребро от вершины привязки
+        до неё. При равных расстояниях - первая строка.
+        """
+        stop_rows = np.full(self.G.number_of_nodes, -1, dtype=np.int64)
+        best = np.full(self.G.number_of_nodes, np.inf)
+        for row, (node, offset) in enumerate(zip(self.bus_nodes.tolist(), self.bus_offsets.tolist())):
+            dist = self.trees[node][0] + offset
+            closer = dist < best
+            best[closer], stop_rows[closer] = dist[closer], row
+        return stop_rows
+
+    def _refresh_routes(self, changed_stops, rows=None):
+        """
+        Маршруты дом -> ближайшая по сети остановка, как в find_routes_and_places.
+        Пересчитываются дома rows и те, у кого сменилась ближайшая остановка или её дерево.
+        """
+        if not len(self.buses):
+            self._routes = [None] * len(self.houses)
+            return
+        house_points = place_points(self.houses)
+        stop_points = place_points(self.buses)
+        nearest = self._stop_of_node()[self.house_nodes]
+        rows = set(rows or ())
+        for row, stop_row in enumerate(nearest.tolist()):
+            if stop_row < 0:
+                self._routes[row] = None
+                continue
+            cached = self._routes[row]
+            stop_key = tuple(stop_points[stop_row].tolist())
+            stop_node = int(self.bus_nodes[stop_row])
+            if cached is None or row in rows or cached[0] != stop_key or cached[1] != stop_node \
+                    or stop_node in changed_stops:
+                self._routes[row] = (stop_key, stop_node, self._route(house_points[row], stop_key, stop_node, row))
+
+    def _route(self, house_point, stop_point, stop_node, row):
+        dist, predecessors = self.trees[stop_node]
+        node = self.house_nodes[row]
+        if not np.isfinite(dist[node]):
+            return None
+        path = reconstruct_path_to(predecessors, node, stop_node)
+        return [tuple(house_point.tolist())] + self.G.path_keys(path) + [stop_point]
+
+    # --- Results ---
+    def edge_loads(self):
+        return self.G.edge_dict(self.loads)
+
+    def routes(self):
+        house_points = place_points(self.houses)
+        return {tuple(point): cached[2] if cached is not None else None
+                for point, cached in zip(house_points.tolist(), self._routes)}
+
+    def summary(self, edge_loads=None):
+        """Сводка как у summarize_traffic_data: маршруты - пары (вершина дома, вершина остановки) с путём"""
+        house_nodes = np.flatnonzero(self.has_house)
+        routes_count, total_people = 0, 0.0
+        for dist, _ in self.trees.values():
+            reachable = house_nodes[np.isfinite(dist[house_nodes])]
+            routes_count += len(reachable)
+            total_people += self.node_weights[reachable].sum()
+        return traffic_summary(self.buses.shape[0], routes_count, total_people,
+                               self.edge_loads() if edge_loads is None else edge_loads)
+
+    def result(self):
+        """Ответ в формате get_routes плюс id домов и остановок (в том же порядке) для правок"""
+        edge_loads = self.edge_loads()
+        catchments = stop_catchments(self.G, self._stop_of_node(), self.house_nodes,
+                                     self.houses['Total_People'].to_numpy(dtype=float), place_points(self.buses))
+        result = routes_result(self.summary(edge_loads), self.houses, self.buses,
+                               (None, heatmap_edge_colors(self.G, edge_loads)), self.routes(), catchments)
+        result["analysis_id"] = self.id
+        result["house_ids"] = self.houses.index.tolist()
+        result["bus_stop_ids"] = self.buses.index.tolist()
+        closed = np.array(sorted(self.closed), dtype=np.int64)
+        starts, ends = self.G.sources[closed], self.G.indices[closed]
+        # Участок закрыт в обе стороны - выводим его один раз
+        result["closed_segments"] = [[self.G.node_key(u), self.G.node_key(v)]
+                                     for u, v in zip(starts.tolist(), ends.tolist()) if u < v]
+        return result
+
+    # --- Edits ---
+    def snapshot(self):
+        """Состояние до пакета правок для restore: то, что правки меняют на месте, копируется"""
+        state = dict(self.__dict__)
+        state.update(G=self.G.with_weights(self.G.weights), buses=self.buses.copy(), loads=self.loads.copy(),
+                     node_weights=self.node_weights.copy(), has_house=self.has_house.copy(),
+                     bus_places=self.bus_places.copy(), bus_nodes=self.bus_nodes.copy(),
+                     bus_offsets=self.bus_offsets.copy(), trees=dict(self.trees), closed=set(self.closed),
+                     _next_id=dict(self._next_id), _routes=list(self._routes))
+        return state
+
+    def restore(self, state):
+        self.__dict__.update(state)
+        self._sync_places()
+
+    def apply(self, edit):
+        """
+        Применяет одну правку - словарь с ключом op:
+        - add_building: x, y (или geometry в GeoJSON), apartments или total_people
+        - remove_building: id
+        - add_stop: x, y; move_stop: id, x, y; remove_stop: id
+        - close_segment / open_segment: start [x, y], end [x, y]
+        Возвращает id добавленного объекта или None.
+        """
+        op = edit.get("op")
+
+        def field(name):
+            if name not in edit:
+                raise ValueError(f"{op} needs {name}")
+            return edit[name]
+
+        if op in ("add_building", "add_stop", "move_stop"):
+            geometry = shapely.geometry.shape(edit["geometry"]) if "geometry" in edit \
+                else shapely.Point(float(field("x")), float(field("y")))
+        if op == "add_building":
+            return self.add_building(geometry, edit.get("apartments"), edit.get("total_people"))
+        if op == "remove_building":
+            return self.remove_building(field("id"))
+        if op == "add_stop":
+            return self.add_stop(geometry)
+        if op == "move_stop":
+            return self.move_stop(field("id"), geometry)
+        if op == "remove_stop":
+            return self.remove_stop(field("id"))
+        if op == "close_segment":
+            return self.close_segment(field("start"), field("end"))
+        if op == "open_segment":
+            return self.open_segment(field("start"), field("end"))
+        raise ValueError(f"Unknown edit {op}")
+
+
+def create_analysis(folder_path, id, version, lat=55.555, long=37.495, radius=1000, seed=POPULATION_SEED,
+                    progress=None):
+    """Строит Analysis для окна версии - те же данные и привязка к улицам, что у find_routes_and_places"""
+    pipeline = get_pipeline(folder_path, id, version, lat, long, radius, seed, progress)
+    pipeline.window()
+    if progress is not None:
+        progress("what_if")
+    analysis = Analysis.from_pipeline(pipeline)
+    analysis.session_id = id
+    return analysis
+
+
+def apply_edits(analysis, edits):
+    """
+    Применяет правки по очереди и возвращает результат анализа с id добавленных объектов (created_ids).
+    Пакет применяется целиком или не применяется: при ошибке анализ возвращается к состоянию до пакета.
+    Не найден объект - KeyError, неверная правка - ValueError.
+    """
+    with analysis.lock:
+        state = analysis.snapshot()
+        created = []
+        try:
+            for number, edit in enumerate(edits):
+                try:
+                    created.append(analysis.apply(edit))
+                except KeyError as e:
+                    raise KeyError(f"Edit {number}: {e.args[0] if e.args else 'not found'}")
+                except (ValueError, TypeError) as e:
+                    raise ValueError(f"Edit {number}: {e}")
+        except Exception:
+            analysis.restore(state)
+            raise
+        result = analysis.result()
+    result["created_ids"] = created
+    return result
+
+
+# --- Tasks ---
+# Анализы хранятся в процессе очереди задач, который их создал; правки этого анализа идут в тот же процесс
+def create_what_if(folder_path, id, version, lat=55.555, long=37.495, radius=1000, seed=POPULATION_SEED,
+                   progress=None):
+    """Задача очереди: создаёт анализ окна в хранилище процесса и возвращает его результат"""
+    analysis = analyses.put(create_analysis(folder_path, id, version, lat, long, radius, seed, progress))
+    return apply_edits(analysis, [])
+
+
+def _stored_analysis(analysis_id, session_id):
+    analysis = analyses.get(analysis_id, session_id)
+    if analysis is None:
+        raise KeyError("Analysis not found")
+    return analysis
+
+
+def edit_what_if(analysis_id, session_id, edits=(), progress=None):
+    """Задача очереди: правки анализа из хранилища процесса (без правок - текущий результат)"""
+    return apply_edits(_stored_analysis(analysis_id, session_id), edits)
+
+
+def delete_what_if(analysis_id, session_id, progress=None):
+    """Задача очереди: удаляет анализ из хранилища процесса"""
+    _stored_analysis(analysis_id, session_id)
+    analyses.remove(analysis_id)
+    return {"deleted": analysis_id}
+
+
+class AnalysisStore:
+    """LRU-хранилище анализов процесса; анализ доступен только своей сессии"""
+
+    def __init__(self, max_items=WHAT_IF_MAX_ANALYSES):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, analysis):
+        with self._lock:
+            self._items[analysis.id] = analysis
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return analysis
+
+    def get(self, analysis_id, session_id=None):
+        with self._lock:
+            analysis = self._items.get(analysis_id)
+            if analysis is not None:
+                self._items.move_to_end(analysis_id)
+        if analysis is None or (session_id is not None and analysis.session_id != session_id):
+            return None
+        return analysis
+
+    def remove(self, analysis_id):
+        with self._lock:
+            return self._items.pop(analysis_id, None) is not None
+
+
+analyses = AnalysisStore()